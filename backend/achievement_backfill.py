@@ -0,0 +1,162 @@
+"""Retroactive evaluation of achievement definitions across all players
+
+When a definition is added or changed, ``backfill_achievements`` walks the
+players collection in ``_id`` order, compares each batch's aggregate
+counters against every requirement with NumPy, and writes the unlocks with
+unordered bulk inserts. The unique (player_id, achievement_id) index turns
+re-inserts into no-ops, and the position reached is saved after each batch
+in ``achievement_backfills`` so an interrupted run resumes where it stopped.
+
+Batches are evaluated in the offload process pool while the following
+batches are read; results are applied (and the position saved) in order.
+"""
+import logging
+from collections import Counter, deque
+from datetime import datetime
+
+import bson
+import numpy as np
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
+
+import offload
+from bulk_reads import decode_batch, iter_raw_batches, raw_collection
+from counters import unlocks_counter
+from ids import decode_id
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 5000
+DUPLICATE_KEY_ERROR = 11000
+
+def backfill_job_id(achievement_ids) -> str:
+    return ",".join(sorted(achievement_ids))
+
+def evaluate_batch(batch, achievements: list, progress_fields: dict) -> dict:
+    """Return {achievement_id: [player ids that meet it]} for one decoded batch"""
+    player_ids = [decode_id(doc.get("id")) for doc in batch]
+    columns = {}
+    unlocked = {}
+    for achievement in achievements:
+        field = progress_fields[achievement["requirement_type"]]
+        if field not in columns:
+            columns[field] = np.fromiter(
+                (doc.get(field) or 0 for doc in batch), dtype=np.int64, count=len(batch)
+            )
+        mask = columns[field] >= achievement["requirement_value"]
+        unlocked[achievement["id"]] = [player_ids[i] for i in np.flatnonzero(mask)]
+    return unlocked
+
+def evaluate_raw_batch(raw_docs: list, achievements: list, progress_fields: dict) -> dict:
+    """evaluate_batch over raw BSON bytes (cheaper to send to a pool worker than documents)"""
+    return evaluate_batch(decode_batch(raw_docs), achievements, progress_fields)
+
+async def _insert_unlocks(player_achievements_collection, docs: list) -> dict:
+    """Unordered bulk insert that ignores unlocks the player already has
+
+    Returns {achievement_id: unlocks inserted}.
+    """
+    if not docs:
+        return {}
+    duplicates = set()
+    try:
+        await player_achievements_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+    inserted = Counter(
+        doc["achievement_id"] for index, doc in enumerate(docs) if index not in duplicates
+    )
+    return dict(inserted)
+
+async def backfill_achievements(achievement_ids, players_collection, achievements_collection,
+                                player_achievements_collection, backfills_collection,
+                                progress_fields: dict, batch_size: int = BACKFILL_BATCH_SIZE,
+                                restart: bool = False, on_progress=None, counters=None):
+    """Unlock the given achievements for every player who already qualifies
+
+    Pass ``counters`` (a ShardedCounters) to keep the unlock counts current.
+    """
+    achievements = await achievements_collection.find(
+        {"id": {"$in": list(achievement_ids)}}, {"_id": 0}
+    ).to_list(length=None)
+    missing = set(achievement_ids) - {a["id"] for a in achievements}
+    if missing:
+        raise ValueError(f"Unknown achievements: {', '.join(sorted(missing))}")
+    unsupported = [a["id"] for a in achievements if a["requirement_type"] not in progress_fields]
+    if unsupported:
+        raise ValueError(
+            f"Achievements not derivable from player aggregates: {', '.join(unsupported)}"
+        )
+
+    job_id = backfill_job_id(achievement_ids)
+    job = None if restart else await backfills_collection.find_one({"_id": job_id})
+    if not job or job.get("status") == "completed":
+        job = {
+            "_id": job_id,
+            "achievement_ids": sorted(achievement_ids),
+            "last_player": None,
+            "processed": 0,
+            "unlocked": 0,
+            "status": "running",
+            "started_at": datetime.utcnow(),
+        }
+        await backfills_collection.replace_one({"_id": job_id}, job, upsert=True)
+
+    fields = {progress_fields[a["requirement_type"]] for a in achievements}
+    projection = {"_id": 1, "id": 1, **{field: 1 for field in fields}}
+    query = {"total_games": {"$gt": 0}}
+    if job["last_player"] is not None:
+        query["_id"] = {"$gt": job["last_player"]}
+
+    cursor = raw_collection(players_collection).find(query, projection, batch_size=batch_size).sort("_id", 1)
+    positions = deque()  # (last _id, size) of each batch handed to the pool, in order
+
+    async def raw_batches():
+        async for batch in iter_raw_batches(cursor, batch_size):
+            positions.append((batch[-1]["_id"], len(batch)))
+            yield [doc.raw if isinstance(doc, RawBSONDocument) else bson.encode(doc) for doc in batch]
+
+    async for unlocked in offload.imap(evaluate_raw_batch, raw_batches(), achievements, progress_fields):
+        last_player, batch_len = positions.popleft()
+        now = datetime.utcnow()
+        docs = [
+            {
+                "player_id": player_id,
+                "achievement_id": achievement_id,
+                "unlocked_at": now,
+                "game_session_id": None,
+            }
+            for achievement_id, player_ids in unlocked.items()
+            for player_id in player_ids
+        ]
+        inserted = await _insert_unlocks(player_achievements_collection, docs)
+        if counters is not None:
+            await counters.incr_many({
+                unlocks_counter(achievement_id): count for achievement_id, count in inserted.items()
+            })
+
+        job["last_player"] = last_player
+        job["processed"] += batch_len
+        job["unlocked"] += sum(inserted.values())
+        await backfills_collection.update_one(
+            {"_id": job_id},
+            {"$set": {
+                "last_player": job["last_player"],
+                "processed": job["processed"],
+                "unlocked": job["unlocked"],
+                "updated_at": now,
+            }}
+        )
+        if on_progress:
+            on_progress(job["processed"], job["unlocked"])
+
+    job["status"] = "completed"
+    await backfills_collection.update_one(
+        {"_id": job_id},
+        {"$set": {"status": "completed", "completed_at": datetime.utcnow()}}
+    )
+    logger.info("Achievement backfill %s: %d players, %d unlocks", job_id, job["processed"], job["unlocked"])
+    return job
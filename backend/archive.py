@@ -0,0 +1,254 @@
+"""Cold-tier archival for old game sessions and scores
+
+Finished sessions older than ``ARCHIVE_SESSION_AGE_DAYS`` are packed into
+compressed batches (one zlib-compressed BSON stream per document in
+``game_sessions_archive``, or Parquet files under ``ARCHIVE_DIR``) and
+removed from the hot collection. Old scores are archived the same way,
+except that the all-time top ``ARCHIVE_KEEP_TOP_SCORES`` always stay hot.
+
+All-time figures keep working without the archived rows:
+
+* player totals and best scores live on the player documents;
+* every archived score is added to a DDSketch in ``score_archive_stats``,
+  so ranks are ``hot count + archived estimate`` (and exact for the top N,
+  since nothing above the retained cut-off is ever archived);
+* its game duration goes into a second sketch there, which the global
+  duration distribution folds in;
+* ``total_entries`` adds the archived count to the maintained ``scores``
+  counter, which archiving decrements by the rows it deletes.
+
+``restore_archived`` moves batches from the Mongo archive collections back
+to the hot ones (reversing the sketches and the counter for scores); raise
+``ARCHIVE_SESSION_AGE_DAYS`` first, or the next archive run moves them out
+again.
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+
+import bson
+from bson.binary import Binary
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from counters import SCORES_COUNTER
+from score_sketch import DDSketch
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SESSION_AGE_DAYS = int(os.environ.get("ARCHIVE_SESSION_AGE_DAYS", "90"))
+ARCHIVE_KEEP_TOP_SCORES = int(os.environ.get("ARCHIVE_KEEP_TOP_SCORES", "1000"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "5000"))
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR")  # Parquet files instead of Mongo archive collections
+ARCHIVE_STATS_REFRESH_INTERVAL = int(os.environ.get("ARCHIVE_STATS_REFRESH_INTERVAL", "60"))
+ARCHIVE_STATS_ID = "scores"
+ARCHIVE_DURATIONS_ID = "durations"
+
+# Refuse to start rather than fail on the first archived batch
+if ARCHIVE_DIR and not (
+    importlib.util.find_spec("pandas")
+    and any(importlib.util.find_spec(engine) for engine in ("pyarrow", "fastparquet"))
+):
+    raise RuntimeError("ARCHIVE_DIR needs pandas and a Parquet engine: pip install pandas pyarrow")
+
+def compress_batch(docs: list) -> bytes:
+    return zlib.compress(b"".join(bson.encode(doc) for doc in docs), 6)
+
+def decompress_batch(payload: bytes) -> list:
+    """Inverse of compress_batch, for restores and offline analysis"""
+    return bson.decode_all(zlib.decompress(payload))
+
+def _write_parquet(kind: str, month: str, batch_key: str, docs: list):
+    import pandas as pd
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    frame = pd.DataFrame([{**doc, "_id": str(doc["_id"])} for doc in docs])
+    frame.to_parquet(os.path.join(ARCHIVE_DIR, f"{kind}-{month}-{batch_key}.parquet"), index=False)
+
+async def _archive_batch(kind: str, docs: list, time_field: str, archive_collection):
+    """Write one batch to the cold tier, grouped by month; safe to repeat"""
+    by_month = {}
+    for doc in docs:
+        month = (doc.get(time_field) or datetime.utcnow()).strftime("%Y-%m")
+        by_month.setdefault(month, []).append(doc)
+
+    for month, month_docs in by_month.items():
+        # Keyed on the first _id so a re-run after a crash overwrites, not duplicates
+        batch_key = str(month_docs[0]["_id"])
+        if ARCHIVE_DIR:
+            _write_parquet(kind, month, batch_key, month_docs)
+            continue
+        await archive_collection.replace_one(
+            {"_id": f"{month}:{batch_key}"},
+            {
+                "_id": f"{month}:{batch_key}",
+                "month": month,
+                "count": len(month_docs),
+                "codec": "zlib+bson",
+                "archived_at": datetime.utcnow(),
+                "payload": Binary(compress_batch(month_docs)),
+            },
+            upsert=True
+        )
+
+async def _archive_matching(kind: str, collection, archive_collection, query: dict,
+                            time_field: str, batch_size: int, on_batch=None, on_deleted=None):
+    """Move every document matching query to the cold tier, batch by batch"""
+    archived = 0
+    while True:
+        docs = await collection.find(query).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not docs:
+            return archived
+        await _archive_batch(kind, docs, time_field, archive_collection)
+        if on_batch:
+            await on_batch(docs)
+        result = await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        if on_deleted:
+            await on_deleted(result.deleted_count)
+        archived += len(docs)
+        logger.info("Archived %d %s", archived, kind)
+
+async def archive_sessions(sessions_collection, archive_collection,
+                           older_than_days: int = ARCHIVE_SESSION_AGE_DAYS,
+                           batch_size: int = ARCHIVE_BATCH_SIZE):
+    """Archive finished sessions that started before the cut-off"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    query = {"status": {"$in": ["completed", "abandoned"]}, "start_time": {"$lt": cutoff}}
+    return await _archive_matching(
+        "sessions", sessions_collection, archive_collection, query, "start_time", batch_size
+    )
+
+async def _record_sketch(archive_stats_collection, sketch_id: str, values: list, batch_key: str,
+                         sign: int = 1, guard: str = "last_batch"):
+    """Add (or with sign=-1 remove) values in a shared sketch document, once per batch"""
+    sketch = DDSketch()
+    for value in values:
+        sketch.add(value)
+    increments = {f"buckets.{key}": sign * count for key, count in sketch.buckets.items()}
+    increments["zero_count"] = sign * sketch.zero_count
+    increments["count"] = sign * sketch.count
+    try:
+        # The guard keeps a retried batch from being counted twice
+        await archive_stats_collection.update_one(
+            {"_id": sketch_id, guard: {"$ne": batch_key}},
+            {"$inc": increments, "$set": {guard: batch_key}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass
+
+async def archive_scores(scores_collection, archive_collection, archive_stats_collection,
+                         older_than_days: int = ARCHIVE_SESSION_AGE_DAYS,
+                         keep_top: int = ARCHIVE_KEEP_TOP_SCORES,
+                         batch_size: int = ARCHIVE_BATCH_SIZE, counters=None):
+    """Archive old scores below the retained top-N, recording them in the archive sketch
+
+    Pass ``counters`` (a ShardedCounters) to decrement the hot score count.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    query = {"created_at": {"$lt": cutoff}}
+
+    retained = await scores_collection.find({}, {"_id": 0, "score": 1}).sort(
+        "score", -1
+    ).skip(max(keep_top - 1, 0)).limit(1).to_list(length=1)
+    if retained:
+        query["score"] = {"$lt": retained[0]["score"]}
+    else:
+        return 0  # Fewer scores than the retained top-N
+
+    async def record(docs):
+        batch_key = str(docs[0]["_id"])
+        await _record_sketch(
+            archive_stats_collection, ARCHIVE_STATS_ID, [doc.get("score", 0) for doc in docs], batch_key
+        )
+        await _record_sketch(
+            archive_stats_collection, ARCHIVE_DURATIONS_ID, [doc.get("game_duration", 0) for doc in docs], batch_key
+        )
+
+    async def deleted(count):
+        if counters is not None:
+            await counters.incr(SCORES_COUNTER, -count)
+
+    return await _archive_matching(
+        "scores", scores_collection, archive_collection, query, "created_at", batch_size, record, deleted
+    )
+
+async def restore_archived(collection, archive_collection, month: str = None, on_batch=None) -> int:
+    """Move archived batches (of one YYYY-MM month, or all) back to the hot collection
+
+    Safe to repeat after a failure: documents already restored are skipped
+    and a batch is deleted from the archive only once it is back. Calls
+    ``on_batch(batch id, docs, inserted count)`` before deleting each one.
+    """
+    batch_ids = [
+        doc["_id"] async for doc in archive_collection.find({"month": month} if month else {}, {"_id": 1})
+    ]
+    restored = 0
+    for batch_id in batch_ids:
+        batch = await archive_collection.find_one({"_id": batch_id})
+        if not batch:
+            continue
+        docs = decompress_batch(batch["payload"])
+        try:
+            inserted = len((await collection.insert_many(docs, ordered=False)).inserted_ids)
+        except BulkWriteError as e:
+            inserted = e.details["nInserted"]  # The rest were restored by an earlier run
+        if on_batch:
+            await on_batch(batch_id, docs, inserted)
+        await archive_collection.delete_one({"_id": batch_id})
+        restored += inserted
+        logger.info("Restored %d documents", restored)
+    return restored
+
+async def restore_scores(scores_collection, archive_collection, archive_stats_collection,
+                         month: str = None, counters=None) -> int:
+    """Restore archived scores, taking them back out of the archive sketches
+
+    Pass ``counters`` (a ShardedCounters) to increment the hot score count.
+    """
+    async def unrecord(batch_id, docs, inserted):
+        for sketch_id, field in ((ARCHIVE_STATS_ID, "score"), (ARCHIVE_DURATIONS_ID, "game_duration")):
+            await _record_sketch(
+                archive_stats_collection, sketch_id, [doc.get(field, 0) for doc in docs], batch_id,
+                sign=-1, guard="last_restored"
+            )
+        if counters is not None:
+            await counters.incr(SCORES_COUNTER, inserted)
+
+    return await restore_archived(scores_collection, archive_collection, month, unrecord)
+
+class ArchivedScores:
+    """Cached views of the archived-score and archived-duration sketches"""
+
+    def __init__(self):
+        self.sketch = DDSketch()
+        self.durations = DDSketch()
+
+    @property
+    def count(self) -> int:
+        return self.sketch.count
+
+    def count_above(self, score: int) -> int:
+        if not self.sketch.count:
+            return 0
+        return self.sketch.count_above(score)
+
+    async def refresh(self, archive_stats_collection):
+        doc = await archive_stats_collection.find_one({"_id": ARCHIVE_STATS_ID})
+        self.sketch = DDSketch.from_document(doc) if doc else DDSketch()
+        doc = await archive_stats_collection.find_one({"_id": ARCHIVE_DURATIONS_ID})
+        self.durations = DDSketch.from_document(doc) if doc else DDSketch()
+
+archived_scores = ArchivedScores()
+
+async def archived_scores_refresh_loop(archive_stats_collection,
+                                       interval: int = ARCHIVE_STATS_REFRESH_INTERVAL):
+    """Keep this worker's archived-score totals current"""
+    while True:
+        try:
+            await archived_scores.refresh(archive_stats_collection)
+        except Exception:
+            logger.exception("Archived score stats refresh failed")
+        await asyncio.sleep(interval)
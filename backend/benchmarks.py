@@ -0,0 +1,222 @@
+"""Micro-benchmarks for the backend's CPU-bound paths
+
+Run from the backend directory, e.g. ``python benchmarks.py replay``,
+``python benchmarks.py columns`` or ``python benchmarks.py encodings``.
+Inputs are synthetic and built in memory, so no database is needed.
+"""
+import gzip
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import bson
+import numpy as np
+import typer
+from bson.raw_bson import RawBSONDocument
+from fastapi.encoders import jsonable_encoder
+
+from bulk_reads import RAW_CODEC_OPTIONS, SCORE_COLUMNS, _column, decode_batch
+from content_negotiation import COMPRESSORS, brotli, msgpack, zstandard
+from event_log import (
+    EVENT, encode_event, fold_batch, encode_state_chunk, decode_state_chunk
+)
+from models import (
+    Player, GameSession, GameStats, PowerUpStats, AchievementWithStatus, DetailedStats,
+    LeaderboardEntry, LeaderboardResponse
+)
+
+app = typer.Typer(help="Cosmic Defender backend benchmarks")
+
+@app.callback()
+def main():
+    """Cosmic Defender backend benchmarks"""
+
+def _report(name: str, count: int, seconds: float, unit: str = "events"):
+    typer.echo(f"{name:<24} {count:>10} {unit} in {seconds:7.3f}s  {count / seconds:>12,.0f} {unit}/s")
+
+def _synthetic_events(events: int, players: int, seed: int) -> list:
+    rng = random.Random(seed)
+    player_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(players)]
+    now = datetime.utcnow()
+    return [
+        bson.encode(encode_event(seq, {
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "player_id": rng.choice(player_ids),
+            "end_time": now,
+            "final_score": rng.randint(0, 50000),
+            "max_wave": rng.randint(1, 30),
+            "game_duration": rng.randint(10, 1800),
+            "enemies_destroyed": rng.randint(0, 500),
+            "asteroids_destroyed": rng.randint(0, 200),
+            "powerups_collected": rng.randint(0, 20),
+        }))
+        for seq in range(1, events + 1)
+    ]
+
+@app.command("replay")
+def replay(
+    events: int = typer.Option(500000, help="Events in the synthetic log"),
+    players: int = typer.Option(20000, help="Distinct players"),
+    batch_size: int = typer.Option(10000, help="Events per cursor batch"),
+    seed: int = typer.Option(1, help="Random seed"),
+):
+    """Fold throughput of the game event log, plus snapshot encode/decode"""
+    log = _synthetic_events(events, players, seed)
+    size = sum(len(doc) for doc in log)
+    typer.echo(f"{events} events, {size / events:.1f} bytes/event ({EVENT.size} bytes packed counters)")
+
+    state = {}
+    started = time.perf_counter()
+    for start in range(0, len(log), batch_size):
+        # decode_all stands in for the driver decoding one cursor batch
+        fold_batch(state, bson.decode_all(b"".join(log[start:start + batch_size])))
+    _report("decode + fold", events, time.perf_counter() - started)
+
+    rows = list(state.items())
+    started = time.perf_counter()
+    payload = encode_state_chunk(rows)
+    _report("snapshot encode", len(rows), time.perf_counter() - started, "players")
+
+    restored = {}
+    started = time.perf_counter()
+    decode_state_chunk(payload, restored)
+    _report("snapshot decode", len(rows), time.perf_counter() - started, "players")
+    typer.echo(f"snapshot size {len(payload) / 1024:.0f} KiB for {len(rows)} players")
+
+@app.command("columns")
+def columns(
+    docs: int = typer.Option(200000, help="Projected score documents"),
+    batch_size: int = typer.Option(10000, help="Documents per cursor batch"),
+    seed: int = typer.Option(1, help="Random seed"),
+):
+    """Packing raw cursor batches into NumPy columns: lazy RawBSONDocument access vs decode_batch"""
+    rng = random.Random(seed)
+    raw = [
+        RawBSONDocument(bson.encode({
+            "score": rng.randint(0, 50000), "wave": rng.randint(1, 30), "game_duration": rng.randint(10, 1800)
+        }), RAW_CODEC_OPTIONS)
+        for _ in range(docs)
+    ]
+    batches = [raw[start:start + batch_size] for start in range(0, docs, batch_size)]
+
+    # Raw documents cache their inflated form, so each run gets fresh copies
+    lazy = [[RawBSONDocument(doc.raw, RAW_CODEC_OPTIONS) for doc in batch] for batch in batches]
+    started = time.perf_counter()
+    for batch in lazy:
+        lazy_columns = {field: _column(batch, field, dtype) for field, dtype in SCORE_COLUMNS.items()}
+    _report("RawBSONDocument.get", docs, time.perf_counter() - started, "docs")
+
+    started = time.perf_counter()
+    for batch in batches:
+        decoded = decode_batch(batch)
+        decoded_columns = {field: _column(decoded, field, dtype) for field, dtype in SCORE_COLUMNS.items()}
+    _report("decode_batch", docs, time.perf_counter() - started, "docs")
+    assert all(np.array_equal(lazy_columns[field], decoded_columns[field]) for field in SCORE_COLUMNS)
+
+ACHIEVEMENT_ICONS = ["🎯", "☄️", "🌊", "⚡", "🏆", "💥", "🛡️", "🚀", "⭐", "👑"]
+
+def _synthetic_stats(rng: random.Random, achievements: int, recent_games: int) -> dict:
+    now = datetime.utcnow()
+    player = Player(username="pilot_one", total_games=250, total_score=1_250_000, best_score=48_000,
+                    total_playtime=90_000, last_played=now)
+    games = [
+        GameSession(player_id=player.id, player_username=player.username, start_time=now - timedelta(minutes=i * 7),
+                    end_time=now - timedelta(minutes=i * 7 - 5), final_score=rng.randint(0, 50000),
+                    max_wave=rng.randint(1, 30), enemies_destroyed=rng.randint(0, 500),
+                    asteroids_destroyed=rng.randint(0, 200), powerups_collected=rng.randint(0, 20),
+                    game_duration=rng.randint(60, 1800), status="completed")
+        for i in range(recent_games)
+    ]
+    catalog = [
+        AchievementWithStatus(
+            id=f"achievement_{i}", name=f"Achievement {i}",
+            description=f"Destroy {10 * (i + 1)} enemies in a single cosmic defense run",
+            icon=ACHIEVEMENT_ICONS[i % len(ACHIEVEMENT_ICONS)], category="combat",
+            requirement_type="enemies_destroyed", requirement_value=10 * (i + 1), points=10 + i,
+            is_hidden=False, unlocked=i % 3 == 0, unlocked_at=now if i % 3 == 0 else None, progress=rng.randint(0, 500)
+        )
+        for i in range(achievements)
+    ]
+    stats = DetailedStats(
+        player=player,
+        game_stats=GameStats(total_games=250, total_score=1_250_000, best_score=48_000, average_score=5000.0,
+                             total_playtime=90_000, total_enemies_destroyed=40_000, total_asteroids_destroyed=9_000,
+                             total_powerups_collected=1_200, best_wave=28, win_rate=0.1,
+                             achievements_unlocked=achievements // 3, total_achievements=achievements),
+        powerup_stats=[PowerUpStats(type="shield", collected_count=40)],
+        recent_games=games,
+        achievements=catalog,
+    )
+    return jsonable_encoder(stats)
+
+def _synthetic_leaderboard(rng: random.Random, entries: int) -> dict:
+    now = datetime.utcnow()
+    page = LeaderboardResponse(
+        entries=[
+            LeaderboardEntry(rank=i + 1, player_id=str(uuid.UUID(int=rng.getrandbits(128))),
+                             player_username=f"pilot_{rng.randint(0, 99999)}", score=50000 - i * 37,
+                             wave=rng.randint(1, 30), game_duration=rng.randint(60, 1800), created_at=now)
+            for i in range(entries)
+        ],
+        total_entries=250_000, user_rank=1234, user_best_score=31000, user_rank_exact=True
+    )
+    return jsonable_encoder(page)
+
+def _time_per_call(fn, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+@app.command("encodings")
+def encodings(
+    entries: int = typer.Option(100, help="Leaderboard entries per page"),
+    achievements: int = typer.Option(40, help="Achievements in the stats payload"),
+    recent_games: int = typer.Option(10, help="Recent games in the stats payload"),
+    repeat: int = typer.Option(200, help="Timed repetitions per cell"),
+    seed: int = typer.Option(1, help="Random seed"),
+):
+    """Size and CPU cost of each response representation and compression"""
+    rng = random.Random(seed)
+    payloads = {
+        "leaderboard": _synthetic_leaderboard(rng, entries),
+        "player stats": _synthetic_stats(rng, achievements, recent_games),
+    }
+    representations = {
+        "json": (
+            lambda content: json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode(),
+            json.loads,
+        ),
+    }
+    if msgpack:
+        representations["msgpack"] = (msgpack.packb, msgpack.unpackb)
+    decompressors = {"identity": lambda body: body, "gzip": gzip.decompress}
+    if brotli:
+        decompressors["br"] = brotli.decompress
+    if zstandard:
+        decompressors["zstd"] = zstandard.ZstdDecompressor().decompress
+    compressors = {"identity": lambda body: body, **COMPRESSORS}
+
+    typer.echo(f"{'payload':<14} {'format':<8} {'encoding':<9} {'bytes':>8} {'ratio':>6} "
+               f"{'server µs':>10} {'client µs':>10}")
+    for payload_name, content in payloads.items():
+        for format_name, (serialize, parse) in representations.items():
+            body = serialize(content)
+            serialize_cost = _time_per_call(lambda: serialize(content), repeat)
+            for encoding, compress in compressors.items():
+                wire = compress(body)
+                decompress = decompressors[encoding]
+                # Server: serialize + compress; client: decompress + parse
+                server = serialize_cost + _time_per_call(lambda: compress(body), repeat)
+                client = _time_per_call(lambda: parse(decompress(wire)), repeat)
+                typer.echo(f"{payload_name:<14} {format_name:<8} {encoding:<9} {len(wire):>8} "
+                           f"{len(wire) / len(body):>6.2f} {server * 1e6:>10.1f} {client * 1e6:>10.1f}")
+    missing = [name for name, module in (("brotli", brotli), ("zstandard", zstandard), ("msgpack", msgpack))
+               if module is None]
+    if missing:
+        typer.echo(f"(not installed: {', '.join(missing)})")
+
+if __name__ == "__main__":
+    app()
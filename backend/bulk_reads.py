@@ -0,0 +1,95 @@
+"""Bulk cursor reads for large scans (warmups, exports, analytics)
+
+Reads go through a ``RawBSONDocument`` codec so Motor hands back the raw
+bytes of each batch without decoding them. ``decode_batch`` then decodes a
+whole batch in one ``bson.decode_all`` call, and only the fields the
+server-side projection kept, which is several times faster than
+``RawBSONDocument.get`` (that inflates each document on first access; see
+``python benchmarks.py columns``). Numeric columns are packed straight into
+NumPy arrays, so only one batch of dicts is alive at a time.
+"""
+import bson
+import numpy as np
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument, tz_aware=False)
+DECODE_CODEC_OPTIONS = CodecOptions(tz_aware=False)
+DEFAULT_BATCH_SIZE = 10000
+
+# Numeric score fields and the dtypes used to hold them
+SCORE_COLUMNS = {
+    "score": np.int64,
+    "wave": np.int32,
+    "game_duration": np.int32,
+}
+
+def raw_collection(collection):
+    """Return a view of a collection that decodes documents lazily"""
+    return collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+
+async def iter_raw_batches(cursor, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Yield lists of RawBSONDocument from a cursor, one server batch at a time"""
+    while True:
+        batch = await cursor.to_list(length=batch_size)
+        if not batch:
+            return
+        yield batch
+
+def decode_batch(batch) -> list:
+    """Decode a raw batch (RawBSONDocuments or their bytes) into dicts in one pass"""
+    return bson.decode_all(
+        b"".join(doc if isinstance(doc, bytes) else doc.raw for doc in batch), DECODE_CODEC_OPTIONS
+    )
+
+def _column(batch, field: str, dtype):
+    """Pack one field of a decoded batch into an array"""
+    if np.dtype(dtype).kind == "O":
+        return np.array([doc.get(field) for doc in batch], dtype=object)
+    return np.fromiter((doc.get(field) or 0 for doc in batch), dtype=dtype, count=len(batch))
+
+def _concat(chunks: dict, columns: dict):
+    """Join per-batch chunks into one array per column"""
+    return {
+        field: np.concatenate(parts) if parts else np.empty(0, dtype=columns[field])
+        for field, parts in chunks.items()
+    }
+
+async def iter_column_batches(collection, columns: dict, filter: dict = None, sort=None,
+                              batch_size: int = DEFAULT_BATCH_SIZE):
+    """Yield {field: array} for each server batch of matching documents"""
+    projection = {"_id": 0, **{field: 1 for field in columns}}
+    cursor = raw_collection(collection).find(filter or {}, projection, batch_size=batch_size)
+    if sort:
+        cursor = cursor.sort(sort)
+
+    async for batch in iter_raw_batches(cursor, batch_size):
+        docs = decode_batch(batch)
+        yield {field: _column(docs, field, dtype) for field, dtype in columns.items()}
+
+async def read_columns(collection, columns: dict, filter: dict = None, sort=None,
+                       batch_size: int = DEFAULT_BATCH_SIZE):
+    """Read the given fields of every matching document into NumPy arrays
+
+    ``columns`` maps field name to dtype; use ``object`` for string fields.
+    Missing numeric fields are read as 0.
+    """
+    chunks = {field: [] for field in columns}
+    async for batch in iter_column_batches(collection, columns, filter, sort, batch_size):
+        for field, values in batch.items():
+            chunks[field].append(values)
+    return _concat(chunks, columns)
+
+async def aggregate_columns(collection, pipeline: list, columns: dict,
+                            batch_size: int = DEFAULT_BATCH_SIZE):
+    """Run an aggregation and read its output fields into NumPy arrays"""
+    cursor = raw_collection(collection).aggregate(
+        pipeline, batchSize=batch_size, allowDiskUse=True
+    )
+
+    chunks = {field: [] for field in columns}
+    async for batch in iter_raw_batches(cursor, batch_size):
+        docs = decode_batch(batch)
+        for field, dtype in columns.items():
+            chunks[field].append(_column(docs, field, dtype))
+    return _concat(chunks, columns)
@@ -0,0 +1,191 @@
+"""Negotiated response encodings: compression and MessagePack
+
+``CompressionMiddleware`` compresses complete responses of compressible
+types (JSON, MessagePack, text) of at least ``COMPRESSION_MIN_BYTES`` with
+the best encoding the client accepts. Preference goes to zstd, then brotli,
+then gzip among those installed; ``brotli`` and ``zstandard`` are optional.
+Streamed responses, partial content and responses that already carry a
+``Content-Encoding`` pass through untouched.
+
+Routes using ``NegotiatedRoute`` with ``NegotiatedResponse`` as their
+response class serve the same payload as ``application/msgpack`` when the
+request's ``Accept`` header prefers it over JSON (and ``msgpack`` is
+installed). Datetimes are ISO strings in both representations.
+"""
+import contextvars
+import gzip
+import os
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "3"))
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+COMPRESSIBLE_TYPES = ("application/json", "text/") + MSGPACK_MEDIA_TYPES
+
+def _gzip(body: bytes) -> bytes:
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+def _brotli(body: bytes) -> bytes:
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+
+_zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if zstandard else None
+
+def _zstd(body: bytes) -> bytes:
+    return _zstd_compressor.compress(body)
+
+# Server preference order, best first
+COMPRESSORS = {
+    name: compress
+    for name, compress, available in (
+        ("zstd", _zstd, zstandard is not None),
+        ("br", _brotli, brotli is not None),
+        ("gzip", _gzip, True),
+    )
+    if available
+}
+
+def parse_quality_list(header: str) -> dict:
+    """{token: q} from an Accept or Accept-Encoding header"""
+    qualities = {}
+    for part in header.split(","):
+        token, *params = [piece.strip() for piece in part.split(";")]
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[token.lower()] = max(q, qualities.get(token.lower(), 0.0))
+    return qualities
+
+def choose_encoding(accept_encoding: str):
+    """The best compression the client accepts, or None for identity"""
+    qualities = parse_quality_list(accept_encoding)
+    wildcard = qualities.get("*", 0.0)
+    best, best_q = None, 0.0
+    for name in COMPRESSORS:
+        q = qualities.get(name, wildcard)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def prefers_msgpack(accept: str) -> bool:
+    if msgpack is None or not accept:
+        return False
+    qualities = parse_quality_list(accept)
+    msgpack_q = max(qualities.get(media_type, 0.0) for media_type in MSGPACK_MEDIA_TYPES)
+    return msgpack_q > 0 and msgpack_q >= qualities.get("application/json", 0.0)
+
+def _add_vary(headers: MutableHeaders, value: str):
+    vary = headers.get("vary")
+    if not vary:
+        headers["Vary"] = value
+    elif value.lower() not in vary.lower():
+        headers["Vary"] = f"{vary}, {value}"
+
+class CompressionMiddleware:
+    """Compress complete responses with the negotiated Content-Encoding"""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_compressed(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message  # Held until the body shows whether to compress
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                if start_message is not None:
+                    # Another body type (zero-copy send) is never compressed
+                    await send(start_message)
+                    start_message = None
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            body = message.get("body", b"")
+            content_type = headers.get("content-type", "")
+            compressible = (
+                start["status"] not in (204, 206, 304)
+                and "content-encoding" not in headers
+                and "content-range" not in headers
+                and content_type.startswith(COMPRESSIBLE_TYPES)
+            )
+            if compressible:
+                _add_vary(headers, "Accept-Encoding")
+            if compressible and not message.get("more_body", False) and len(body) >= self.minimum_size:
+                body = COMPRESSORS[encoding](body)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+                message = {**message, "body": body}
+            await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+_wants_msgpack = contextvars.ContextVar("wants_msgpack", default=False)
+
+class NegotiatedResponse(JSONResponse):
+    """JSON, or MessagePack when the route's request asked for it"""
+
+    def render(self, content) -> bytes:
+        if _wants_msgpack.get():
+            self.media_type = MSGPACK_MEDIA_TYPES[0]
+            return msgpack.packb(content, use_bin_type=True)
+        return super().render(content)
+
+    def init_headers(self, headers=None):
+        super().init_headers(headers)
+        if msgpack is not None:
+            _add_vary(self.headers, "Accept")
+
+class NegotiatedRoute(APIRoute):
+    """Route whose NegotiatedResponse follows the request's Accept header"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def negotiated_handler(request):
+            token = _wants_msgpack.set(prefers_msgpack(request.headers.get("accept", "")))
+            try:
+                return await handler(request)
+            finally:
+                _wants_msgpack.reset(token)
+
+        return negotiated_handler
@@ -0,0 +1,204 @@
+"""Sharded counters maintained on write
+
+Totals the read paths would otherwise recount with ``count_documents`` are
+kept in the ``stat_counters`` collection as they change:
+
+* ``scores``: scores in the hot table (``end_game`` adds, archiving removes)
+* ``players``: registered players
+* ``games:<YYYY-MM-DD>``: games completed that day (UTC)
+* ``unlocks:<achievement id>``: players holding that achievement
+
+Each counter is split over ``COUNTER_SHARDS`` documents,
+``{_id: "<name>#<shard>", name, value}``, and every increment ``$inc``s
+one shard chosen at random, so concurrent games do not all queue on one
+hot document. A counter's value is the sum of its shards.
+
+Every worker holds the sums in memory. Its own increments apply at once,
+and ``refresh`` reloads them every ``COUNTER_REFRESH_INTERVAL`` seconds,
+so other workers' writes show up within that interval.
+
+``reconcile`` recounts from the source collections every
+``COUNTER_RECONCILE_INTERVAL`` seconds and folds any drift (from a crash
+between a write and its increment, or a double-ended game) into shard 0.
+The counts and the counter totals are not read at the same instant, so
+writes in flight show up as drift too. Drift is therefore only corrected
+once two consecutive runs agree on its direction, and then by the smaller
+of the two amounts. Real drift persists between runs; in-flight writes
+have landed by the next one. A lease stops two workers from correcting
+the same drift twice. A counter with no shard documents yet (a new
+deployment, or one upgraded with existing data) is seeded with its exact
+count on the first run, which the loop makes at startup. Day
+counters are only reconciled for the last ``COUNTER_RECONCILE_DAYS``
+days; older days keep their count after the scores are archived.
+"""
+import asyncio
+import logging
+import os
+import random
+from datetime import date, datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+COUNTER_SHARDS = int(os.environ.get("COUNTER_SHARDS", "8"))
+COUNTER_REFRESH_INTERVAL = float(os.environ.get("COUNTER_REFRESH_INTERVAL", "1"))
+COUNTER_RECONCILE_INTERVAL = float(os.environ.get("COUNTER_RECONCILE_INTERVAL", "3600"))
+COUNTER_RECONCILE_DAYS = int(os.environ.get("COUNTER_RECONCILE_DAYS", "7"))
+RECONCILE_LEASE_ID = "reconcile"
+RECONCILE_DRIFT_ID = "reconcile_drift"
+
+SCORES_COUNTER = "scores"
+PLAYERS_COUNTER = "players"
+
+def games_counter(day: date) -> str:
+    return f"games:{day.isoformat()[:10]}"
+
+def unlocks_counter(achievement_id: str) -> str:
+    return f"unlocks:{achievement_id}"
+
+class ShardedCounters:
+    """Worker-local sums of the sharded counters in a collection"""
+
+    def __init__(self, collection, shards: int = COUNTER_SHARDS):
+        self.collection = collection
+        self.shards = shards
+        self.values = {}
+        self.loaded = False
+
+    def get(self, name: str) -> int:
+        return self.values.get(name, 0)
+
+    def _increment(self, name: str, amount: int, shard: int = None) -> UpdateOne:
+        shard = random.randrange(self.shards) if shard is None else shard
+        return UpdateOne(
+            {"_id": f"{name}#{shard}"},
+            {"$inc": {"value": amount}, "$set": {"name": name}},
+            upsert=True
+        )
+
+    async def incr(self, name: str, amount: int = 1):
+        await self.incr_many({name: amount})
+
+    async def incr_many(self, amounts: dict, shard: int = None):
+        """Apply several increments with one bulk write"""
+        amounts = {name: amount for name, amount in amounts.items() if amount}
+        if not amounts:
+            return
+        await self.collection.bulk_write(
+            [self._increment(name, amount, shard) for name, amount in amounts.items()], ordered=False
+        )
+        for name, amount in amounts.items():
+            self.values[name] = self.values.get(name, 0) + amount
+
+    async def totals(self) -> dict:
+        return {
+            doc["_id"]: doc["value"]
+            async for doc in self.collection.aggregate([
+                {"$match": {"name": {"$exists": True}}},
+                {"$group": {"_id": "$name", "value": {"$sum": "$value"}}},
+            ])
+        }
+
+    async def refresh(self):
+        self.values = await self.totals()
+        self.loaded = True
+
+    async def _acquire_lease(self, seconds: float) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.collection.update_one(
+                {"_id": RECONCILE_LEASE_ID, "until": {"$lt": now}},
+                {"$set": {"until": now + timedelta(seconds=seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False  # Held by another worker
+        return True
+
+    async def reconcile(self, scores_collection, players_collection, player_achievements_collection,
+                        days: int = COUNTER_RECONCILE_DAYS, lease: float = COUNTER_RECONCILE_INTERVAL):
+        """Correct the drift seen on this run and the last; None if another worker holds the lease
+
+        Counters with no shard documents are seeded at once. Returns
+        {counter: correction applied}.
+        """
+        if not await self._acquire_lease(lease):
+            return None
+
+        since = datetime.combine(datetime.utcnow().date() - timedelta(days=days - 1), datetime.min.time())
+        actual = {
+            SCORES_COUNTER: await scores_collection.count_documents({}),
+            PLAYERS_COUNTER: await players_collection.count_documents({}),
+        }
+        async for doc in player_achievements_collection.aggregate([
+            {"$group": {"_id": "$achievement_id", "count": {"$sum": 1}}}
+        ]):
+            actual[unlocks_counter(doc["_id"])] = doc["count"]
+        async for doc in scores_collection.aggregate([
+            {"$match": {"created_at": {"$gte": since}}},
+            {"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                "count": {"$sum": 1},
+            }},
+        ]):
+            actual[f"games:{doc['_id']}"] = doc["count"]
+
+        current = await self.totals()
+        recent_days = {games_counter(since + timedelta(days=n)) for n in range(days)}
+        reconciled = [
+            name for name in current
+            if not name.startswith("games:") or name in recent_days
+        ]
+        drift = {
+            name: actual.get(name, 0) - current.get(name, 0)
+            for name in {*actual, *reconciled}
+        }
+        drift = {name: delta for name, delta in drift.items() if delta}
+        # Counters that were never written start from the exact count
+        seeds = {name: delta for name, delta in drift.items() if name not in current}
+
+        previous = await self.collection.find_one({"_id": RECONCILE_DRIFT_ID}) or {}
+        previous = dict(previous.get("drift", []))
+        corrections = {
+            name: min(delta, previous[name], key=abs)
+            for name, delta in drift.items()
+            if (delta > 0) == (previous.get(name, 0) > 0) and previous.get(name)
+        }
+        corrections.update(seeds)
+        # Stored as pairs: counter names may contain dots
+        remaining = [[name, delta - corrections.get(name, 0)] for name, delta in drift.items()]
+        await self.collection.replace_one(
+            {"_id": RECONCILE_DRIFT_ID},
+            {"drift": [pair for pair in remaining if pair[1]]},
+            upsert=True
+        )
+
+        self.values = current
+        await self.incr_many(corrections, shard=0)
+        if corrections:
+            logger.info("Reconciled counters: %s", corrections)
+        return corrections
+
+async def counter_refresh_loop(counters: ShardedCounters, interval: float = COUNTER_REFRESH_INTERVAL):
+    """Keep this worker's counter totals current"""
+    while True:
+        try:
+            await counters.refresh()
+        except Exception:
+            logger.exception("Counter refresh failed")
+        await asyncio.sleep(interval)
+
+async def counter_reconcile_loop(counters: ShardedCounters, scores_collection, players_collection,
+                                 player_achievements_collection,
+                                 interval: float = COUNTER_RECONCILE_INTERVAL):
+    """Reconcile the counters at startup and then every interval (one worker at a time)"""
+    while True:
+        try:
+            await counters.reconcile(
+                scores_collection, players_collection, player_achievements_collection, lease=interval / 2
+            )
+        except Exception:
+            logger.exception("Counter reconciliation failed")
+        await asyncio.sleep(interval)
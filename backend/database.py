@@ -1,31 +1,289 @@
+import logging
 import os
+import time
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from pathlib import Path
 
+from score_sketch import score_sketch
+from archive import archived_scores
+from player_cache import player_cache, MISSING
+from ids import decode_id, id_codec, match_id
+from read_routing import routed
+from job_queue import init_job_indexes
+from idempotency import init_idempotency_indexes
+from counters import ShardedCounters, PLAYERS_COUNTER, unlocks_counter
+from models import (
+    PLAYER_PROJECTION, PLAYER_ID_PROJECTION, PLAYER_STATS_PROJECTION, GAME_SESSION_PROJECTION,
+    LEADERBOARD_ENTRY_PROJECTION,
+    ACHIEVEMENT_PROJECTION, PLAYER_ACHIEVEMENT_PROJECTION
+)
+
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# Database connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Database connection: a MongoDB deployment, or the embedded in-process store
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+if STORAGE_BACKEND == 'memory':
+    from embedded_storage import EmbeddedClient
+    client = EmbeddedClient()
+elif STORAGE_BACKEND == 'mongo':
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+else:
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r} (expected mongo or memory)")
 db = client[os.environ['DB_NAME']]
 
 # Collections
-players_collection = db.players
-game_sessions_collection = db.game_sessions
-scores_collection = db.scores
+players_collection = id_codec(db.players)
+game_sessions_collection = id_codec(db.game_sessions)
+scores_collection = id_codec(db.scores)
 achievements_collection = db.achievements
-player_achievements_collection = db.player_achievements
+player_achievements_collection = id_codec(db.player_achievements)
+score_sketches_collection = db.score_sketches
+game_sessions_archive_collection = db.game_sessions_archive
+scores_archive_collection = db.scores_archive
+score_archive_stats_collection = db.score_archive_stats
+achievement_backfills_collection = db.achievement_backfills
+game_events_collection = db.game_events
+event_snapshots_collection = db.event_snapshots
+counters_collection = db.counters
+projection_checkpoints_collection = db.projection_checkpoints
+jobs_collection = db.jobs
+idempotency_keys_collection = db.idempotency_keys
+groups_collection = db.groups
+replays_collection = id_codec(db.replays)
+stat_counters_collection = db.stat_counters
+
+# Maintained totals (see counters.py)
+stat_counters = ShardedCounters(stat_counters_collection)
+
+# Reads that tolerate bounded staleness (see read_routing.py); everything
+# else, including read-your-writes paths, uses the primary handles above
+leaderboard_scores_collection = routed(scores_collection, "leaderboard")
+leaderboard_players_collection = routed(players_collection, "leaderboard")
+catalog_achievements_collection = routed(achievements_collection, "catalog")
+stats_players_collection = routed(players_collection, "stats")
+stats_scores_collection = routed(scores_collection, "stats")
+
+MAX_BULK_PLAYER_IDS = int(os.environ.get("MAX_BULK_PLAYER_IDS", "200"))
+MAX_PLAYER_SYNC_PAGE = int(os.environ.get("MAX_PLAYER_SYNC_PAGE", "1000"))
+# updated_at is stamped before the write commits, so a caught-up sync
+# position is rewound this far to pick up writes that committed late
+PLAYER_SYNC_OVERLAP = float(os.environ.get("PLAYER_SYNC_OVERLAP", "30"))
+
+# Ranks inside the top N are always counted exactly
+EXACT_RANK_TOP_N = int(os.environ.get("EXACT_RANK_TOP_N", "1000"))
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "300"))
+
+# Player aggregate that measures progress for each requirement type
+PROGRESS_FIELDS = {
+    "enemies_destroyed": "total_enemies_destroyed",
+    "asteroids_destroyed": "total_asteroids_destroyed",
+    "powerups_collected": "total_powerups_collected",
+    "score": "best_score",
+    "wave": "best_wave",
+    "game_duration": "longest_game",
+}
+
+_catalog_cache = {"items": None, "expires_at": 0.0}
+
+# {index: error} for indexes the last init_indexes could not build
+index_failures = {}
+
+# The command that clears what stops an index from building
+INDEX_FIXES = {
+    "players.username": "python manage.py dedupe-usernames",
+    "player_achievements.player_id_achievement_id": "python manage.py dedupe-achievements",
+}
+
+async def _build_index(name: str, create):
+    """Await one index build, logging a failure instead of raising it
+
+    Every index is attempted, so one that cannot be built (a unique index
+    over duplicates) does not leave the rest missing.
+    """
+    try:
+        await create
+    except PyMongoError as e:
+        index_failures[name] = str(e)
+        fix = f"; fix with `{INDEX_FIXES[name]}`" if name in INDEX_FIXES else ""
+        logger.error("Index %s was not built: %s%s", name, e, fix)
+    else:
+        index_failures.pop(name, None)
+
+async def init_indexes():
+    """Create the indexes the read paths rely on; returns index_failures
+
+    Most of these are laid out so the hot queries can be answered from the
+    index alone (e.g. rank counting only touches the ``score`` index).
+    """
+    await _build_index("players.id", players_collection.create_index([("id", ASCENDING)], unique=True))
+    await _build_index(
+        "players.username", players_collection.create_index([("username", ASCENDING)], unique=True)
+    )
+    await _build_index("players.id_best_score_total_games", players_collection.create_index(
+        [("id", ASCENDING), ("best_score", DESCENDING), ("total_games", ASCENDING)]
+    ))
+    await _build_index(
+        "players.updated_at_id",
+        players_collection.create_index([("updated_at", ASCENDING), ("id", ASCENDING)])
+    )
+    await _build_index(
+        "game_sessions.id", game_sessions_collection.create_index([("id", ASCENDING)], unique=True)
+    )
+    await _build_index("game_sessions.player_id_status_start_time", game_sessions_collection.create_index(
+        [("player_id", ASCENDING), ("status", ASCENDING), ("start_time", DESCENDING)]
+    ))
+    await _build_index(
+        "game_sessions.status_start_time",
+        game_sessions_collection.create_index([("status", ASCENDING), ("start_time", ASCENDING)])
+    )
+    await _build_index("scores.score", scores_collection.create_index([("score", DESCENDING)]))
+    await _build_index(
+        "scores.player_id_score",
+        scores_collection.create_index([("player_id", ASCENDING), ("score", DESCENDING)])
+    )
+    await _build_index("scores.created_at", scores_collection.create_index([("created_at", ASCENDING)]))
+    await _build_index(
+        "achievements.id", achievements_collection.create_index([("id", ASCENDING)], unique=True)
+    )
+    await _build_index("player_achievements.player_id_achievement_id", player_achievements_collection.create_index(
+        [("player_id", ASCENDING), ("achievement_id", ASCENDING)], unique=True
+    ))
+    await _build_index("game_events.g", game_events_collection.create_index([("g", ASCENDING)], unique=True))
+    await _build_index("groups.id", groups_collection.create_index([("id", ASCENDING)], unique=True))
+    await _build_index("groups.members", groups_collection.create_index([("members", ASCENDING)]))
+    await _build_index(
+        "replays.game_session_id",
+        replays_collection.create_index([("game_session_id", ASCENDING)], unique=True)
+    )
+    await _build_index(
+        "replays.score_created_at",
+        replays_collection.create_index([("score", DESCENDING), ("created_at", ASCENDING)])
+    )
+    await _build_index("jobs", init_job_indexes(jobs_collection))
+    await _build_index("idempotency_keys", init_idempotency_indexes(idempotency_keys_collection))
+    await _build_index("event_snapshots.seq_kind_n", event_snapshots_collection.create_index(
+        [("seq", DESCENDING), ("kind", ASCENDING), ("n", ASCENDING)]
+    ))
+    return index_failures
+
+# Sync position of players written before updated_at existed, until the
+# startup backfill stamps them
+LEGACY_UPDATED_AT = datetime(1970, 1, 1)
+
+async def backfill_player_updated_at() -> int:
+    """Stamp players written before updated_at existed, so they join the sync feed
+
+    Runs at startup (a no-op once every player is stamped). Returns how
+    many players were stamped.
+    """
+    result = await players_collection.update_many(
+        {"updated_at": {"$exists": False}}, {"$set": {"updated_at": datetime.utcnow()}}
+    )
+    return result.modified_count
+
+async def backfill_longest_game(batch_size: int = 1000) -> int:
+    """Fill longest_game for players written before it was tracked
+
+    Takes the longest game among each player's hot scores; archived scores
+    are not read, so it can fall short for players whose longest games were
+    archived. Runs at startup (a no-op once every player has it). Returns
+    how many players were filled.
+    """
+    filled = 0
+    while True:
+        players = await players_collection.find(
+            {"longest_game": {"$exists": False}, "total_games": {"$gt": 0}},
+            {"_id": 0, "id": 1, "username": 1}
+        ).limit(batch_size).to_list(length=batch_size)
+        if not players:
+            return filled
+        longest = {player["id"]: 0 for player in players}
+        async for doc in scores_collection.aggregate([
+            {"$match": {"player_id": {"$in": list(longest)}}},
+            {"$group": {"_id": "$player_id", "longest_game": {"$max": "$game_duration"}}},
+        ]):
+            longest[decode_id(doc["_id"])] = doc["longest_game"] or 0
+        now = datetime.utcnow()
+        # $max: a game ending meanwhile may already have set a longer one
+        result = await players_collection.bulk_write([
+            UpdateOne(
+                {"id": match_id(player_id)},
+                {"$max": {"longest_game": duration}, "$set": {"updated_at": now}}
+            )
+            for player_id, duration in longest.items()
+        ], ordered=False)
+        filled += result.modified_count
+        for player in players:
+            player_cache.invalidate(player["id"], player["username"])
+
+async def dedupe_usernames() -> int:
+    """Rename all but the oldest player holding each duplicated username
+
+    The unique username index cannot be built while duplicates exist. The
+    renamed players keep their id and history; their username gets the
+    start of their id appended. Returns how many players were renamed.
+    """
+    renamed = 0
+    duplicated = players_collection.aggregate([
+        {"$group": {"_id": "$username", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    async for group in duplicated:
+        username = group["_id"]
+        holders = await players_collection.find(
+            {"username": username}, PLAYER_ID_PROJECTION
+        ).sort([("created_at", ASCENDING), ("id", ASCENDING)]).to_list(length=None)
+        for player in holders[1:]:
+            new_username = f"{username}_{player['id'][:8]}"
+            await players_collection.update_one(
+                {"id": player["id"]}, {"$set": {"username": new_username, "updated_at": datetime.utcnow()}}
+            )
+            for collection in (scores_collection, game_sessions_collection, replays_collection):
+                await collection.update_many(
+                    {"player_id": player["id"]}, {"$set": {"player_username": new_username}}
+                )
+            player_cache.invalidate(player["id"], username)
+            renamed += 1
+    return renamed
+
+async def dedupe_player_achievements() -> int:
+    """Delete repeated unlocks of an achievement by one player, keeping the earliest
+
+    The unique (player_id, achievement_id) index cannot be built while
+    duplicates exist. The unlock counters are decremented to match. Returns
+    how many unlocks were deleted.
+    """
+    removed = {}
+    duplicated = player_achievements_collection.aggregate([
+        {"$sort": {"unlocked_at": ASCENDING, "_id": ASCENDING}},
+        {"$group": {
+            "_id": {"player_id": "$player_id", "achievement_id": "$achievement_id"},
+            "unlocks": {"$push": "$_id"},
+            "count": {"$sum": 1},
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+    async for group in duplicated:
+        result = await player_achievements_collection.delete_many({"_id": {"$in": group["unlocks"][1:]}})
+        name = unlocks_counter(group["_id"]["achievement_id"])
+        removed[name] = removed.get(name, 0) - result.deleted_count
+    await stat_counters.incr_many(removed)
+    return -sum(removed.values())
 
 async def init_achievements():
     """Initialize default achievements in the database"""
     
     # Check if achievements already exist
-    existing_count = await achievements_collection.count_documents({})
-    if existing_count > 0:
+    existing = await achievements_collection.find_one({}, {"_id": 1})
+    if existing:
         return
     
     default_achievements = [
@@ -152,34 +410,241 @@ async def init_achievements():
     ]
     
     await achievements_collection.insert_many(default_achievements)
+    invalidate_achievement_catalog()
     print("✅ Default achievements initialized")
 
+async def get_achievement_catalog():
+    """Get all achievement definitions (cached in process, treat as read-only)
+
+    An empty catalog is never cached: a secondary that has not replicated
+    init_achievements yet returns none, so the primary is asked instead.
+    """
+    now = time.monotonic()
+    if _catalog_cache["items"] is None or _catalog_cache["expires_at"] < now:
+        items = await catalog_achievements_collection.find({}, ACHIEVEMENT_PROJECTION).to_list(length=None)
+        if not items:
+            items = await achievements_collection.find({}, ACHIEVEMENT_PROJECTION).to_list(length=None)
+            if not items:
+                return items
+        _catalog_cache["items"] = items
+        _catalog_cache["expires_at"] = now + CATALOG_CACHE_TTL
+    return _catalog_cache["items"]
+
+def invalidate_achievement_catalog():
+    """Drop the cached catalog after achievement definitions change"""
+    _catalog_cache["items"] = None
+
+def achievement_unlock_percent(achievement_id: str):
+    """Share of players holding an achievement, from the maintained counters"""
+    players = stat_counters.get(PLAYERS_COUNTER)
+    if players <= 0:
+        return None
+    unlocks = stat_counters.get(unlocks_counter(achievement_id))
+    return round(min(100.0 * unlocks / players, 100.0), 2)
+
+def achievement_progress(achievement: dict, player: dict, unlocked: bool):
+    """Progress towards an achievement from the player's aggregate counters"""
+    if unlocked:
+        return achievement["requirement_value"]
+    field = PROGRESS_FIELDS.get(achievement["requirement_type"])
+    if field is None:
+        return None  # Per-game conditions (score_time, no_damage) have no running total
+    return min(player.get(field, 0) or 0, achievement["requirement_value"])
+
 async def get_player_by_username(username: str):
     """Get player by username"""
-    return await players_collection.find_one({"username": username})
+    cached = player_cache.by_username(username)
+    if cached is not None:
+        return None if cached is MISSING else cached
+    
+    player = await players_collection.find_one({"username": username}, PLAYER_PROJECTION)
+    if player:
+        player_cache.put(player)
+    else:
+        player_cache.put_missing_username(username)
+    return player
+
+async def get_player_by_id(player_id: str):
+    """Get player by id"""
+    cached = player_cache.by_id(player_id)
+    if cached is not None:
+        return None if cached is MISSING else cached
+    
+    player = await players_collection.find_one({"id": player_id}, PLAYER_PROJECTION)
+    if player:
+        player_cache.put(player)
+    else:
+        player_cache.put_missing_id(player_id)
+    return player
+
+async def get_or_create_player(username: str, new_player: dict):
+    """Get the player with this username, creating it atomically if missing
+
+    Warm players are served from the cache; otherwise a single upsert on the
+    unique username index both looks up and creates, so concurrent logins
+    with the same name can never create two players.
+    """
+    cached = player_cache.by_username(username)
+    if cached is not None and cached is not MISSING:
+        return cached
+    
+    insert_fields = {k: v for k, v in new_player.items() if k != "username"}
+    for attempt in range(2):
+        try:
+            player = await players_collection.find_one_and_update(
+                {"username": username},
+                {"$setOnInsert": insert_fields},
+                projection=PLAYER_PROJECTION,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            break
+        except DuplicateKeyError:
+            # A concurrent upsert won the race; retrying finds its document
+            if attempt:
+                raise
+    
+    if player["id"] == insert_fields.get("id"):
+        await stat_counters.incr(PLAYERS_COUNTER)  # This call inserted it
+    player_cache.put(player)
+    return player
 
 async def create_player(player_data: dict):
     """Create a new player"""
     result = await players_collection.insert_one(player_data)
-    return await players_collection.find_one({"_id": result.inserted_id})
+    await stat_counters.incr(PLAYERS_COUNTER)
+    return await players_collection.find_one({"_id": result.inserted_id}, PLAYER_PROJECTION)
+
+async def get_players_by_ids(player_ids: list):
+    """Get several players at once, in the order asked for
+
+    Cached players are served from memory and the rest are fetched with a
+    single ``$in`` query. Unknown ids are left out.
+    """
+    found = {}
+    missing = []
+    for player_id in dict.fromkeys(player_ids):
+        cached = player_cache.by_id(player_id)
+        if cached is None:
+            missing.append(player_id)
+        elif cached is not MISSING:
+            found[player_id] = cached
+    
+    if missing:
+        async for player in players_collection.find({"id": {"$in": missing}}, PLAYER_PROJECTION):
+            player_cache.put(player)
+            found[player["id"]] = player
+    
+    return [found[player_id] for player_id in player_ids if player_id in found]
+
+async def get_players_updated_since(updated_since: datetime = None, after_id: str = None,
+                                    limit: int = MAX_PLAYER_SYNC_PAGE):
+    """Players changed after a (updated_at, id) position, oldest change first
+
+    Fetches one extra document to tell whether another page follows.
+    Returns (players, has_more, next position as (updated_at, id)). Once
+    caught up, the next position is rewound ``PLAYER_SYNC_OVERLAP`` seconds,
+    so the following call repeats recent changes instead of missing late
+    commits; while paging it stays exact so paging always advances.
+    """
+    query = {}
+    if updated_since is not None:
+        if after_id is not None:
+            # Players not yet stamped sort first, at the LEGACY_UPDATED_AT position
+            same_time = None if updated_since == LEGACY_UPDATED_AT else updated_since
+            query["$or"] = [
+                {"updated_at": {"$gt": updated_since}},
+                {"updated_at": same_time, "id": {"$gt": after_id}},
+            ]
+        else:
+            query["updated_at"] = {"$gt": updated_since}
+    
+    players = await players_collection.find(query, PLAYER_PROJECTION).sort(
+        [("updated_at", ASCENDING), ("id", ASCENDING)]
+    ).limit(limit + 1).to_list(length=limit + 1)
+    has_more = len(players) > limit
+    players = players[:limit]
+
+    if players:
+        position = (players[-1].get("updated_at") or LEGACY_UPDATED_AT, players[-1]["id"])
+    else:
+        position = (updated_since, after_id)
+    settled = datetime.utcnow() - timedelta(seconds=PLAYER_SYNC_OVERLAP)
+    if not has_more and position[0] is not None and position[0] > settled:
+        position = (settled, None)
+    return players, has_more, position
 
 async def update_player(player_id: str, update_data: dict):
     """Update player data"""
-    await players_collection.update_one(
+    player = await players_collection.find_one_and_update(
         {"id": player_id},
-        {"$set": update_data}
+        {"$set": {**update_data, "updated_at": datetime.utcnow()}},
+        projection=PLAYER_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if player:
+        player_cache.put(player)
+    return player
+
+# Applied game ids kept on each player, so replayed games are not counted twice
+PROJECTED_GAMES_KEPT = 50
+
+def player_games_update(games: list) -> dict:
+    """Atomic $inc/$max update adding completed games to a player's aggregates
+
+    Filter on ``projected_games: {"$ne": game id}`` (one game per update) to
+    make it idempotent.
+    """
+    return {
+        "$inc": {
+            "total_games": len(games),
+            "total_score": sum(game.get("final_score", 0) for game in games),
+            "total_playtime": sum(game.get("game_duration", 0) for game in games),
+            "total_enemies_destroyed": sum(game.get("enemies_destroyed", 0) for game in games),
+            "total_asteroids_destroyed": sum(game.get("asteroids_destroyed", 0) for game in games),
+            "total_powerups_collected": sum(game.get("powerups_collected", 0) for game in games),
+        },
+        "$max": {
+            "best_score": max(game.get("final_score", 0) for game in games),
+            "best_wave": max(game.get("max_wave", 1) for game in games),
+            "longest_game": max(game.get("game_duration", 0) for game in games),
+            # Updates for one player may apply in any order
+            "last_played": max(game.get("end_time") or datetime.utcnow() for game in games),
+        },
+        "$set": {
+            "updated_at": datetime.utcnow(),
+        },
+        "$push": {
+            "projected_games": {"$each": [game["id"] for game in games], "$slice": -PROJECTED_GAMES_KEPT},
+        },
+    }
+
+async def record_player_game(player_id: str, game: dict):
+    """Add one completed game to the player's aggregates
+
+    Returns the player document from before the update, or None if the
+    player is unknown or the game was already applied.
+    """
+    player = await players_collection.find_one_and_update(
+        {"id": player_id, "projected_games": {"$ne": game["id"]}},
+        player_games_update([game]),
+        projection=PLAYER_STATS_PROJECTION,
+        return_document=ReturnDocument.BEFORE
     )
-    return await players_collection.find_one({"id": player_id})
+    if player:
+        player_cache.invalidate(player_id, player["username"])
+    return player
 
 async def get_leaderboard(limit: int = 10, skip: int = 0):
     """Get leaderboard with top scores"""
     pipeline = [
         {"$sort": {"score": -1}},
         {"$skip": skip},
-        {"$limit": limit}
+        {"$limit": limit},
+        {"$project": LEADERBOARD_ENTRY_PROJECTION}
     ]
     
-    scores = await scores_collection.aggregate(pipeline).to_list(length=limit)
+    scores = await leaderboard_scores_collection.aggregate(pipeline).to_list(length=limit)
     
     # Add rank to each entry
     for idx, score in enumerate(scores):
@@ -187,35 +652,67 @@ async def get_leaderboard(limit: int = 10, skip: int = 0):
     
     return scores
 
-async def get_player_rank(player_id: str):
-    """Get player's rank on leaderboard"""
-    player_best = await scores_collection.find_one(
-        {"player_id": player_id}, 
-        sort=[("score", -1)]
+async def get_player_best_score(player_id: str, consistent: bool = False):
+    """Get player's best score
+
+    Read from the player document (covered by the id/best_score index) so it
+    stays correct after old scores have been archived. ``consistent`` reads
+    from the primary, for callers that just wrote the score.
+    """
+    collection = players_collection if consistent else leaderboard_players_collection
+    player = await collection.find_one(
+        {"id": player_id},
+        {"_id": 0, "best_score": 1, "total_games": 1}
     )
+    if not player or not player.get("total_games"):
+        return None
+    return player.get("best_score", 0)
+
+async def get_player_rank(player_id: str, best_score: int = None, approximate: bool = False,
+                          consistent: bool = False):
+    """Get player's rank on leaderboard
+
+    With ``approximate`` the count stops at ``EXACT_RANK_TOP_N``; players
+    further down get a rank estimated from the score sketch instead.
+    ``consistent`` counts on the primary so the caller's own score is seen.
+    """
+    if best_score is None:
+        best_score = await get_player_best_score(player_id, consistent)
+    scores = scores_collection if consistent else leaderboard_scores_collection
     
-    if not player_best:
+    if best_score is None:
         return None
     
-    # Count how many scores are higher
-    higher_scores = await scores_collection.count_documents(
-        {"score": {"$gt": player_best["score"]}}
+    # Count how many scores are higher (covered by the score index)
+    if approximate:
+        higher_scores = await scores.count_documents(
+            {"score": {"$gt": best_score}},
+            limit=EXACT_RANK_TOP_N
+        )
+        if higher_scores >= EXACT_RANK_TOP_N and score_sketch.loaded:
+            return max(score_sketch.rank(best_score), EXACT_RANK_TOP_N + 1)
+        return higher_scores + archived_scores.count_above(best_score) + 1
+    
+    higher_scores = await scores.count_documents(
+        {"score": {"$gt": best_score}}
     )
     
-    return higher_scores + 1
+    # Archived scores are all below the retained top-N, so this is 0 near the top
+    return higher_scores + archived_scores.count_above(best_score) + 1
 
 async def check_achievements(player_id: str, game_session: dict):
     """Check if player has unlocked any achievements"""
-    player = await players_collection.find_one({"id": player_id})
+    player = await players_collection.find_one({"id": player_id}, PLAYER_STATS_PROJECTION)
     if not player:
         return []
     
     # Get all achievements
-    achievements = await achievements_collection.find({}).to_list(length=None)
+    achievements = await get_achievement_catalog()
     
     # Get already unlocked achievements
     unlocked = await player_achievements_collection.find(
-        {"player_id": player_id}
+        {"player_id": player_id},
+        PLAYER_ACHIEVEMENT_PROJECTION
     ).to_list(length=None)
     
     unlocked_ids = [ua["achievement_id"] for ua in unlocked]
@@ -262,19 +759,41 @@ async def check_achievements(player_id: str, game_session: dict):
                 "game_session_id": game_session.get("id")
             }
             
-            await player_achievements_collection.insert_one(achievement_data)
+            try:
+                await player_achievements_collection.insert_one(achievement_data)
+            except DuplicateKeyError:
+                continue  # Already granted, e.g. by a concurrent backfill
+            await stat_counters.incr(unlocks_counter(achievement["id"]))
             new_achievements.append(achievement)
     
     return new_achievements
 
-async def get_player_achievements(player_id: str):
-    """Get all achievements for a player with status"""
+async def get_game_achievements(player_id: str, game_session_id: str):
+    """Achievements the player unlocked in one game"""
+    unlocked = await player_achievements_collection.find(
+        {"player_id": player_id, "game_session_id": game_session_id},
+        PLAYER_ACHIEVEMENT_PROJECTION
+    ).to_list(length=None)
+    unlocked_ids = {ua["achievement_id"] for ua in unlocked}
+    if not unlocked_ids:
+        return []
+    return [a for a in await get_achievement_catalog() if a["id"] in unlocked_ids]
+
+async def get_player_achievements(player_id: str, player: dict = None):
+    """Get all achievements for a player with status and progress
+
+    Pass ``player`` when the caller already holds the player document.
+    """
+    if player is None:
+        player = await players_collection.find_one({"id": player_id}, PLAYER_STATS_PROJECTION) or {}
+    
     # Get all achievements
-    achievements = await achievements_collection.find({}).to_list(length=None)
+    achievements = await get_achievement_catalog()
     
     # Get player's unlocked achievements
     unlocked = await player_achievements_collection.find(
-        {"player_id": player_id}
+        {"player_id": player_id},
+        PLAYER_ACHIEVEMENT_PROJECTION
     ).to_list(length=None)
     
     unlocked_dict = {ua["achievement_id"]: ua for ua in unlocked}
@@ -285,25 +804,33 @@ async def get_player_achievements(player_id: str):
         achievement_data = {
             **achievement,
             "unlocked": is_unlocked,
-            "unlocked_at": unlocked_dict.get(achievement["id"], {}).get("unlocked_at") if is_unlocked else None
+            "unlocked_at": unlocked_dict.get(achievement["id"], {}).get("unlocked_at") if is_unlocked else None,
+            "progress": achievement_progress(achievement, player, is_unlocked),
+            "unlock_percent": achievement_unlock_percent(achievement["id"])
         }
         result.append(achievement_data)
     
     return result
 
-async def get_game_stats(player_id: str):
-    """Get comprehensive game statistics for a player"""
-    player = await players_collection.find_one({"id": player_id})
+async def get_game_stats(player_id: str, player: dict = None):
+    """Get comprehensive game statistics for a player
+
+    Pass ``player`` (read with PLAYER_STATS_PROJECTION) when the caller
+    already holds it.
+    """
+    if player is None:
+        player = await players_collection.find_one({"id": player_id}, PLAYER_STATS_PROJECTION)
     if not player:
         return None
     
     # Get recent games
     recent_games = await game_sessions_collection.find(
-        {"player_id": player_id, "status": "completed"}
+        {"player_id": player_id, "status": "completed"},
+        GAME_SESSION_PROJECTION
     ).sort("start_time", -1).limit(5).to_list(length=5)
     
     # Get achievements
-    achievements = await get_player_achievements(player_id)
+    achievements = await get_player_achievements(player_id, player)
     unlocked_count = len([a for a in achievements if a["unlocked"]])
     
     # Calculate stats
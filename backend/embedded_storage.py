@@ -0,0 +1,539 @@
+"""Embedded in-process storage for single-node deployments and tests
+
+With ``STORAGE_BACKEND=memory`` the Motor client in ``database.py`` is
+replaced by an in-process, Motor-compatible one built on ``mongomock``
+(``mongomock-motor``). Every function in ``database.py`` and every module
+holding a collection keeps working unchanged, with no mongod and no network
+round trip per call; ``backend_test.py`` uses it to run in-process.
+
+The wrappers here fill the gaps between mongomock and the server that the
+code relies on:
+
+* ``with_options(codec_options=<RawBSONDocument>)`` returns raw BSON
+  documents, so the bulk readers behave as they do against MongoDB.
+* Read preferences are accepted and ignored: there is a single node.
+* ``find_one_and_update(..., return_document=AFTER)`` returns the updated
+  document even when the update makes it stop matching the filter.
+* ``$max`` and ``$min`` compare in BSON order (null below everything)
+  rather than with Python's ``max``/``min``: they are resolved against the
+  target document and applied as ``$set``.
+* ``watch`` raises ``OperationFailure`` as a standalone mongod does, so
+  ``PROJECTION_MODE=stream`` is not available.
+
+TTL indexes are created but not enforced. Data lives in memory. With
+``EMBEDDED_DATA_DIR`` set, every write appends the documents it changed
+(or deleted) to a journal segment there before it returns, so a crash
+loses nothing that was acknowledged (``EMBEDDED_JOURNAL_FSYNC=1`` also
+survives power loss). Every ``EMBEDDED_SAVE_INTERVAL`` seconds the journal
+moves to a new segment and a background thread folds the sealed segments
+into a new snapshot (one BSON file per collection) from the files alone,
+so the event loop never waits for it. ``CURRENT`` names the snapshot;
+startup loads it and replays the segments written after it. Indexes are
+not persisted: ``init_indexes`` builds them at startup.
+"""
+import asyncio
+import glob
+import logging
+import operator
+import os
+import shutil
+import tempfile
+
+import bson
+import mongomock
+from bson.errors import InvalidBSON
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from mongomock.filtering import bson_compare
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+logger = logging.getLogger(__name__)
+
+EMBEDDED_DATA_DIR = os.environ.get("EMBEDDED_DATA_DIR")
+EMBEDDED_SAVE_INTERVAL = float(os.environ.get("EMBEDDED_SAVE_INTERVAL", "60"))
+EMBEDDED_JOURNAL_FSYNC = os.environ.get("EMBEDDED_JOURNAL_FSYNC", "0") == "1"
+
+_MISSING = object()
+
+def _to_raw(doc, codec_options):
+    if doc is None or codec_options is None:
+        return doc
+    return RawBSONDocument(bson.encode(doc), codec_options)
+
+def _get_path(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _resolve_extremes(update, doc):
+    """Rewrite $max/$min as $set of the fields they change in doc (None when upserting)"""
+    if not isinstance(update, dict) or not ("$max" in update or "$min" in update):
+        return update
+    update = dict(update)
+    sets = dict(update.get("$set", {}))
+    for op, compare in (("$max", operator.gt), ("$min", operator.lt)):
+        for field, value in update.pop(op, {}).items():
+            current = _MISSING if doc is None else _get_path(doc, field)
+            if current is _MISSING or bson_compare(compare, value, current):
+                sets[field] = value
+    if sets:
+        update["$set"] = sets
+    return update
+
+def _write_model(model):
+    """(kind, filter, document, upsert) of a pymongo write model
+
+    pymongo has no public accessors for these, so the slots are read directly.
+    """
+    kinds = {
+        InsertOne: "insert", UpdateOne: "update_one", UpdateMany: "update_many",
+        ReplaceOne: "replace", DeleteOne: "delete_one", DeleteMany: "delete_many",
+    }
+    kind = kinds[type(model)]
+    return (
+        kind,
+        getattr(model, "_filter", None),
+        getattr(model, "_doc", None),
+        getattr(model, "_upsert", False),
+    )
+
+class Journal:
+    """Append-only log of the documents each write changed, in segment files"""
+
+    def __init__(self, data_dir: str, segment: int, fsync: bool = EMBEDDED_JOURNAL_FSYNC):
+        self.data_dir = data_dir
+        self.segment = segment
+        self.fsync = fsync
+        self._file = open(segment_path(data_dir, segment), "ab")
+
+    def append(self, records: list):
+        if not records:
+            return
+        self._file.write(b"".join(bson.encode(record) for record in records))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self) -> int:
+        """Start a new segment; returns the number of the sealed one"""
+        sealed = self.segment
+        self._file.close()
+        self.segment += 1
+        self._file = open(segment_path(self.data_dir, self.segment), "ab")
+        return sealed
+
+    def close(self):
+        self._file.close()
+
+def segment_path(data_dir: str, segment: int) -> str:
+    return os.path.join(data_dir, f"journal-{segment:012d}.bson")
+
+def _segments(data_dir: str) -> list:
+    return sorted(
+        int(os.path.basename(path)[len("journal-"):-len(".bson")])
+        for path in glob.glob(os.path.join(data_dir, "journal-*.bson"))
+    )
+
+def _current_snapshot(data_dir: str) -> tuple:
+    """(snapshot directory, last segment folded into it)
+
+    Before the first snapshot the data directory itself is read, which also
+    loads files saved by the whole-store saves this replaced.
+    """
+    try:
+        with open(os.path.join(data_dir, "CURRENT")) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return data_dir, 0
+    return os.path.join(data_dir, name), int(name[len("snapshot-"):])
+
+def _load_snapshot(sync_client, snapshot_dir: str):
+    for path in glob.glob(os.path.join(snapshot_dir, "*.*.bson")):
+        name = os.path.basename(path)[:-len(".bson")]
+        if name.startswith("journal-"):
+            continue
+        db_name, collection_name = name.split(".", 1)
+        with open(path, "rb") as f:
+            docs = bson.decode_all(f.read())
+        if docs:
+            sync_client[db_name][collection_name].insert_many(docs)
+
+def _replay_segment(sync_client, path: str) -> int:
+    """Apply one journal segment; a record torn by a crash ends it"""
+    applied = 0
+    with open(path, "rb") as f:
+        try:
+            for record in bson.decode_file_iter(f):
+                collection = sync_client[record["d"]][record["c"]]
+                if record["o"] == "put":
+                    collection.replace_one({"_id": record["doc"]["_id"]}, record["doc"], upsert=True)
+                elif record["o"] == "del":
+                    collection.delete_one({"_id": record["id"]})
+                elif record["o"] == "drop":
+                    collection.drop()
+                applied += 1
+        except InvalidBSON:
+            logger.warning("Ignoring a torn record at the end of %s", path)
+    return applied
+
+def compact(data_dir: str, upto: int):
+    """Fold the journal segments up to ``upto`` into a new snapshot, from the files alone"""
+    snapshot_dir, folded = _current_snapshot(data_dir)
+    if upto <= folded:
+        return
+    scratch = mongomock.MongoClient()
+    _load_snapshot(scratch, snapshot_dir)
+    for segment in _segments(data_dir):
+        if folded < segment <= upto:
+            _replay_segment(scratch, segment_path(data_dir, segment))
+
+    name = f"snapshot-{upto}"
+    tmp_dir = tempfile.mkdtemp(dir=data_dir, prefix=".snapshot-")
+    try:
+        for db_name in scratch.list_database_names():
+            database = scratch[db_name]
+            for collection_name in database.list_collection_names():
+                with open(os.path.join(tmp_dir, f"{db_name}.{collection_name}.bson"), "wb") as f:
+                    for doc in database[collection_name].find():
+                        f.write(bson.encode(doc))
+                    f.flush()
+                    os.fsync(f.fileno())
+        final_dir = os.path.join(data_dir, name)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    fd, tmp_current = tempfile.mkstemp(dir=data_dir, prefix=".current-")
+    with os.fdopen(fd, "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_current, os.path.join(data_dir, "CURRENT"))
+
+    # Only now is everything below upto redundant
+    for segment in _segments(data_dir):
+        if segment <= upto:
+            os.unlink(segment_path(data_dir, segment))
+    for path in glob.glob(os.path.join(data_dir, "snapshot-*")):
+        if os.path.basename(path) != name:
+            shutil.rmtree(path, ignore_errors=True)
+    for path in glob.glob(os.path.join(data_dir, "*.*.bson")):
+        if not os.path.basename(path).startswith("journal-"):
+            os.unlink(path)  # Whole-store save files, folded into the first snapshot
+
+class EmbeddedCursor:
+    """Cursor proxy returning raw documents when the collection asked for them"""
+
+    def __init__(self, cursor, codec_options=None):
+        self._cursor = cursor
+        self._codec_options = codec_options
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, *args):
+        self._cursor = self._cursor.skip(*args)
+        return self
+
+    def limit(self, *args):
+        self._cursor = self._cursor.limit(*args)
+        return self
+
+    def batch_size(self, *args):
+        self._cursor = self._cursor.batch_size(*args)
+        return self
+
+    async def to_list(self, length=None):
+        return [_to_raw(doc, self._codec_options) for doc in await self._cursor.to_list(length=length)]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return _to_raw(await self._cursor.__anext__(), self._codec_options)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class EmbeddedCollection:
+    """Motor-style collection over an in-process mongomock collection
+
+    Writes run on the synchronous mongomock collection (mongomock-motor
+    does the same, on the event loop), each one addressed by ``_id`` once
+    its target is known, so the documents it changed can be journaled.
+    """
+
+    def __init__(self, collection, sync_collection, journal=None, codec_options=None):
+        self._collection = collection
+        self._sync = sync_collection
+        self._journal = journal
+        self._codec_options = codec_options  # Set for raw BSON views
+
+    @property
+    def name(self):
+        return self._collection.name
+
+    def with_options(self, codec_options=None, **kwargs):
+        if codec_options is not None and codec_options.document_class is RawBSONDocument:
+            return EmbeddedCollection(self._collection, self._sync, self._journal, codec_options)
+        return EmbeddedCollection(self._collection, self._sync, self._journal, self._codec_options)
+
+    def find(self, *args, **kwargs):
+        return EmbeddedCursor(self._collection.find(*args, **kwargs), self._codec_options)
+
+    async def find_one(self, *args, **kwargs):
+        return _to_raw(await self._collection.find_one(*args, **kwargs), self._codec_options)
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        for option in ("allowDiskUse", "batchSize"):
+            kwargs.pop(option, None)
+        return EmbeddedCursor(self._collection.aggregate(pipeline, *args, **kwargs), self._codec_options)
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure(
+            "Change streams are not available with STORAGE_BACKEND=memory", code=40573
+        )
+
+    # Writes
+
+    def _log(self, ids):
+        """Journal the current state of these documents (deleted ones as deletions)"""
+        if self._journal is None:
+            return
+        ids = [doc_id for doc_id in ids if doc_id is not None]
+        found = {doc["_id"]: doc for doc in self._sync.find({"_id": {"$in": ids}})} if ids else {}
+        database = self._sync.database.name
+        self._journal.append([
+            {"d": database, "c": self._sync.name, "o": "put", "doc": found[doc_id]}
+            if doc_id in found else
+            {"d": database, "c": self._sync.name, "o": "del", "id": doc_id}
+            for doc_id in ids
+        ])
+
+    def _update(self, filter, update, upsert=False, replace=False, sort=None):
+        """Update the first match by _id; returns (matched, modified, upserted_id, target _id)"""
+        target = self._sync.find_one(filter, sort=sort)
+        if target is None:
+            if not upsert:
+                return 0, 0, None, None
+            if replace:
+                result = self._sync.replace_one(filter, update, upsert=True)
+            else:
+                result = self._sync.update_one(filter, _resolve_extremes(update, None), upsert=True)
+            self._log([result.upserted_id])
+            return 0, 0, result.upserted_id, None
+        if replace:
+            result = self._sync.replace_one({"_id": target["_id"]}, update)
+        else:
+            update = _resolve_extremes(update, target)
+            if not update:
+                return 1, 0, None, target["_id"]  # Every $max/$min was already satisfied
+            result = self._sync.update_one({"_id": target["_id"]}, update)
+        self._log([target["_id"]])
+        return result.matched_count, result.modified_count, None, target["_id"]
+
+    def _update_many(self, filter, update, upsert=False):
+        targets = list(self._sync.find(filter))
+        if not targets:
+            return self._update(filter, update, upsert=upsert)
+        matched = modified = 0
+        for target in targets:
+            resolved = _resolve_extremes(update, target)
+            matched += 1
+            if resolved:
+                modified += self._sync.update_one({"_id": target["_id"]}, resolved).modified_count
+        self._log([target["_id"] for target in targets])
+        return matched, modified, None, None
+
+    def _delete(self, filter, many=False, sort=None):
+        if many:
+            ids = [doc["_id"] for doc in self._sync.find(filter, {"_id": 1})]
+        else:
+            target = self._sync.find_one(filter, {"_id": 1}, sort=sort)
+            ids = [target["_id"]] if target else []
+        if not ids:
+            return 0, None
+        deleted = self._sync.delete_many({"_id": {"$in": ids}}).deleted_count
+        self._log(ids)
+        return deleted, ids[0]
+
+    @staticmethod
+    def _update_result(matched, modified, upserted_id):
+        raw = {"n": matched + (upserted_id is not None), "nModified": modified}
+        if upserted_id is not None:
+            raw["upserted"] = upserted_id
+        return UpdateResult(raw, True)
+
+    async def insert_one(self, document, *args, **kwargs):
+        document.setdefault("_id", ObjectId())
+        self._sync.insert_one(document)
+        self._log([document["_id"]])
+        return InsertOneResult(document["_id"], True)
+
+    async def insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        try:
+            return self._sync.insert_many(documents, *args, **kwargs)
+        finally:
+            # Documents already there are journaled unchanged, which is harmless
+            self._log([document["_id"] for document in documents])
+
+    async def update_one(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upserted_id, _ = self._update(filter, update, upsert=upsert)
+        return self._update_result(matched, modified, upserted_id)
+
+    async def update_many(self, filter, update, upsert=False, **kwargs):
+        matched, modified, upserted_id, _ = self._update_many(filter, update, upsert=upsert)
+        return self._update_result(matched, modified, upserted_id)
+
+    async def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        matched, modified, upserted_id, _ = self._update(filter, replacement, upsert=upsert, replace=True)
+        return self._update_result(matched, modified, upserted_id)
+
+    async def delete_one(self, filter, *args, **kwargs):
+        deleted, _ = self._delete(filter)
+        return DeleteResult({"n": deleted}, True)
+
+    async def delete_many(self, filter, *args, **kwargs):
+        deleted, _ = self._delete(filter, many=True)
+        return DeleteResult({"n": deleted}, True)
+
+    async def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, **kwargs):
+        before = self._sync.find_one(filter, projection, sort=sort)
+        _, _, upserted_id, target_id = self._update(filter, update, upsert=upsert, sort=sort)
+        if return_document is not ReturnDocument.AFTER:
+            return before
+        # Located by _id, so the updated document is found even if it no longer matches filter
+        doc_id = target_id if target_id is not None else upserted_id
+        return None if doc_id is None else self._sync.find_one({"_id": doc_id}, projection)
+
+    async def find_one_and_replace(self, filter, replacement, projection=None, sort=None, upsert=False,
+                                   return_document=ReturnDocument.BEFORE, **kwargs):
+        before = self._sync.find_one(filter, projection, sort=sort)
+        _, _, upserted_id, target_id = self._update(filter, replacement, upsert=upsert, replace=True, sort=sort)
+        if return_document is not ReturnDocument.AFTER:
+            return before
+        doc_id = target_id if target_id is not None else upserted_id
+        return None if doc_id is None else self._sync.find_one({"_id": doc_id}, projection)
+
+    async def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        before = self._sync.find_one(filter, projection, sort=sort)
+        self._delete(filter, sort=sort)
+        return before
+
+    async def bulk_write(self, requests, ordered=True, **kwargs):
+        """Apply each write in turn, collecting a BulkWriteResult (or BulkWriteError)"""
+        counts = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0}
+        upserted, errors = [], []
+        for index, model in enumerate(requests):
+            kind, filter, document, upsert = _write_model(model)
+            try:
+                if kind == "insert":
+                    await self.insert_one(document)
+                    counts["nInserted"] += 1
+                    continue
+                if kind in ("delete_one", "delete_many"):
+                    counts["nRemoved"] += self._delete(filter, many=kind == "delete_many")[0]
+                    continue
+                if kind == "update_many":
+                    matched, modified, upserted_id, _ = self._update_many(filter, document, upsert=upsert)
+                else:
+                    matched, modified, upserted_id, _ = self._update(
+                        filter, document, upsert=upsert, replace=kind == "replace"
+                    )
+            except PyMongoError as e:
+                errors.append({"index": index, "code": getattr(e, "code", None), "errmsg": str(e), "op": model})
+                if ordered:
+                    break
+                continue
+            counts["nMatched"] += matched
+            counts["nModified"] += modified
+            if upserted_id is not None:
+                counts["nUpserted"] += 1
+                upserted.append({"index": index, "_id": upserted_id})
+        result = {**counts, "upserted": upserted, "writeErrors": errors, "writeConcernErrors": []}
+        if errors:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    async def drop(self, *args, **kwargs):
+        self._sync.drop()
+        if self._journal is not None:
+            self._journal.append([{"d": self._sync.database.name, "c": self._sync.name, "o": "drop"}])
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+class EmbeddedDatabase:
+    def __init__(self, database, sync_database, journal=None):
+        self._database = database
+        self._sync_database = sync_database
+        self._journal = journal
+
+    def __getitem__(self, name):
+        return EmbeddedCollection(self._database[name], self._sync_database[name], self._journal)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+class EmbeddedClient:
+    """In-process stand-in for AsyncIOMotorClient, optionally journaled to disk"""
+
+    def __init__(self, data_dir: str = EMBEDDED_DATA_DIR):
+        self.data_dir = data_dir
+        self._sync_client = mongomock.MongoClient()
+        self._client = AsyncMongoMockClient(mock_mongo_client=self._sync_client)
+        self.journal = None
+        if data_dir:
+            self.load()
+
+    def __getitem__(self, name):
+        return EmbeddedDatabase(self._client[name], self._sync_client[name], self.journal)
+
+    def load(self):
+        """Read the current snapshot, replay the journal after it and open a new segment"""
+        os.makedirs(self.data_dir, exist_ok=True)
+        snapshot_dir, folded = _current_snapshot(self.data_dir)
+        _load_snapshot(self._sync_client, snapshot_dir)
+        segments = [segment for segment in _segments(self.data_dir) if segment > folded]
+        replayed = sum(
+            _replay_segment(self._sync_client, segment_path(self.data_dir, segment)) for segment in segments
+        )
+        # A fresh segment, so nothing is ever appended after a torn record
+        self.journal = Journal(self.data_dir, max([folded, *segments]) + 1)
+        logger.info("Loaded embedded storage from %s (%d journal records replayed)", self.data_dir, replayed)
+
+    async def save(self):
+        """Seal the journal segment and fold it into a new snapshot in a worker thread"""
+        if self.journal is None:
+            return
+        sealed = self.journal.rotate()
+        await asyncio.to_thread(compact, self.data_dir, sealed)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+    async def save_loop(self, interval: float = EMBEDDED_SAVE_INTERVAL):
+        """Snapshot the journal periodically (no-op without a data_dir)"""
+        if not self.data_dir:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save()
+            except Exception:
+                logger.exception("Saving embedded storage failed")
@@ -0,0 +1,293 @@
+"""Append-only log of completed games and the views replayed from it
+
+Every ``end_game`` appends one immutable event to ``game_events``::
+
+    {_id: seq, g: game id, p: player id, t: ended_at, d: packed counters}
+
+Ids are stored as 16-byte BSON UUIDs and the six game counters are packed
+into a single 28-byte binary field, so an event is about 110 bytes of BSON.
+``seq`` comes from a counter document and gives the log a total order.
+
+The player aggregates (totals, best score/wave, longest game) are a fold
+over the log. ``take_snapshot`` periodically stores that fold in
+``event_snapshots`` (zlib-compressed chunks), and ``rebuild_player_views``
+recomputes every player document from the latest snapshot plus a streaming
+pass over the events after it. The best score/wave distributions in the
+global stats read the player documents, so they follow on their next
+refresh. Events carry no username or score timestamp, so the leaderboard
+(rows of ``scores``) and the duration distribution are not rebuilt from
+the log: they are only as complete as ``scores`` is.
+
+The first snapshot is seeded from the current player documents
+(``snapshot-events --from-players``), since games played before the log
+existed have no events.
+"""
+import logging
+import os
+import struct
+import uuid
+from datetime import datetime, timedelta
+
+from bson.binary import Binary, UUID_SUBTYPE
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from archive import compress_batch, decompress_batch
+from bulk_reads import decode_batch, iter_raw_batches, raw_collection
+from ids import encode_id, decode_id, match_id
+
+logger = logging.getLogger(__name__)
+
+EVENT_BATCH_SIZE = int(os.environ.get("EVENT_BATCH_SIZE", "10000"))
+EVENT_SNAPSHOT_CHUNK = int(os.environ.get("EVENT_SNAPSHOT_CHUNK", "20000"))
+EVENT_SNAPSHOTS_KEPT = int(os.environ.get("EVENT_SNAPSHOTS_KEPT", "3"))
+# Events younger than this are left out of snapshots, so a sequence number
+# allocated just before the cut-off cannot be written after it
+EVENT_SNAPSHOT_LAG = int(os.environ.get("EVENT_SNAPSHOT_LAG", "60"))
+EVENT_SEQ_ID = "game_events"
+
+# score, wave, game_duration, enemies_destroyed, asteroids_destroyed, powerups_collected
+EVENT = struct.Struct("<qiiiii")
+
+# Player fields produced by the fold, in the order they are held in the state
+PLAYER_VIEW_FIELDS = (
+    "total_games", "total_score", "total_playtime", "total_enemies_destroyed",
+    "total_asteroids_destroyed", "total_powerups_collected",
+    "best_score", "best_wave", "longest_game", "last_played",
+)
+
+def _player_key(player_id):
+    """Hashable fold key for a player id (UUID bytes, or the string itself)"""
+    encoded = encode_id(player_id)
+    return bytes(encoded) if isinstance(encoded, Binary) else encoded
+
+def _stored_player_key(value):
+    """Fold key for a player id as an event stores it"""
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return bytes(value)  # The common case, without a round trip through the string
+    return _player_key(decode_id(value))
+
+def _player_id(key) -> str:
+    return str(uuid.UUID(bytes=key)) if isinstance(key, bytes) else key
+
+def encode_event(seq: int, game: dict) -> dict:
+    return {
+        "_id": seq,
+        "g": encode_id(game["id"]),
+        "p": encode_id(game["player_id"]),
+        "t": game.get("end_time") or datetime.utcnow(),
+        "d": Binary(EVENT.pack(
+            game.get("final_score", 0),
+            game.get("max_wave", 1),
+            game.get("game_duration", 0),
+            game.get("enemies_destroyed", 0),
+            game.get("asteroids_destroyed", 0),
+            game.get("powerups_collected", 0),
+        )),
+    }
+
+def decode_event(doc: dict) -> dict:
+    """Turn an event back into the game session fields end_game works with"""
+    score, wave, duration, enemies, asteroids, powerups = EVENT.unpack(doc["d"])
+    return {
+        "id": decode_id(doc["g"]),
+        "player_id": decode_id(doc["p"]),
+        "end_time": doc["t"],
+        "final_score": score,
+        "max_wave": wave,
+        "game_duration": duration,
+        "enemies_destroyed": enemies,
+        "asteroids_destroyed": asteroids,
+        "powerups_collected": powerups,
+    }
+
+async def next_seq(counters_collection, name: str = EVENT_SEQ_ID) -> int:
+    counter = await counters_collection.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+async def append_game_event(events_collection, counters_collection, game: dict):
+    """Record a completed game; repeated calls for the same game are ignored"""
+    seq = await next_seq(counters_collection)
+    try:
+        await events_collection.insert_one(encode_event(seq, game))
+    except DuplicateKeyError:
+        return None
+    return seq
+
+def apply_event(state: dict, key, ended_at, score: int, wave: int, duration: int,
+                enemies: int, asteroids: int, powerups: int):
+    """Fold one game into the player state (mirrors the end_game updates)"""
+    row = state.get(key)
+    if row is None:
+        state[key] = [1, score, duration, enemies, asteroids, powerups,
+                      max(score, 0), max(wave, 1), max(duration, 0), ended_at]
+        return
+    row[0] += 1
+    row[1] += score
+    row[2] += duration
+    row[3] += enemies
+    row[4] += asteroids
+    row[5] += powerups
+    if score > row[6]:
+        row[6] = score
+    if wave > row[7]:
+        row[7] = wave
+    if duration > row[8]:
+        row[8] = duration
+    row[9] = ended_at
+
+def fold_batch(state: dict, batch) -> int:
+    """Fold a batch of event documents into state; returns the last seq"""
+    unpack = EVENT.unpack
+    for doc in batch:
+        apply_event(state, _stored_player_key(doc["p"]), doc["t"], *unpack(doc["d"]))
+    return batch[-1]["_id"] if batch else None
+
+async def replay(events_collection, state: dict, after_seq: int = 0, until_seq: int = None,
+                 batch_size: int = EVENT_BATCH_SIZE):
+    """Stream events after after_seq (up to until_seq) into state
+
+    Returns (last seq applied, number of events).
+    """
+    query = {"_id": {"$gt": after_seq}}
+    if until_seq is not None:
+        query["_id"]["$lte"] = until_seq
+    # Events are tiny, so the driver's C decoder beats lazy RawBSONDocument access here
+    cursor = events_collection.find(query, batch_size=batch_size).sort("_id", 1)
+    last_seq, count = after_seq, 0
+    async for batch in iter_raw_batches(cursor, batch_size):
+        last_seq = fold_batch(state, batch)
+        count += len(batch)
+    return last_seq, count
+
+def encode_state_chunk(rows) -> bytes:
+    return compress_batch([
+        {"p": Binary(key, UUID_SUBTYPE) if isinstance(key, bytes) else key, "v": row}
+        for key, row in rows
+    ])
+
+def decode_state_chunk(payload: bytes, state: dict):
+    for doc in decompress_batch(payload):
+        key = doc["p"]
+        state[bytes(key) if isinstance(key, (Binary, bytes)) else key] = doc["v"]
+
+async def load_snapshot(snapshots_collection):
+    """Return (seq, state) of the latest complete snapshot, or (0, {})"""
+    header = await snapshots_collection.find_one(
+        {"kind": "header"}, sort=[("seq", -1)]
+    )
+    if not header:
+        return 0, {}
+    state = {}
+    async for chunk in snapshots_collection.find(
+        {"kind": "chunk", "seq": header["seq"]}
+    ).sort("n", 1):
+        decode_state_chunk(chunk["payload"], state)
+    return header["seq"], state
+
+async def write_snapshot(snapshots_collection, seq: int, state: dict,
+                         chunk_size: int = EVENT_SNAPSHOT_CHUNK):
+    """Store state as of seq; the header is written last, marking it complete"""
+    await snapshots_collection.delete_many({"seq": seq})
+    rows = list(state.items())
+    chunks = 0
+    for n, start in enumerate(range(0, len(rows), chunk_size)):
+        await snapshots_collection.insert_one({
+            "kind": "chunk",
+            "seq": seq,
+            "n": n,
+            "payload": Binary(encode_state_chunk(rows[start:start + chunk_size])),
+        })
+        chunks += 1
+    await snapshots_collection.insert_one({
+        "kind": "header",
+        "seq": seq,
+        "players": len(rows),
+        "chunks": chunks,
+        "created_at": datetime.utcnow(),
+    })
+
+    # Keep the newest few snapshots so a bad one can be skipped by hand
+    old = await snapshots_collection.find(
+        {"kind": "header"}, {"seq": 1}
+    ).sort("seq", -1).skip(EVENT_SNAPSHOTS_KEPT).to_list(length=None)
+    if old:
+        await snapshots_collection.delete_many({"seq": {"$in": [doc["seq"] for doc in old]}})
+
+async def _snapshot_cutoff(events_collection):
+    cutoff = datetime.utcnow() - timedelta(seconds=EVENT_SNAPSHOT_LAG)
+    last = await events_collection.find(
+        {"t": {"$lt": cutoff}}, {"_id": 1}
+    ).sort("_id", -1).limit(1).to_list(length=1)
+    return last[0]["_id"] if last else None
+
+async def seed_state_from_players(players_collection, batch_size: int = EVENT_BATCH_SIZE) -> dict:
+    """Initial state taken from the player documents as they stand now"""
+    state = {}
+    cursor = raw_collection(players_collection).find(
+        {"total_games": {"$gt": 0}},
+        {"_id": 0, "id": 1, **{field: 1 for field in PLAYER_VIEW_FIELDS}},
+        batch_size=batch_size
+    )
+    async for batch in iter_raw_batches(cursor, batch_size):
+        for doc in decode_batch(batch):
+            row = [doc.get(field) or 0 for field in PLAYER_VIEW_FIELDS]
+            row[PLAYER_VIEW_FIELDS.index("last_played")] = doc.get("last_played")
+            state[_player_key(doc["id"])] = row
+    return state
+
+async def take_snapshot(events_collection, snapshots_collection, counters_collection,
+                        players_collection=None):
+    """Write a new snapshot and return its seq (None if there is nothing new)
+
+    With players_collection the snapshot is seeded from the player documents
+    at the current head of the log instead of folding the previous snapshot.
+    """
+    if players_collection is not None:
+        counter = await counters_collection.find_one({"_id": EVENT_SEQ_ID})
+        seq = counter["seq"] if counter else 0
+        state = await seed_state_from_players(players_collection)
+    else:
+        seq, state = await load_snapshot(snapshots_collection)
+        cutoff = await _snapshot_cutoff(events_collection)
+        if cutoff is None or cutoff <= seq:
+            return None
+        seq, _ = await replay(events_collection, state, after_seq=seq, until_seq=cutoff)
+    await write_snapshot(snapshots_collection, seq, state)
+    logger.info("Event snapshot at seq %d (%d players)", seq, len(state))
+    return seq
+
+async def rebuild_player_views(events_collection, snapshots_collection, players_collection,
+                               batch_size: int = EVENT_BATCH_SIZE, on_progress=None):
+    """Recompute every player's aggregates from the latest snapshot and the log tail"""
+    seq, state = await load_snapshot(snapshots_collection)
+    last_seq, replayed = await replay(events_collection, state, after_seq=seq)
+
+    rows = list(state.items())
+    written = 0
+    for start in range(0, len(rows), batch_size):
+        # Every rewritten player is stamped so incremental sync clients pick up the repair
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"id": match_id(_player_id(key))},
+                {"$set": {**dict(zip(PLAYER_VIEW_FIELDS, row)), "updated_at": now}}
+            )
+            for key, row in rows[start:start + batch_size]
+        ]
+        result = await players_collection.bulk_write(operations, ordered=False)
+        written += result.matched_count
+        if on_progress:
+            on_progress(start + len(operations), written)
+    return {
+        "snapshot_seq": seq,
+        "last_seq": last_seq,
+        "events_replayed": replayed,
+        "players": len(rows),
+        "players_written": written,
+    }
@@ -1,46 +1,118 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Header, Request
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
 import asyncio
 
 from models import (
-    Player, PlayerCreate, PlayerUpdate,
+    Player, PlayerCreate, PlayerUpdate, PlayerSyncResponse,
     GameSession, GameSessionCreate, GameSessionUpdate,
     Score, ScoreCreate,
     LeaderboardEntry, LeaderboardResponse,
     Achievement, AchievementWithStatus,
-    GameStats, DetailedStats
+    GameStats, DetailedStats, GlobalStatsResponse, GameResult, LobbyResponse,
+    ActivityStats, DailyGames,
+    Group, GroupCreate, GroupMemberAdd, FriendAdd, Replay,
+    PLAYER_STATS_PROJECTION,
+    GAME_SESSION_PROJECTION
 )
 from database import (
     players_collection, game_sessions_collection, scores_collection,
-    achievements_collection, player_achievements_collection,
-    get_player_by_username, create_player, update_player,
-    get_leaderboard, get_player_rank, check_achievements,
-    get_player_achievements, get_game_stats, init_achievements
+    player_achievements_collection, score_sketches_collection,
+    score_archive_stats_collection, game_events_collection, counters_collection,
+    leaderboard_scores_collection, leaderboard_players_collection, catalog_achievements_collection,
+    stats_players_collection, stats_scores_collection, jobs_collection, idempotency_keys_collection,
+    client, STORAGE_BACKEND, stat_counters, EXACT_RANK_TOP_N, MAX_BULK_PLAYER_IDS, MAX_PLAYER_SYNC_PAGE,
+    get_player_by_id, get_or_create_player, update_player,
+    get_players_by_ids, get_players_updated_since, record_player_game,
+    get_leaderboard, get_player_best_score, get_player_rank, check_achievements,
+    get_player_achievements, get_achievement_catalog, achievement_unlock_percent, get_game_stats,
+    init_achievements, init_indexes, backfill_player_updated_at, backfill_longest_game
+)
+from global_stats import global_stats, global_stats_refresh_loop
+from score_sketch import score_sketch, score_sketch_sync_loop
+from singleflight import read_coalescer
+from rate_limit import rate_limit
+from leaderboard_snapshot import leaderboard_snapshot, leaderboard_snapshot_loop
+from archive import archived_scores, archived_scores_refresh_loop
+from event_log import append_game_event
+from projections import PROJECTION_MODE, player_cache_invalidation_loop
+from job_queue import enqueue, get_job, run_job_workers
+from post_game import GAME_END_JOB, GAME_JOB_HANDLERS, game_end_job_key, game_result
+from idempotency import idempotency_store
+from content_negotiation import NegotiatedRoute, NegotiatedResponse
+from counters import (
+    SCORES_COUNTER, PLAYERS_COUNTER, games_counter, counter_refresh_loop, counter_reconcile_loop
+)
+from replays import REPLAY_TOP_N, ReplayFileResponse, save_replay, open_replay, get_top_replays
+from groups import (
+    GroupFullError, friend_group_id, create_group, get_group, get_player_groups,
+    add_member, remove_member, add_friend, remove_friend, record_group_score, get_group_leaderboard
 )
 
-router = APIRouter()
+router = APIRouter(route_class=NegotiatedRoute, default_response_class=NegotiatedResponse)
 
-# Initialize achievements on startup
+# Initialize indexes and achievements on startup
+asyncio.create_task(init_indexes())
+asyncio.create_task(backfill_player_updated_at())
+asyncio.create_task(backfill_longest_game())
 asyncio.create_task(init_achievements())
+asyncio.create_task(global_stats_refresh_loop(stats_players_collection, stats_scores_collection))
+asyncio.create_task(score_sketch_sync_loop(score_sketches_collection, scores_collection))
+asyncio.create_task(archived_scores_refresh_loop(score_archive_stats_collection))
+asyncio.create_task(counter_refresh_loop(stat_counters))
+asyncio.create_task(counter_reconcile_loop(
+    stat_counters, scores_collection, players_collection, player_achievements_collection
+))
+asyncio.create_task(leaderboard_snapshot_loop(
+    leaderboard_players_collection, leaderboard_scores_collection, catalog_achievements_collection
+))
+if STORAGE_BACKEND == "memory":
+    if PROJECTION_MODE == "stream":
+        raise RuntimeError("PROJECTION_MODE=stream needs MongoDB change streams; use inline or queue")
+    asyncio.create_task(client.save_loop())
+if PROJECTION_MODE == "stream":
+    asyncio.create_task(player_cache_invalidation_loop(players_collection))
+if PROJECTION_MODE == "queue":
+    asyncio.create_task(run_job_workers(jobs_collection, GAME_JOB_HANDLERS))
 
 @router.post("/players", response_model=Player)
 async def create_or_get_player(player_data: PlayerCreate):
     """Create a new player or get existing player"""
-    # Check if player exists
-    existing_player = await get_player_by_username(player_data.username)
-    if existing_player:
-        return Player(**existing_player)
-    
-    # Create new player
     new_player = Player(**player_data.dict())
-    await create_player(new_player.dict())
-    return new_player
+    player = await get_or_create_player(player_data.username, new_player.dict())
+    return Player(**player)
+
+@router.get("/players", response_model=List[Player])
+async def get_players(ids: List[str] = Query(...)):
+    """Get several players by ID (repeated or comma-separated), skipping unknown ones"""
+    player_ids = [player_id for value in ids for player_id in value.split(",") if player_id]
+    if len(player_ids) > MAX_BULK_PLAYER_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BULK_PLAYER_IDS} player IDs per request"
+        )
+    players = await get_players_by_ids(player_ids)
+    return [Player(**player) for player in players]
+
+@router.get("/players/changes", response_model=PlayerSyncResponse)
+async def get_player_changes(updated_since: Optional[datetime] = None, after_id: Optional[str] = None,
+                             limit: int = Query(MAX_PLAYER_SYNC_PAGE, ge=1, le=MAX_PLAYER_SYNC_PAGE)):
+    """Players changed since the given position, for incremental client sync"""
+    players, has_more, (next_updated_since, next_after_id) = await get_players_updated_since(
+        updated_since, after_id, limit
+    )
+    return PlayerSyncResponse(
+        players=[Player(**player) for player in players],
+        has_more=has_more,
+        next_updated_since=next_updated_since,
+        next_after_id=next_after_id
+    )
 
 @router.get("/players/{player_id}", response_model=Player)
 async def get_player(player_id: str):
     """Get player by ID"""
-    player = await players_collection.find_one({"id": player_id})
+    player = await get_player_by_id(player_id)
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     return Player(**player)
@@ -48,7 +120,7 @@ async def get_player(player_id: str):
 @router.put("/players/{player_id}", response_model=Player)
 async def update_player_data(player_id: str, player_data: PlayerUpdate):
     """Update player data"""
-    player = await players_collection.find_one({"id": player_id})
+    player = await get_player_by_id(player_id)
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     
@@ -57,10 +129,24 @@ async def update_player_data(player_id: str, player_data: PlayerUpdate):
     return Player(**updated_player)
 
 @router.post("/games", response_model=GameSession)
-async def start_game(game_data: GameSessionCreate):
-    """Start a new game session"""
+async def start_game(
+    game_data: GameSessionCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Start a new game session
+
+    Retries sent with the same ``Idempotency-Key`` get the original session.
+    Keys are scoped to the player, so clients never see each other's sessions.
+    """
+    return await idempotency_store.run(
+        idempotency_keys_collection, f"start_game:{game_data.player_id}", idempotency_key, game_data,
+        lambda: create_game_session(game_data)
+    )
+
+async def create_game_session(game_data: GameSessionCreate):
+    """Create a game session for an existing player"""
     # Verify player exists
-    player = await players_collection.find_one({"id": game_data.player_id})
+    player = await get_player_by_id(game_data.player_id)
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     
@@ -72,35 +158,100 @@ async def start_game(game_data: GameSessionCreate):
 @router.get("/games/{game_id}", response_model=GameSession)
 async def get_game(game_id: str):
     """Get game session by ID"""
-    game = await game_sessions_collection.find_one({"id": game_id})
+    game = await game_sessions_collection.find_one({"id": game_id}, GAME_SESSION_PROJECTION)
     if not game:
         raise HTTPException(status_code=404, detail="Game session not found")
     return GameSession(**game)
 
-@router.put("/games/{game_id}", response_model=GameSession)
-async def update_game(game_id: str, game_data: GameSessionUpdate):
-    """Update game session"""
-    game = await game_sessions_collection.find_one({"id": game_id})
+@router.get("/games/{game_id}/result", response_model=GameResult)
+async def get_game_result(game_id: str):
+    """Get achievements and rank for a finished game
+
+    ``pending`` until the game's post-processing job has run.
+    """
+    game = await game_sessions_collection.find_one({"id": game_id}, GAME_SESSION_PROJECTION)
     if not game:
         raise HTTPException(status_code=404, detail="Game session not found")
+    if game["status"] != "completed":
+        raise HTTPException(status_code=409, detail="Game has not ended")
     
+    job = await get_job(jobs_collection, game_end_job_key(game_id))
+    if job is None:
+        # Processed inline (or by the stream worker), or the job has expired
+        return GameResult(game_id=game_id, status="done", **await game_result(game))
+    if job["status"] == "done":
+        return GameResult(game_id=game_id, status="done", **job["result"])
+    if job["status"] == "failed":
+        return GameResult(game_id=game_id, status="failed", error=job.get("error"))
+    return GameResult(game_id=game_id, status="pending")
+
+@router.put("/games/{game_id}/replay", response_model=Replay, dependencies=[rate_limit("replay_upload")])
+async def upload_replay(game_id: str, request: Request):
+    """Upload the compressed replay of a finished game
+
+    The body is stored as sent. Only games among the top ``REPLAY_TOP_N``
+    scores keep a replay; others are refused with 409.
+    """
+    game = await game_sessions_collection.find_one({"id": game_id}, GAME_SESSION_PROJECTION)
+    if not game:
+        raise HTTPException(status_code=404, detail="Game session not found")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    return await save_replay(game, request.stream(), content_type)
+
+@router.get("/games/{game_id}/replay", response_class=ReplayFileResponse)
+async def get_replay(
+    game_id: str,
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_range: Optional[str] = Header(None, alias="If-Range")
+):
+    """Stream a game's replay, or the byte range asked for"""
+    opened = await open_replay(game_id)
+    if opened is None:
+        raise HTTPException(status_code=404, detail="Replay not found")
+    replay, file = opened
+    return ReplayFileResponse(replay, file, range_header=range_header, if_range=if_range)
+
+@router.get("/replays", response_model=List[Replay])
+async def list_replays(limit: int = Query(10, ge=1, le=REPLAY_TOP_N)):
+    """Replays of the best-scoring games, best first"""
+    return await get_top_replays(limit)
+
+@router.put("/games/{game_id}", response_model=GameSession)
+async def update_game(game_id: str, game_data: GameSessionUpdate):
+    """Update game session"""
     update_data = {k: v for k, v in game_data.dict().items() if v is not None}
     
-    await game_sessions_collection.update_one(
-        {"id": game_id},
-        {"$set": update_data}
-    )
-    
-    updated_game = await game_sessions_collection.find_one({"id": game_id})
+    if update_data:
+        updated_game = await game_sessions_collection.find_one_and_update(
+            {"id": game_id},
+            {"$set": update_data},
+            projection=GAME_SESSION_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+    else:
+        updated_game = await game_sessions_collection.find_one({"id": game_id}, GAME_SESSION_PROJECTION)
+    if not updated_game:
+        raise HTTPException(status_code=404, detail="Game session not found")
     return GameSession(**updated_game)
 
 @router.post("/games/{game_id}/end")
-async def end_game(game_id: str, final_data: GameSessionUpdate):
-    """End a game session and process final score"""
-    game = await game_sessions_collection.find_one({"id": game_id})
-    if not game:
-        raise HTTPException(status_code=404, detail="Game session not found")
-    
+async def end_game(
+    game_id: str,
+    final_data: GameSessionUpdate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """End a game session and process final score
+
+    Retries sent with the same ``Idempotency-Key`` get the original response
+    without recording the score again.
+    """
+    return await idempotency_store.run(
+        idempotency_keys_collection, f"end_game:{game_id}", idempotency_key, final_data,
+        lambda: finish_game(game_id, final_data)
+    )
+
+async def finish_game(game_id: str, final_data: GameSessionUpdate):
+    """Complete a game session and record its score"""
     # Update game session
     update_data = {
         **{k: v for k, v in final_data.dict().items() if v is not None},
@@ -108,13 +259,15 @@ async def end_game(game_id: str, final_data: GameSessionUpdate):
         "status": "completed"
     }
     
-    await game_sessions_collection.update_one(
+    game = await game_sessions_collection.find_one_and_update(
         {"id": game_id},
-        {"$set": update_data}
+        {"$set": update_data},
+        projection=GAME_SESSION_PROJECTION,
+        return_document=ReturnDocument.AFTER
     )
-    
-    # Get updated game session
-    updated_game = await game_sessions_collection.find_one({"id": game_id})
+    if not game:
+        raise HTTPException(status_code=404, detail="Game session not found")
+    await append_game_event(game_events_collection, counters_collection, game)
     
     # Create score entry
     score_data = ScoreCreate(
@@ -131,49 +284,78 @@ async def end_game(game_id: str, final_data: GameSessionUpdate):
     
     new_score = Score(**score_data.dict())
     await scores_collection.insert_one(new_score.dict())
+    await stat_counters.incr_many({SCORES_COUNTER: 1, games_counter(new_score.created_at): 1})
+    score_sketch.add(new_score.score)
+    leaderboard_snapshot.notify_changed(new_score.dict())
+    
+    if PROJECTION_MODE == "queue":
+        await enqueue(jobs_collection, GAME_END_JOB, game_end_job_key(game_id), {"game_id": game_id})
+    if PROJECTION_MODE in ("stream", "queue"):
+        # Player totals, achievements and group boards are updated off the request path;
+        # clients poll GET /games/{id}/result for achievements and rank
+        return {
+            "game_session": GameSession(**game),
+            "score": new_score,
+            "new_achievements": [],
+            "player_rank": None,
+            "success": True
+        }
+    
+    await record_group_score(new_score.dict())
     
     # Update player statistics
-    player = await players_collection.find_one({"id": game["player_id"]})
+    player = await record_player_game(game["player_id"], game)
     if player:
-        player_updates = {
-            "total_games": player.get("total_games", 0) + 1,
-            "total_score": player.get("total_score", 0) + update_data.get("final_score", 0),
-            "total_playtime": player.get("total_playtime", 0) + update_data.get("game_duration", 0),
-            "total_enemies_destroyed": player.get("total_enemies_destroyed", 0) + update_data.get("enemies_destroyed", 0),
-            "total_asteroids_destroyed": player.get("total_asteroids_destroyed", 0) + update_data.get("asteroids_destroyed", 0),
-            "total_powerups_collected": player.get("total_powerups_collected", 0) + update_data.get("powerups_collected", 0),
-            "last_played": datetime.utcnow()
-        }
-        
-        # Update best score if needed
-        if update_data.get("final_score", 0) > player.get("best_score", 0):
-            player_updates["best_score"] = update_data.get("final_score", 0)
-        
-        # Update best wave if needed
-        if update_data.get("max_wave", 1) > player.get("best_wave", 1):
-            player_updates["best_wave"] = update_data.get("max_wave", 1)
-        
-        await update_player(game["player_id"], player_updates)
+        global_stats.record_game(player, game)
     
     # Check for new achievements
-    new_achievements = await check_achievements(game["player_id"], updated_game)
+    new_achievements = await check_achievements(game["player_id"], game)
     
     # Get player's rank
-    player_rank = await get_player_rank(game["player_id"])
+    player_rank = await get_player_rank(game["player_id"], consistent=True)
     
     return {
-        "game_session": GameSession(**updated_game),
+        "game_session": GameSession(**game),
         "score": new_score,
         "new_achievements": new_achievements,
         "player_rank": player_rank,
         "success": True
     }
 
-@router.get("/leaderboard", response_model=LeaderboardResponse)
-async def get_leaderboard_data(limit: int = 10, skip: int = 0, player_id: Optional[str] = None):
-    """Get leaderboard with optional player rank"""
+@router.get("/leaderboard", response_model=LeaderboardResponse,
+            dependencies=[rate_limit("leaderboard")])
+async def get_leaderboard_data(
+    limit: int = 10,
+    skip: int = 0,
+    player_id: Optional[str] = None,
+    approximate: bool = False
+):
+    """Get leaderboard with optional player rank
+
+    ``approximate`` keeps exact ranks for the top ``EXACT_RANK_TOP_N`` and
+    estimates the rest from the score sketch. Identical concurrent requests
+    share one set of queries.
+    """
+    return await read_coalescer.do(
+        ("leaderboard", limit, skip, player_id, approximate),
+        lambda: load_leaderboard(limit, skip, player_id, approximate)
+    )
+
+async def load_leaderboard(limit: int, skip: int, player_id: Optional[str], approximate: bool,
+                           player: dict = None):
+    """Build a leaderboard response, from the shared snapshot when it covers the page
+
+    Pass ``player`` when the caller already holds the player document.
+    """
+    snapshot = leaderboard_snapshot.fresh()
+    
     # Get top scores
-    top_scores = await get_leaderboard(limit, skip)
+    if snapshot and snapshot.can_serve_page(skip, limit):
+        top_scores = snapshot.page(skip, limit)
+        total_entries = snapshot.total_scores + archived_scores.count
+    else:
+        top_scores = await get_leaderboard(limit, skip)
+        total_entries = stat_counters.get(SCORES_COUNTER) + archived_scores.count
     
     # Convert to LeaderboardEntry objects
     entries = []
@@ -189,36 +371,146 @@ async def get_leaderboard_data(limit: int = 10, skip: int = 0, player_id: Option
         )
         entries.append(entry)
     
-    # Get total entries count
-    total_entries = await scores_collection.count_documents({})
-    
     # Get user rank if player_id provided
     user_rank = None
     user_best_score = None
+    user_rank_exact = None
+    user_top_percent = None
     if player_id:
-        user_rank = await get_player_rank(player_id)
-        user_best = await scores_collection.find_one(
-            {"player_id": player_id},
-            sort=[("score", -1)]
-        )
-        if user_best:
-            user_best_score = user_best["score"]
+        if snapshot:
+            user_best_score = snapshot.best_score(player_id)
+        if user_best_score is not None:
+            user_rank = snapshot.rank(user_best_score) + archived_scores.count_above(user_best_score)
+            user_rank_exact = user_rank <= EXACT_RANK_TOP_N or not archived_scores.count
+        else:
+            if player is None:
+                user_best_score = await get_player_best_score(player_id)
+            elif player.get("total_games"):
+                user_best_score = player.get("best_score", 0)
+            if user_best_score is not None:
+                user_rank = await get_player_rank(player_id, user_best_score, approximate=approximate)
+            if user_rank is not None:
+                user_rank_exact = not approximate or user_rank <= EXACT_RANK_TOP_N
+        if user_rank is not None and score_sketch.loaded:
+            user_top_percent = score_sketch.top_percent(user_best_score)
     
     return LeaderboardResponse(
         entries=entries,
         total_entries=total_entries,
         user_rank=user_rank,
-        user_best_score=user_best_score
+        user_best_score=user_best_score,
+        user_rank_exact=user_rank_exact,
+        user_top_percent=user_top_percent
     )
 
-@router.get("/players/{player_id}/stats", response_model=DetailedStats)
+# Group and friend leaderboards
+@router.post("/groups", response_model=Group)
+async def create_player_group(group_data: GroupCreate):
+    """Create a clan owned (and first joined) by a player"""
+    if not await get_player_by_id(group_data.owner_id):
+        raise HTTPException(status_code=404, detail="Player not found")
+    return Group(**await create_group(group_data.name, group_data.owner_id))
+
+@router.get("/groups/{group_id}", response_model=Group)
+async def get_player_group(group_id: str):
+    """Get group by ID"""
+    group = await get_group(group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return Group(**group)
+
+@router.post("/groups/{group_id}/members", response_model=Group)
+async def join_group(group_id: str, member: GroupMemberAdd):
+    """Add a player to a clan"""
+    if not await get_player_by_id(member.player_id):
+        raise HTTPException(status_code=404, detail="Player not found")
+    try:
+        group = await add_member(group_id, member.player_id)
+    except GroupFullError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return Group(**group)
+
+@router.delete("/groups/{group_id}/members/{player_id}", response_model=Group)
+async def leave_group(group_id: str, player_id: str):
+    """Remove a player from a clan"""
+    group = await remove_member(group_id, player_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return Group(**group)
+
+@router.get("/groups/{group_id}/leaderboard", response_model=LeaderboardResponse,
+            dependencies=[rate_limit("leaderboard")])
+async def get_group_leaderboard_data(
+    group_id: str,
+    limit: int = Query(10, ge=1, le=100),
+    skip: int = Query(0, ge=0),
+    player_id: Optional[str] = None
+):
+    """Leaderboard of a clan's members, best game per member"""
+    board = await get_group_leaderboard(group_id, limit, skip, player_id)
+    if board is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+    return LeaderboardResponse(**board)
+
+@router.get("/players/{player_id}/groups", response_model=List[Group])
+async def get_groups_of_player(player_id: str):
+    """Clans the player belongs to"""
+    return [Group(**group) for group in await get_player_groups(player_id)]
+
+@router.post("/players/{player_id}/friends", response_model=Group)
+async def befriend_player(player_id: str, friend: FriendAdd):
+    """Add a friend (both ways); returns the player's friend group"""
+    if friend.friend_id == player_id:
+        raise HTTPException(status_code=400, detail="Players cannot befriend themselves")
+    for required_id in (player_id, friend.friend_id):
+        if not await get_player_by_id(required_id):
+            raise HTTPException(status_code=404, detail="Player not found")
+    try:
+        return Group(**await add_friend(player_id, friend.friend_id))
+    except GroupFullError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.delete("/players/{player_id}/friends/{friend_id}")
+async def unfriend_player(player_id: str, friend_id: str):
+    """Remove a friend (both ways)"""
+    await remove_friend(player_id, friend_id)
+    return {"success": True}
+
+@router.get("/players/{player_id}/friends/leaderboard", response_model=LeaderboardResponse,
+            dependencies=[rate_limit("leaderboard")])
+async def get_friend_leaderboard(
+    player_id: str,
+    limit: int = Query(10, ge=1, le=100),
+    skip: int = Query(0, ge=0)
+):
+    """Leaderboard of the player and their friends"""
+    board = await get_group_leaderboard(friend_group_id(player_id), limit, skip, player_id)
+    if board is None:
+        # The friend group is created with the first friend
+        if not await get_player_by_id(player_id):
+            raise HTTPException(status_code=404, detail="Player not found")
+        return LeaderboardResponse(entries=[], total_entries=0)
+    return LeaderboardResponse(**board)
+
+@router.get("/players/{player_id}/stats", response_model=DetailedStats,
+            dependencies=[rate_limit("player_stats")])
 async def get_player_stats(player_id: str):
     """Get detailed player statistics"""
-    player = await players_collection.find_one({"id": player_id})
+    return await read_coalescer.do(
+        ("player_stats", player_id),
+        lambda: load_player_stats(player_id)
+    )
+
+async def load_player_stats(player_id: str, player: dict = None):
+    """Build a detailed stats response"""
+    if player is None:
+        player = await players_collection.find_one({"id": player_id}, PLAYER_STATS_PROJECTION)
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     
-    stats = await get_game_stats(player_id)
+    stats = await get_game_stats(player_id, player)
     if not stats:
         raise HTTPException(status_code=404, detail="Stats not found")
     
@@ -230,6 +522,33 @@ async def get_player_stats(player_id: str):
         achievements=[AchievementWithStatus(**achievement) for achievement in stats["achievements"]]
     )
 
+@router.get("/lobby", response_model=LobbyResponse, dependencies=[rate_limit("lobby")])
+async def get_lobby(
+    player_id: str,
+    leaderboard_limit: int = Query(10, ge=1, le=100)
+):
+    """Get everything the lobby shows (stats, achievements, leaderboard) in one request
+
+    The player document and achievement catalog are read once and shared by
+    the sub-results, which are loaded concurrently.
+    """
+    return await read_coalescer.do(
+        ("lobby", player_id, leaderboard_limit),
+        lambda: load_lobby(player_id, leaderboard_limit)
+    )
+
+async def load_lobby(player_id: str, leaderboard_limit: int):
+    """Build a lobby response"""
+    player = await players_collection.find_one({"id": player_id}, PLAYER_STATS_PROJECTION)
+    if not player:
+        raise HTTPException(status_code=404, detail="Player not found")
+    
+    stats, leaderboard = await asyncio.gather(
+        load_player_stats(player_id, player),
+        load_leaderboard(leaderboard_limit, 0, player_id, False, player)
+    )
+    return LobbyResponse(stats=stats, leaderboard=leaderboard)
+
 @router.get("/achievements", response_model=List[AchievementWithStatus])
 async def get_achievements(player_id: Optional[str] = None):
     """Get all achievements, optionally with player progress"""
@@ -237,11 +556,48 @@ async def get_achievements(player_id: Optional[str] = None):
         achievements = await get_player_achievements(player_id)
         return [AchievementWithStatus(**achievement) for achievement in achievements]
     else:
-        achievements = await achievements_collection.find({}).to_list(length=None)
-        return [AchievementWithStatus(**{**achievement, "unlocked": False}) for achievement in achievements]
+        snapshot = leaderboard_snapshot.current()
+        # A snapshot built from a lagging secondary can hold an empty catalog
+        achievements = snapshot.catalog() if snapshot else None
+        if not achievements:
+            achievements = await get_achievement_catalog()
+        return [
+            AchievementWithStatus(**{
+                **achievement,
+                "unlocked": False,
+                "unlock_percent": achievement_unlock_percent(achievement["id"]),
+            })
+            for achievement in achievements
+        ]
 
 @router.get("/players/{player_id}/achievements", response_model=List[AchievementWithStatus])
 async def get_player_achievements_endpoint(player_id: str):
     """Get player's achievements with unlock status"""
     achievements = await get_player_achievements(player_id)
-    return [AchievementWithStatus(**achievement) for achievement in achievements]
\ No newline at end of file
+    return [AchievementWithStatus(**achievement) for achievement in achievements]
+
+@router.get("/stats/activity", response_model=ActivityStats)
+async def get_activity_stats(days: int = Query(7, ge=1, le=90)):
+    """Player and score totals and games completed per day, from the maintained counters"""
+    today = datetime.utcnow().date()
+    dates = [today - timedelta(days=n) for n in reversed(range(days))]
+    return ActivityStats(
+        total_players=stat_counters.get(PLAYERS_COUNTER),
+        total_scores=stat_counters.get(SCORES_COUNTER) + archived_scores.count,
+        games_per_day=[
+            DailyGames(date=day.isoformat(), games=stat_counters.get(games_counter(day)))
+            for day in dates
+        ],
+    )
+
+@router.get("/stats/global", response_model=GlobalStatsResponse)
+async def get_global_stats(
+    score: Optional[int] = None,
+    bins: int = Query(20, ge=1, le=200),
+    cdf: Optional[List[int]] = Query(None)
+):
+    """Get global score, wave and duration distributions"""
+    summary = await global_stats.summary(score=score, bins=bins)
+    if cdf:
+        summary["score_cdf"] = global_stats.score_cdf(cdf)
+    return GlobalStatsResponse(**summary)
@@ -0,0 +1,260 @@
+"""Global score/wave/duration distributions held in sorted NumPy arrays
+
+The arrays are rebuilt from Mongo periodically and patched in between from
+``end_game``. Updates are buffered and merged into the sorted arrays on the
+next read, so queries are a ``searchsorted`` or a slice away. Rebuild sorts
+and the histogram/percentile summaries run in the offload process pool.
+
+The duration distribution also folds in the sketch of archived games'
+durations (see archive.py), so it stays all-time after archiving; its
+percentiles and histogram are then within the sketch's relative accuracy.
+
+The summaries are computed once per rebuild (and per ``bins``) and cached,
+so between rebuilds a request only pays for the player count and the
+``searchsorted`` of its score against the live arrays.
+"""
+import asyncio
+import logging
+import os
+
+import numpy as np
+
+import offload
+from archive import archived_scores
+from bulk_reads import iter_column_batches
+
+logger = logging.getLogger(__name__)
+
+STATS_REBUILD_INTERVAL = int(os.environ.get("STATS_REBUILD_INTERVAL", "900"))
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90, 95, 99)
+
+class SortedColumn:
+    """A sorted array with buffered inserts and removals"""
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.values = np.empty(0, dtype=dtype)
+        self._added = []
+        self._removed = []
+        self._journal = None
+
+    def begin_reload(self):
+        """Start recording changes so they survive a reload in flight"""
+        self._journal = ([], [])
+
+    def finish_reload(self, values, presorted: bool = False):
+        """Swap in freshly read values plus anything recorded since begin_reload"""
+        values = np.asarray(values, dtype=self.dtype)
+        self.values = values if presorted else np.sort(values)
+        self._added, self._removed = self._journal or ([], [])
+        self._journal = None
+
+    def abort_reload(self):
+        self._journal = None
+
+    def add(self, value):
+        self._added.append(value)
+        if self._journal is not None:
+            self._journal[0].append(value)
+
+    def replace(self, old_value, new_value):
+        self._removed.append(old_value)
+        if self._journal is not None:
+            self._journal[1].append(old_value)
+        self.add(new_value)
+
+    def sorted(self):
+        """Return the sorted array with all buffered changes applied
+
+        Inserts are merged before removals so a value added and replaced
+        within the same buffer is removed correctly.
+        """
+        if self._added:
+            added = np.asarray(self._added, dtype=self.dtype)
+            self._added = []
+            self.values = np.sort(np.concatenate([self.values, added]), kind="mergesort")
+        if self._removed:
+            removed = np.asarray(self._removed, dtype=self.dtype)
+            self._removed = []
+            uniq, counts = np.unique(removed, return_counts=True)
+            starts = np.searchsorted(self.values, uniq, side="left")
+            idx = np.concatenate([np.arange(s, s + c) for s, c in zip(starts, counts)])
+            expected = np.repeat(uniq, counts)
+            in_range = idx < len(self.values)
+            idx, expected = idx[in_range], expected[in_range]
+            # Only drop positions that really hold the removed value
+            self.values = np.delete(self.values, idx[self.values[idx] == expected])
+        return self.values
+
+def describe(values, percentiles=DEFAULT_PERCENTILES, bins: int = 20, extra=None):
+    """Summarise a sorted array: percentiles, histogram and min/max/mean
+
+    ``extra`` is an optional (values, counts) pair of weighted values, such
+    as the buckets of a sketch, summarised together with the array.
+    """
+    if extra is not None and len(extra[0]):
+        return _describe_weighted(values, extra, percentiles, bins)
+    if len(values) == 0:
+        return {
+            "count": 0, "min": 0, "max": 0, "mean": 0.0,
+            "percentiles": {str(p): 0 for p in percentiles},
+            "histogram": {"edges": [], "counts": []},
+        }
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        "count": int(len(values)),
+        "min": int(values[0]),
+        "max": int(values[-1]),
+        "mean": float(values.mean()),
+        "percentiles": {
+            str(p): float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))
+        },
+        "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+    }
+
+def _describe_weighted(values, extra, percentiles, bins: int):
+    uniq, counts = np.unique(values, return_counts=True)
+    merged = np.concatenate([uniq.astype(np.float64), np.asarray(extra[0], dtype=np.float64)])
+    weights = np.concatenate([counts, np.asarray(extra[1], dtype=np.int64)])
+    order = np.argsort(merged, kind="mergesort")
+    merged, weights = merged[order], weights[order]
+    cumulative = np.cumsum(weights)
+    total = int(cumulative[-1])
+    # Nearest-rank percentiles over the weighted values
+    ranks = np.ceil(np.asarray(percentiles, dtype=np.float64) / 100 * total).clip(1, total)
+    positions = np.searchsorted(cumulative, ranks, side="left")
+    hist_counts, edges = np.histogram(merged, bins=bins, weights=weights)
+    return {
+        "count": total,
+        "min": int(merged[0]),
+        "max": int(round(merged[-1])),
+        "mean": float((merged * weights).sum() / total),
+        "percentiles": {str(p): float(merged[i]) for p, i in zip(percentiles, positions)},
+        "histogram": {"edges": edges.tolist(), "counts": hist_counts.astype(np.int64).tolist()},
+    }
+
+def sketch_points(sketch) -> tuple:
+    """(values, counts) of a DDSketch's buckets, zeros included, for describe"""
+    keys = sorted(sketch.buckets)
+    values = [0.0] + [sketch.value(key) for key in keys]
+    counts = [sketch.zero_count] + [sketch.buckets[key] for key in keys]
+    kept = [(v, c) for v, c in zip(values, counts) if c > 0]
+    return [v for v, _ in kept], [c for _, c in kept]
+
+def fraction_below(values, value) -> float:
+    """Fraction of entries strictly lower than value (the "you beat X%" figure)"""
+    if len(values) == 0:
+        return 0.0
+    return float(np.searchsorted(values, value, side="left")) / len(values)
+
+def cdf(values, points) -> list:
+    """Fraction of entries less than or equal to each point"""
+    if len(values) == 0:
+        return [0.0 for _ in points]
+    positions = np.searchsorted(values, np.asarray(points), side="right")
+    return (positions / len(values)).tolist()
+
+class GlobalStats:
+    """Distributions of player best scores, best waves and game durations"""
+
+    def __init__(self):
+        self.best_scores = SortedColumn(np.int64)
+        self.best_waves = SortedColumn(np.int32)
+        self.durations = SortedColumn(np.int32)
+        self.loaded = False
+        self._rebuild_lock = asyncio.Lock()
+        self._summaries = {}  # bins -> (score, wave, duration) summaries since the last rebuild
+
+    async def rebuild(self, players_collection, scores_collection):
+        """Reload every distribution from Mongo"""
+        columns = (self.best_scores, self.best_waves, self.durations)
+        async with self._rebuild_lock:
+            # Everything recorded before this point is already in the reads below
+            for column in columns:
+                column.begin_reload()
+            try:
+                player_columns = {"best_score": np.int64, "best_wave": np.int32}
+                players = await offload.sorted_columns(
+                    iter_column_batches(players_collection, player_columns, filter={"total_games": {"$gt": 0}}),
+                    player_columns
+                )
+                score_columns = {"game_duration": np.int32}
+                scores = await offload.sorted_columns(
+                    iter_column_batches(scores_collection, score_columns), score_columns
+                )
+            except BaseException:
+                for column in columns:
+                    column.abort_reload()
+                raise
+
+            self.best_scores.finish_reload(players["best_score"], presorted=True)
+            self.best_waves.finish_reload(players["best_wave"], presorted=True)
+            self.durations.finish_reload(scores["game_duration"], presorted=True)
+            self._summaries = {}
+            self.loaded = True
+
+    def record_game(self, player: dict, game: dict):
+        """Apply one finished game, given the player document from before it"""
+        score = game.get("final_score", 0)
+        wave = game.get("max_wave", 1)
+        self.durations.add(game.get("game_duration", 0))
+
+        if player.get("total_games", 0) == 0:
+            self.best_scores.add(score)
+            self.best_waves.add(wave)
+            return
+
+        old_best = player.get("best_score", 0)
+        if score > old_best:
+            self.best_scores.replace(old_best, score)
+        old_wave = player.get("best_wave", 1)
+        if wave > old_wave:
+            self.best_waves.replace(old_wave, wave)
+
+    async def _describe_all(self, bins: int) -> tuple:
+        """Summaries of every distribution as of the last rebuild, computed once in the offload pool"""
+        summaries = self._summaries.get(bins)
+        if summaries is None:
+            durations = self.durations.sorted()
+            summaries = tuple(await asyncio.gather(
+                *(
+                    offload.run(describe, values, bins=bins, size=len(values))
+                    for values in (self.best_scores.sorted(), self.best_waves.sorted())
+                ),
+                offload.run(
+                    describe, durations, bins=bins, extra=sketch_points(archived_scores.durations),
+                    size=len(durations)
+                ),
+            ))
+            self._summaries[bins] = summaries
+        return summaries
+
+    async def summary(self, score: int = None, bins: int = 20):
+        """Percentiles and histograms for every distribution, plus the rank of a score"""
+        score_stats, wave_stats, duration_stats = await self._describe_all(bins)
+        scores = self.best_scores.sorted()
+        result = {
+            "total_players": int(len(scores)),
+            "score": score_stats,
+            "wave": wave_stats,
+            "game_duration": duration_stats,
+            "score_beaten_fraction": None,
+        }
+        if score is not None:
+            result["score_beaten_fraction"] = fraction_below(scores, score)
+        return result
+
+    def score_cdf(self, points) -> list:
+        return cdf(self.best_scores.sorted(), points)
+
+global_stats = GlobalStats()
+
+async def global_stats_refresh_loop(players_collection, scores_collection,
+                                    interval: int = STATS_REBUILD_INTERVAL):
+    """Rebuild the global distributions on a fixed interval"""
+    while True:
+        try:
+            await global_stats.rebuild(players_collection, scores_collection)
+        except Exception:
+            logger.exception("Global stats rebuild failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,247 @@
+"""Clan and friend leaderboards maintained on write
+
+A group document holds its member ids and its board: one entry per member
+(their best game), kept sorted by score::
+
+    {id, name, kind, owner_id, member_count, created_at,
+     members: [player_id, ...],
+     board: [{player_id, player_username, score, wave, game_duration, created_at}, ...]}
+
+``record_group_score`` fans a finished game out to every group the player
+belongs to (found through the multikey ``members`` index) with one
+``bulk_write`` of two ``UpdateMany`` operations, however many groups that
+is. ``end_game`` calls it inline; with ``PROJECTION_MODE=stream`` or
+``queue`` the projection worker or the ``game_end`` job does, through
+``record_group_games``. A member's entry is only ever replaced by a higher score, and only while
+they are still a member, so replays and concurrent leaves are harmless.
+
+A member who joins with their best game already archived enters with the
+all-time bests on their player document instead.
+
+Reading a board costs O(group size) whatever the size of ``scores``; hot
+boards are served from an in-process LRU for ``GROUP_BOARD_CACHE_TTL``
+seconds (writes made by this worker drop the entry at once).
+
+Friend lists are groups too: ``friends:<player_id>`` holds the player and
+their friends, and befriending adds each player to the other's group.
+"""
+import os
+
+from pymongo import DESCENDING, UpdateMany
+from pymongo.errors import DuplicateKeyError
+
+from database import groups_collection, players_collection, scores_collection
+from models import Group, GROUP_PROJECTION, LEADERBOARD_ENTRY_PROJECTION
+from player_cache import LRUCache, MISSING
+from singleflight import read_coalescer
+
+GROUP_MAX_MEMBERS = int(os.environ.get("GROUP_MAX_MEMBERS", "500"))
+GROUP_BOARD_CACHE_SIZE = int(os.environ.get("GROUP_BOARD_CACHE_SIZE", "1000"))
+GROUP_BOARD_CACHE_TTL = float(os.environ.get("GROUP_BOARD_CACHE_TTL", "5"))
+
+BOARD_ENTRY_FIELDS = [field for field in LEADERBOARD_ENTRY_PROJECTION if field != "_id"]
+BEST_GAME_PROJECTION = {
+    "_id": 0, "username": 1, "best_score": 1, "best_wave": 1, "longest_game": 1,
+    "last_played": 1, "created_at": 1,
+}
+
+class GroupFullError(Exception):
+    """The group already has GROUP_MAX_MEMBERS members"""
+
+def friend_group_id(player_id: str) -> str:
+    return f"friends:{player_id}"
+
+def _board_entry(score: dict) -> dict:
+    return {field: score[field] for field in BOARD_ENTRY_FIELDS}
+
+def _board_updates(entry: dict):
+    """($pull, $push) pair that keeps only the member's best entry, sorted"""
+    player_id = entry["player_id"]
+    pull = {"$pull": {"board": {"player_id": player_id, "score": {"$lt": entry["score"]}}}}
+    push = {"$push": {"board": {"$each": [entry], "$sort": {"score": -1}}}}
+    return pull, push
+
+async def _best_entry(player_id: str):
+    """The player's best game as a board entry, or None if they never finished one"""
+    score = await scores_collection.find_one(
+        {"player_id": player_id}, LEADERBOARD_ENTRY_PROJECTION, sort=[("score", DESCENDING)]
+    )
+    player = await players_collection.find_one({"id": player_id}, BEST_GAME_PROJECTION)
+    if not player or score and score["score"] >= player.get("best_score", 0):
+        return _board_entry(score) if score else None
+    if not player.get("best_score"):
+        return None
+    # The best game has been archived: the player document keeps the all-time bests
+    return {
+        "player_id": player_id,
+        "player_username": player["username"],
+        "score": player["best_score"],
+        "wave": player.get("best_wave", 1),
+        "game_duration": player.get("longest_game", 0),
+        "created_at": player.get("last_played") or player["created_at"],
+    }
+
+class GroupBoardCache:
+    """Recently read boards, keyed by group id"""
+
+    def __init__(self, max_size: int = GROUP_BOARD_CACHE_SIZE, ttl: float = GROUP_BOARD_CACHE_TTL):
+        self._cache = LRUCache(max_size, ttl, ttl)
+
+    async def get(self, group_id: str):
+        """The group's board, or None if the group does not exist"""
+        board = self._cache.get(group_id)
+        if board is None:
+            group = await read_coalescer.do(
+                ("group_board", group_id),
+                lambda: groups_collection.find_one({"id": group_id}, {"_id": 0, "board": 1})
+            )
+            board = group.get("board", []) if group else MISSING
+            self._cache.set(group_id, board)
+        return None if board is MISSING else board
+
+    def invalidate(self, group_id: str):
+        self._cache.invalidate(group_id)
+
+group_boards = GroupBoardCache()
+
+async def create_group(name: str, owner_id: str, group_id: str = None, kind: str = "clan"):
+    """Create a group whose first member is its owner"""
+    group = Group(name=name, owner_id=owner_id, kind=kind, member_count=1)
+    if group_id:
+        group.id = group_id
+    entry = await _best_entry(owner_id)
+    await groups_collection.insert_one({
+        **group.dict(),
+        "members": [owner_id],
+        "board": [entry] if entry else [],
+    })
+    group_boards.invalidate(group.id)
+    return group.dict()
+
+async def get_group(group_id: str):
+    return await groups_collection.find_one({"id": group_id}, GROUP_PROJECTION)
+
+async def get_player_groups(player_id: str, kind: str = "clan"):
+    """Groups of a kind the player belongs to"""
+    return await groups_collection.find(
+        {"members": player_id, "kind": kind}, GROUP_PROJECTION
+    ).to_list(length=None)
+
+async def add_member(group_id: str, player_id: str):
+    """Add a player and their best game to a group
+
+    Returns the group (unchanged if they already belong to it), None if the
+    group does not exist, and raises GroupFullError when the group is full.
+    """
+    result = await groups_collection.update_one(
+        {"id": group_id, "members": {"$ne": player_id}, "member_count": {"$lt": GROUP_MAX_MEMBERS}},
+        {"$push": {"members": player_id}, "$inc": {"member_count": 1}}
+    )
+    if not result.matched_count:
+        group = await get_group(group_id)
+        if group and not await groups_collection.find_one({"id": group_id, "members": player_id}, {"_id": 1}):
+            raise GroupFullError(f"Group is full ({GROUP_MAX_MEMBERS} members)")
+        return group
+
+    entry = await _best_entry(player_id)
+    if entry:
+        pull, push = _board_updates(entry)
+        await groups_collection.update_one({"id": group_id, "members": player_id}, pull)
+        await groups_collection.update_one(
+            {"id": group_id, "members": player_id, "board.player_id": {"$ne": player_id}}, push
+        )
+    group_boards.invalidate(group_id)
+    return await get_group(group_id)
+
+async def remove_member(group_id: str, player_id: str):
+    """Remove a player and their board entry; None if the group does not exist"""
+    await groups_collection.update_one(
+        {"id": group_id, "members": player_id},
+        {"$pull": {"members": player_id, "board": {"player_id": player_id}},
+         "$inc": {"member_count": -1}}
+    )
+    group_boards.invalidate(group_id)
+    return await get_group(group_id)
+
+async def _ensure_friend_group(player_id: str):
+    group_id = friend_group_id(player_id)
+    if await groups_collection.find_one({"id": group_id}, {"_id": 1}):
+        return
+    try:
+        await create_group("friends", player_id, group_id=group_id, kind="friends")
+    except DuplicateKeyError:
+        pass  # Created concurrently
+
+async def add_friend(player_id: str, friend_id: str):
+    """Befriend two players, adding each to the other's friend board"""
+    await _ensure_friend_group(player_id)
+    await _ensure_friend_group(friend_id)
+    group = await add_member(friend_group_id(player_id), friend_id)
+    try:
+        await add_member(friend_group_id(friend_id), player_id)
+    except GroupFullError:
+        await remove_member(friend_group_id(player_id), friend_id)
+        raise
+    return group
+
+async def remove_friend(player_id: str, friend_id: str):
+    group = await remove_member(friend_group_id(player_id), friend_id)
+    await remove_member(friend_group_id(friend_id), player_id)
+    return group
+
+async def record_group_score(score: dict):
+    """Fan a finished game out to the boards of every group the player is in"""
+    player_id = score["player_id"]
+    group_ids = [
+        group["id"]
+        async for group in groups_collection.find({"members": player_id}, {"_id": 0, "id": 1})
+    ]
+    if not group_ids:
+        return
+
+    pull, push = _board_updates(_board_entry(score))
+    members_filter = {"id": {"$in": group_ids}, "members": player_id}
+    await groups_collection.bulk_write([
+        UpdateMany(members_filter, pull),
+        UpdateMany({**members_filter, "board.player_id": {"$ne": player_id}}, push),
+    ], ordered=True)
+    for group_id in group_ids:
+        group_boards.invalidate(group_id)
+
+async def record_group_games(game_ids: list):
+    """record_group_score for the scores of these games, for the off-request consumers"""
+    async for score in scores_collection.find(
+        {"game_session_id": {"$in": game_ids}}, LEADERBOARD_ENTRY_PROJECTION
+    ):
+        await record_group_score(score)
+
+async def get_group_leaderboard(group_id: str, limit: int = 10, skip: int = 0, player_id: str = None):
+    """A page of the group's board plus the player's rank in it; None if no such group"""
+    board = await group_boards.get(group_id)
+    if board is None:
+        return None
+
+    # Tied scores share a rank, as on the global board
+    ranks = []
+    for idx, entry in enumerate(board):
+        tied = idx and entry["score"] == board[idx - 1]["score"]
+        ranks.append(ranks[-1] if tied else idx + 1)
+
+    user_rank = None
+    user_best_score = None
+    if player_id:
+        for rank, entry in zip(ranks, board):
+            if entry["player_id"] == player_id:
+                user_rank, user_best_score = rank, entry["score"]
+                break
+
+    return {
+        "entries": [
+            {"rank": rank, **entry}
+            for rank, entry in zip(ranks[skip:skip + limit], board[skip:skip + limit])
+        ],
+        "total_entries": len(board),
+        "user_rank": user_rank,
+        "user_best_score": user_best_score,
+        "user_rank_exact": True if user_rank is not None else None,
+    }
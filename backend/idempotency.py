@@ -0,0 +1,144 @@
+"""Idempotency-Key handling for non-repeatable POST endpoints
+
+A client that retries a request with the same ``Idempotency-Key`` header
+gets the stored response of the first attempt instead of running it again.
+
+* Completed responses are kept in ``idempotency_keys`` (expired by a TTL
+  index after ``IDEMPOTENCY_TTL`` seconds) and in a small in-process LRU
+  cache, so a replay is answered with at most one lookup.
+* The first request claims the key by inserting an ``in_progress`` record.
+  Concurrent duplicates in the same process await the first request's
+  future; duplicates in other processes poll the record until it completes.
+  A claim whose holder died is taken over once its lease expires.
+* If the request fails, the claim is released so the client can retry.
+* Reusing a key with a different request body is rejected with 422.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from player_cache import LRUCache
+
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", str(24 * 3600)))
+IDEMPOTENCY_LEASE = float(os.environ.get("IDEMPOTENCY_LEASE", "30"))
+IDEMPOTENCY_POLL_INTERVAL = float(os.environ.get("IDEMPOTENCY_POLL_INTERVAL", "0.05"))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_CACHE_TTL = float(os.environ.get("IDEMPOTENCY_CACHE_TTL", "600"))
+
+async def init_idempotency_indexes(keys_collection):
+    await keys_collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=IDEMPOTENCY_TTL)
+
+def request_fingerprint(body) -> str:
+    return hashlib.sha256(
+        json.dumps(jsonable_encoder(body), sort_keys=True).encode()
+    ).hexdigest()
+
+class IdempotencyStore:
+    """Runs each (scope, key) at most once and replays its response"""
+
+    def __init__(self):
+        self._cache = LRUCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_CACHE_TTL, IDEMPOTENCY_CACHE_TTL)
+        self._inflight = {}
+
+    async def run(self, keys_collection, scope: str, key, body, fn):
+        """Return fn()'s JSON-encoded result, running it only for the first request"""
+        if not key:
+            return await fn()
+
+        record_id = f"{scope}:{key}"
+        fingerprint = request_fingerprint(body)
+        cached = self._cache.get(record_id)
+        if cached is not None:
+            return self._replay(cached, fingerprint)
+
+        inflight = self._inflight.get(record_id)
+        if inflight is not None:
+            record = await asyncio.shield(inflight)
+            return self._replay(record, fingerprint)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[record_id] = future
+        try:
+            record = await self._execute(keys_collection, record_id, fingerprint, fn)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Waiters re-raise it; don't warn if there are none
+            raise
+        else:
+            future.set_result(record)
+        finally:
+            del self._inflight[record_id]
+        self._cache.set(record_id, record)
+        return self._replay(record, fingerprint)
+
+    @staticmethod
+    def _check_fingerprint(record: dict, fingerprint: str):
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used with a different request"
+            )
+
+    def _replay(self, record: dict, fingerprint: str):
+        self._check_fingerprint(record, fingerprint)
+        return record["response"]
+
+    async def _claim(self, keys_collection, record_id: str, fingerprint: str):
+        """Insert (or take over an expired) claim
+
+        Returns (True, None) when claimed, else (False, current record or None).
+        """
+        now = datetime.utcnow()
+        try:
+            await keys_collection.insert_one({
+                "_id": record_id,
+                "status": "in_progress",
+                "fingerprint": fingerprint,
+                "locked_until": now + timedelta(seconds=IDEMPOTENCY_LEASE),
+                "created_at": now,
+            })
+            return True, None
+        except DuplicateKeyError:
+            pass
+        taken_over = await keys_collection.find_one_and_update(
+            {"_id": record_id, "status": "in_progress", "locked_until": {"$lt": now}},
+            {"$set": {"fingerprint": fingerprint,
+                      "locked_until": now + timedelta(seconds=IDEMPOTENCY_LEASE)}},
+            return_document=ReturnDocument.AFTER
+        )
+        if taken_over:
+            return True, None
+        return False, await keys_collection.find_one({"_id": record_id})
+
+    async def _execute(self, keys_collection, record_id: str, fingerprint: str, fn):
+        while True:
+            claimed, existing = await self._claim(keys_collection, record_id, fingerprint)
+            if claimed:
+                break
+            if existing:
+                self._check_fingerprint(existing, fingerprint)
+                if existing["status"] == "done":
+                    return existing
+            # Another worker is running it (or just released it); try again shortly
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+        try:
+            response = jsonable_encoder(await fn())
+        except BaseException:
+            await keys_collection.delete_one({"_id": record_id, "status": "in_progress"})
+            raise
+        record = {"fingerprint": fingerprint, "response": response}
+        await keys_collection.update_one(
+            {"_id": record_id},
+            {"$set": {"status": "done", "response": response}, "$unset": {"locked_until": ""}}
+        )
+        return record
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,260 @@
+"""Compact storage for UUID id fields
+
+Models generate ids as 36-character UUID strings. With ``ID_STORAGE=binary``
+the ``id``/``player_id``/``game_session_id`` fields are stored as 16-byte
+BSON UUIDs (binary subtype 4) instead, which roughly halves the size of
+every index built on them. Collections are wrapped so filters, inserts and
+updates are encoded on the way in and results decoded on the way out; the
+rest of the code keeps working with strings.
+
+Existing data is converted online with ``python manage.py migrate-ids``.
+``ID_DUAL_READ=1`` makes every wrapped lookup match both representations
+and works with either ``ID_STORAGE``: writes use the configured one, reads
+decode both. Roll out in this order:
+
+1. Restart every worker with ``ID_DUAL_READ=1`` (storage still ``string``).
+2. Run ``migrate-ids``; it refuses to start without ``ID_DUAL_READ=1``.
+3. Restart every worker with ``ID_STORAGE=binary``, keeping dual read.
+4. Run ``migrate-ids`` again for the strings written during step 2.
+5. Drop ``ID_DUAL_READ`` and restart.
+"""
+import os
+import uuid
+
+from bson.binary import Binary, UUID_SUBTYPE
+from bson.raw_bson import RawBSONDocument
+from pymongo import UpdateOne
+
+ID_STORAGE = os.environ.get("ID_STORAGE", "string")
+ID_DUAL_READ = os.environ.get("ID_DUAL_READ", "0") == "1"
+ID_FIELDS = ("id", "player_id", "game_session_id")
+
+def encode_id(value):
+    """Convert an API id string to its stored form"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return Binary.from_uuid(uuid.UUID(value))
+    except ValueError:
+        return value  # Not a UUID (e.g. a bad id from a client): leave as is
+
+def decode_id(value):
+    """Convert a stored id back to its API string"""
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return str(value.as_uuid())
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+def stored_id(value):
+    """An id as it is written under the current ID_STORAGE
+
+    For documents written without the collection wrapper (bulk_write).
+    """
+    return encode_id(value) if ID_STORAGE == "binary" else value
+
+def _id_forms(value) -> list:
+    """Every stored form a lookup of this id should match"""
+    stored = stored_id(value)
+    if not ID_DUAL_READ:
+        return [stored]
+    other = value if stored is not value else encode_id(value)
+    return [stored] if other is stored else [stored, other]
+
+def match_id(value):
+    """Filter value matching an id under the current ID_STORAGE and ID_DUAL_READ
+
+    For operations the collection wrapper does not translate (bulk_write).
+    """
+    forms = _id_forms(value)
+    return forms[0] if len(forms) == 1 else {"$in": forms}
+
+def _encode_id_condition(op: str, operand):
+    if isinstance(operand, list):
+        return op, [form for value in operand for form in _id_forms(value)]
+    forms = _id_forms(operand)
+    if len(forms) == 1:
+        return op, forms[0]
+    if op in ("$eq", "$ne"):
+        return {"$eq": "$in", "$ne": "$nin"}[op], forms
+    return op, forms[0]
+
+def encode_filter(query):
+    """Encode id values in a query filter, including $in/$eq/$ne and $and/$or"""
+    if not isinstance(query, dict):
+        return query
+    encoded = {}
+    for key, value in query.items():
+        if key in ("$and", "$or", "$nor"):
+            encoded[key] = [encode_filter(part) for part in value]
+        elif key in ID_FIELDS:
+            if isinstance(value, dict):
+                encoded[key] = dict(_encode_id_condition(op, operand) for op, operand in value.items())
+            else:
+                encoded[key] = match_id(value)
+        else:
+            encoded[key] = value
+    return encoded
+
+def encode_doc(doc: dict) -> dict:
+    """Encode the id fields of a document being written"""
+    if not isinstance(doc, dict):
+        return doc
+    return {key: stored_id(value) if key in ID_FIELDS else value for key, value in doc.items()}
+
+def encode_update(update):
+    """Encode id fields inside update operators ($set, $setOnInsert, ...)"""
+    if isinstance(update, list):  # Aggregation pipeline update
+        return update
+    return {op: encode_doc(fields) if op.startswith("$") else fields for op, fields in update.items()}
+
+def decode_doc(doc):
+    """Decode the id fields of a document read back"""
+    if not isinstance(doc, dict):
+        return doc
+    for key in ID_FIELDS:
+        if key in doc:
+            doc[key] = decode_id(doc[key])
+    return doc
+
+def encode_pipeline(pipeline: list) -> list:
+    return [
+        {"$match": encode_filter(stage["$match"])} if "$match" in stage else stage
+        for stage in pipeline
+    ]
+
+class IdCodecCursor:
+    """Cursor proxy that decodes id fields of each document"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, *args):
+        self._cursor = self._cursor.skip(*args)
+        return self
+
+    def limit(self, *args):
+        self._cursor = self._cursor.limit(*args)
+        return self
+
+    def batch_size(self, *args):
+        self._cursor = self._cursor.batch_size(*args)
+        return self
+
+    async def to_list(self, length=None):
+        return [decode_doc(doc) for doc in await self._cursor.to_list(length=length)]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return decode_doc(await self._cursor.__anext__())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class IdCodecCollection:
+    """Collection proxy converting id fields between API strings and BSON UUIDs"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    @property
+    def name(self):
+        return self._collection.name
+
+    def with_options(self, **kwargs):
+        options = self._collection.with_options(**kwargs)
+        codec_options = kwargs.get("codec_options")
+        if codec_options and codec_options.document_class is RawBSONDocument:
+            # Raw readers decode ids themselves (see decode_id)
+            return options
+        return IdCodecCollection(options)
+
+    async def find_one(self, filter=None, *args, **kwargs):
+        return decode_doc(await self._collection.find_one(encode_filter(filter or {}), *args, **kwargs))
+
+    def find(self, filter=None, *args, **kwargs):
+        return IdCodecCursor(self._collection.find(encode_filter(filter or {}), *args, **kwargs))
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        return IdCodecCursor(self._collection.aggregate(encode_pipeline(pipeline), *args, **kwargs))
+
+    async def count_documents(self, filter, *args, **kwargs):
+        return await self._collection.count_documents(encode_filter(filter), *args, **kwargs)
+
+    async def insert_one(self, document, *args, **kwargs):
+        return await self._collection.insert_one(encode_doc(document), *args, **kwargs)
+
+    async def insert_many(self, documents, *args, **kwargs):
+        return await self._collection.insert_many([encode_doc(doc) for doc in documents], *args, **kwargs)
+
+    async def update_one(self, filter, update, *args, **kwargs):
+        return await self._collection.update_one(encode_filter(filter), encode_update(update), *args, **kwargs)
+
+    async def replace_one(self, filter, replacement, *args, **kwargs):
+        return await self._collection.replace_one(encode_filter(filter), encode_doc(replacement), *args, **kwargs)
+
+    async def update_many(self, filter, update, *args, **kwargs):
+        return await self._collection.update_many(encode_filter(filter), encode_update(update), *args, **kwargs)
+
+    async def delete_one(self, filter, *args, **kwargs):
+        return await self._collection.delete_one(encode_filter(filter), *args, **kwargs)
+
+    async def delete_many(self, filter, *args, **kwargs):
+        return await self._collection.delete_many(encode_filter(filter), *args, **kwargs)
+
+    async def find_one_and_update(self, filter, update, *args, **kwargs):
+        return decode_doc(await self._collection.find_one_and_update(
+            encode_filter(filter), encode_update(update), *args, **kwargs
+        ))
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+def id_codec(collection):
+    """Wrap a collection for binary id storage or dual read when either is enabled"""
+    if ID_STORAGE == "binary" or ID_DUAL_READ:
+        return IdCodecCollection(collection)
+    return collection
+
+# Collections holding UUID id fields, in migration order
+MIGRATED_COLLECTIONS = ("players", "game_sessions", "scores", "player_achievements", "replays")
+
+async def migrate_collection(collection, batch_size: int = 1000, on_progress=None):
+    """Rewrite string ids of one (unwrapped) collection as BSON UUIDs
+
+    Walks the collection in ``_id`` order with unordered bulk updates, so it
+    can run while the API is serving traffic and be re-run after a failure.
+    """
+    query = {"$or": [{field: {"$type": "string"}} for field in ID_FIELDS]}
+    projection = {field: 1 for field in ID_FIELDS}
+    last_id = None
+    migrated = 0
+    while True:
+        page_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        docs = await collection.find(page_query, projection).sort("_id", 1).limit(
+            batch_size
+        ).to_list(length=batch_size)
+        if not docs:
+            return migrated
+        last_id = docs[-1]["_id"]
+
+        operations = []
+        for doc in docs:
+            changes = {
+                field: encode_id(doc[field])
+                for field in ID_FIELDS
+                if isinstance(doc.get(field), str) and not isinstance(encode_id(doc[field]), str)
+            }
+            if changes:
+                operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": changes}))
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            migrated += result.modified_count
+        if on_progress:
+            on_progress(migrated)
@@ -0,0 +1,136 @@
+"""Durable job queue on a Mongo collection
+
+Jobs are documents in ``jobs``::
+
+    {key, kind, payload, status, attempts, run_after, locked_until,
+     result, error, created_at, updated_at}
+
+``key`` is unique, so enqueueing the same work twice is a no-op. Workers
+claim a job atomically with ``find_one_and_update`` and hold it for
+``JOB_LEASE_SECONDS``; a job whose worker died is claimed again once the
+lease runs out. Failed jobs are retried with exponential backoff up to
+``JOB_MAX_ATTEMPTS`` times, then left as ``failed`` with the error.
+Handlers must therefore be safe to run more than once.
+
+``run_job_workers`` runs a pool of ``JOB_CONCURRENCY`` claim loops in the
+current process: inside the API when ``PROJECTION_MODE=queue``, or as a
+dedicated process via ``python manage.py jobs``.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "8"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "60"))
+JOB_RETRY_BASE_DELAY = float(os.environ.get("JOB_RETRY_BASE_DELAY", "1"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "0.5"))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", str(7 * 24 * 3600)))
+
+JOB_PROJECTION = {"_id": 0, "key": 1, "kind": 1, "status": 1, "attempts": 1, "result": 1, "error": 1}
+
+async def init_job_indexes(jobs_collection):
+    await jobs_collection.create_index([("key", ASCENDING)], unique=True)
+    await jobs_collection.create_index([("status", ASCENDING), ("run_after", ASCENDING)])
+    await jobs_collection.create_index(
+        [("finished_at", ASCENDING)], expireAfterSeconds=JOB_RESULT_TTL
+    )
+
+async def enqueue(jobs_collection, kind: str, key: str, payload: dict):
+    """Queue a job unless one with the same key already exists"""
+    now = datetime.utcnow()
+    try:
+        await jobs_collection.update_one(
+            {"key": key},
+            {"$setOnInsert": {
+                "key": key,
+                "kind": kind,
+                "payload": payload,
+                "status": "queued",
+                "attempts": 0,
+                "run_after": now,
+                "created_at": now,
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        pass  # Lost an upsert race with an identical enqueue
+
+async def get_job(jobs_collection, key: str):
+    return await jobs_collection.find_one({"key": key}, JOB_PROJECTION)
+
+async def claim(jobs_collection, kinds: list):
+    """Take the oldest runnable job (or one whose lease expired)"""
+    now = datetime.utcnow()
+    return await jobs_collection.find_one_and_update(
+        {
+            "kind": {"$in": kinds},
+            "$or": [
+                {"status": "queued", "run_after": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lt": now}},
+            ],
+        },
+        {
+            "$set": {
+                "status": "running",
+                "locked_until": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "updated_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_after", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def _finish(jobs_collection, job: dict, result):
+    now = datetime.utcnow()
+    await jobs_collection.update_one(
+        {"_id": job["_id"], "status": "running"},
+        {"$set": {"status": "done", "result": result, "updated_at": now, "finished_at": now}}
+    )
+
+async def _fail(jobs_collection, job: dict, error: Exception):
+    now = datetime.utcnow()
+    if job["attempts"] < JOB_MAX_ATTEMPTS:
+        delay = JOB_RETRY_BASE_DELAY * 2 ** (job["attempts"] - 1)
+        update = {"status": "queued", "run_after": now + timedelta(seconds=delay)}
+    else:
+        update = {"status": "failed", "finished_at": now}
+    await jobs_collection.update_one(
+        {"_id": job["_id"], "status": "running"},
+        {"$set": {**update, "error": str(error), "updated_at": now}}
+    )
+
+async def _worker(jobs_collection, handlers: dict):
+    kinds = list(handlers)
+    while True:
+        try:
+            job = await claim(jobs_collection, kinds)
+        except Exception:
+            logger.exception("Could not claim a job")
+            job = None
+        if job is None:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        try:
+            try:
+                result = await handlers[job["kind"]](job["payload"])
+            except Exception as e:
+                logger.exception("Job %s failed (attempt %d)", job["key"], job["attempts"])
+                await _fail(jobs_collection, job, e)
+            else:
+                await _finish(jobs_collection, job, result)
+        except Exception:
+            # The lease expires and another worker picks the job up again
+            logger.exception("Could not record the outcome of job %s", job["key"])
+
+async def run_job_workers(jobs_collection, handlers: dict, concurrency: int = JOB_CONCURRENCY):
+    """Process jobs of the given kinds with a bounded pool of workers"""
+    await asyncio.gather(*(_worker(jobs_collection, handlers) for _ in range(concurrency)))
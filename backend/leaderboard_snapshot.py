@@ -0,0 +1,508 @@
+"""Leaderboard and catalog snapshot shared by every worker through mmap
+
+One worker (whoever holds the file lock) writes a fixed-layout snapshot
+file and swaps it in atomically with ``os.replace``. Every worker maps the
+file read-only and serves ranks, leaderboard pages and the achievement
+catalog from NumPy views over the mapping, so the page cache holds a single
+copy however many workers run.
+
+``end_game`` appends each new score as one fixed-size record to a journal
+file beside the snapshot (``O_APPEND``, so workers never interleave). Every
+worker reads the journal records written after its mapped snapshot and
+overlays them (``LiveSnapshot``): ranks add the overlaid scores above,
+the top entries are re-cut from the mapped ones plus the records, so only
+the changed ranks are touched. The writer folds the journal tail into a new
+snapshot file once it reaches ``LEADERBOARD_SNAPSHOT_FOLD_RECORDS`` records,
+which bounds the overlay, without touching Mongo.
+
+Changes that are not new scores (archiving, player rebuilds) mark the
+snapshot dirty instead, and the writer rereads everything from Mongo, at
+most once per ``LEADERBOARD_SNAPSHOT_FULL_REBUILD_INTERVAL`` (or when the
+journal outgrows ``LEADERBOARD_JOURNAL_MAX_BYTES``). A full rebuild starts a
+new journal epoch; scores recorded while it reads can be counted twice in
+the rank totals until the next one, but never appear twice on the board.
+Sorting and encoding happen in the offload process pool.
+
+The snapshot records how far into the journal it has folded, and the
+overlay how far it has read. A worker serves the leaderboard only once the
+overlay includes that worker's own latest score (``fresh``), and reads
+Mongo until then, so a player sees their game right after ``end_game``.
+
+File layout (little-endian, every section 8-byte aligned)::
+
+    header    magic, version, generation, built_at, counts, catalog size,
+              journal epoch and offset applied
+    scores    int64[n_scores]        every score, ascending
+    entries   ENTRY_DTYPE[n_entries] top rows, best first
+    players   PLAYER_DTYPE[n_players] player id -> best score, sorted by id
+    catalog   JSON achievement catalog
+
+Journal layout: a ``JOURNAL_HEADER`` (magic, epoch) then ENTRY_DTYPE records.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import offload
+from bulk_reads import iter_column_batches, read_columns
+from ids import decode_id
+from models import LEADERBOARD_ENTRY_PROJECTION, ACHIEVEMENT_CATALOG_PROJECTION
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SNAPSHOT_PATH = os.environ.get(
+    "LEADERBOARD_SNAPSHOT_PATH", os.path.join(_DEFAULT_DIR, "cosmic_defender_leaderboard.snap")
+)
+SNAPSHOT_TOP_ENTRIES = int(os.environ.get("LEADERBOARD_SNAPSHOT_TOP_ENTRIES", "1000"))
+SNAPSHOT_REBUILD_INTERVAL = float(os.environ.get("LEADERBOARD_SNAPSHOT_REBUILD_INTERVAL", "1"))
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("LEADERBOARD_SNAPSHOT_CHECK_INTERVAL", "0.5"))
+SNAPSHOT_FULL_REBUILD_INTERVAL = float(os.environ.get("LEADERBOARD_SNAPSHOT_FULL_REBUILD_INTERVAL", "60"))
+SNAPSHOT_FOLD_RECORDS = int(os.environ.get("LEADERBOARD_SNAPSHOT_FOLD_RECORDS", "10000"))
+JOURNAL_MAX_BYTES = int(os.environ.get("LEADERBOARD_JOURNAL_MAX_BYTES", str(16 * 1024 * 1024)))
+
+MAGIC = b"CDLB"
+VERSION = 2
+HEADER = struct.Struct("<4sIQdQQQQQQ")
+HEADER_SIZE = 96
+JOURNAL_MAGIC = b"CDLJ"
+JOURNAL_HEADER = struct.Struct("<4s4xQ")
+ENTRY_DTYPE = np.dtype([
+    ("player_id", "S36"),
+    ("player_username", "S64"),
+    ("score", "<i8"),
+    ("wave", "<i4"),
+    ("game_duration", "<i4"),
+    ("created_at", "<f8"),
+])
+PLAYER_DTYPE = np.dtype([("player_id", "S36"), ("best_score", "<i8")])
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+def _timestamp(value) -> float:
+    if not value:
+        return 0.0
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+def _utf8_prefix(text: str, size: int) -> bytes:
+    """At most size bytes of text's UTF-8, cut on a character boundary"""
+    return text.encode()[:size].decode("utf-8", errors="ignore").encode()
+
+def entry_row(score: dict) -> tuple:
+    """An ENTRY_DTYPE row for a score document"""
+    return (
+        score["player_id"].encode(), _utf8_prefix(score["player_username"], ENTRY_DTYPE["player_username"].itemsize),
+        score["score"], score["wave"], score["game_duration"], _timestamp(score.get("created_at"))
+    )
+
+def encode_snapshot(generation: int, scores, entries, players, catalog: list,
+                    journal_epoch: int = 0, journal_offset: int = 0) -> bytes:
+    """Serialise snapshot sections into the fixed file layout"""
+    scores = np.sort(np.asarray(scores, dtype="<i8"), kind="stable")  # Linear if already sorted
+    players = np.sort(np.asarray(players, dtype=PLAYER_DTYPE), order="player_id")
+    entries = np.asarray(entries, dtype=ENTRY_DTYPE)
+    catalog_bytes = json.dumps(catalog, default=str).encode()
+
+    sections = [scores.tobytes(), entries.tobytes(), players.tobytes(), catalog_bytes]
+    header = HEADER.pack(
+        MAGIC, VERSION, generation, time.time(),
+        len(scores), len(entries), len(players), len(catalog_bytes), journal_epoch, journal_offset
+    )
+    out = bytearray(header.ljust(HEADER_SIZE, b"\0"))
+    for section in sections:
+        out.extend(b"\0" * (_align(len(out)) - len(out)))
+        out.extend(section)
+    return bytes(out)
+
+def top_entries(entries, limit: int = SNAPSHOT_TOP_ENTRIES):
+    """Best first (earliest first among ties), without repeated rows, cut to limit"""
+    order = np.lexsort((entries["player_id"], entries["created_at"], -entries["score"]))
+    entries = entries[order]
+    key = entries[["player_id", "score", "created_at"]]
+    keep = np.ones(len(entries), dtype=bool)
+    keep[1:] = key[1:] != key[:-1]
+    return entries[keep][:limit]
+
+def page_rows(entries, skip: int, limit: int) -> list:
+    """Leaderboard rows for one page of ENTRY_DTYPE entries, best first"""
+    return [
+        {
+            "rank": skip + idx + 1,
+            "player_id": row["player_id"].decode(),
+            "player_username": row["player_username"].decode(errors="ignore"),
+            "score": int(row["score"]),
+            "wave": int(row["wave"]),
+            "game_duration": int(row["game_duration"]),
+            "created_at": datetime.utcfromtimestamp(row["created_at"]),
+        }
+        for idx, row in enumerate(entries[skip:skip + limit])
+    ]
+
+def patch_snapshot(generation: int, scores, entries, players, catalog: list, records,
+                   journal_epoch: int, journal_offset: int) -> bytes:
+    """encode_snapshot of a snapshot's sections with journal records merged in"""
+    new_scores = np.sort(records["score"])
+    scores = np.insert(scores, np.searchsorted(scores, new_scores, side="right"), new_scores)
+    entries = top_entries(np.concatenate([entries, records]))
+
+    best = {}
+    for player_id, score in zip(records["player_id"], records["score"]):
+        best[player_id] = max(score, best.get(player_id, score))
+    players = np.array(players)
+    idx = np.searchsorted(players["player_id"], list(best))
+    known = [i < len(players) and players["player_id"][i] == player_id for i, player_id in zip(idx, best)]
+    added = []
+    for i, is_known, (player_id, score) in zip(idx, known, best.items()):
+        if is_known:
+            players["best_score"][i] = max(players["best_score"][i], score)
+        else:
+            added.append((player_id, score))
+    if added:
+        players = np.concatenate([players, np.array(added, dtype=PLAYER_DTYPE)])
+
+    return encode_snapshot(generation, scores, entries, players, catalog, journal_epoch, journal_offset)
+
+class Snapshot:
+    """Zero-copy read view over one mapped snapshot file"""
+
+    def __init__(self, buffer):
+        (magic, version, self.generation, self.built_at, n_scores, n_entries,
+         n_players, catalog_size, self.journal_epoch, self.journal_offset) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a leaderboard snapshot")
+
+        offset = HEADER_SIZE
+        self.scores = np.frombuffer(buffer, dtype="<i8", count=n_scores, offset=offset)
+        offset = _align(offset + self.scores.nbytes)
+        self.entries = np.frombuffer(buffer, dtype=ENTRY_DTYPE, count=n_entries, offset=offset)
+        offset = _align(offset + self.entries.nbytes)
+        self.players = np.frombuffer(buffer, dtype=PLAYER_DTYPE, count=n_players, offset=offset)
+        offset = _align(offset + self.players.nbytes)
+        self._catalog_bytes = memoryview(buffer)[offset:offset + catalog_size]
+        self._catalog = None
+
+    @property
+    def total_scores(self) -> int:
+        return len(self.scores)
+
+    def best_score(self, player_id: str):
+        key = player_id.encode()
+        idx = np.searchsorted(self.players["player_id"], key)
+        if idx < len(self.players) and self.players["player_id"][idx] == key:
+            return int(self.players["best_score"][idx])
+        return None
+
+    def rank(self, score: int) -> int:
+        """1 + number of scores strictly higher than score"""
+        return len(self.scores) - int(np.searchsorted(self.scores, score, side="right")) + 1
+
+    def can_serve_page(self, skip: int, limit: int) -> bool:
+        return skip + limit <= len(self.entries) or len(self.entries) == len(self.scores)
+
+    def page(self, skip: int, limit: int) -> list:
+        return page_rows(self.entries, skip, limit)
+
+    def catalog(self) -> list:
+        if self._catalog is None:
+            self._catalog = json.loads(bytes(self._catalog_bytes))
+        return self._catalog
+
+class LiveSnapshot:
+    """A mapped snapshot with the journal records written after it overlaid"""
+
+    def __init__(self, base: Snapshot):
+        self.base = base
+        self.generation = base.generation
+        self.journal_epoch = base.journal_epoch
+        self.journal_offset = max(base.journal_offset, JOURNAL_HEADER.size)
+        self.journal_ok = True
+        self.records = 0
+        self.entries = base.entries
+        self._scores = np.empty(0, dtype="<i8")  # Overlaid scores, ascending
+        self._best = {}  # player id bytes -> best overlaid score
+
+    def extend(self, records, journal_offset: int):
+        """Overlay journal records read up to journal_offset"""
+        new_scores = np.sort(records["score"])
+        self._scores = np.insert(self._scores, np.searchsorted(self._scores, new_scores, side="right"), new_scores)
+        self.entries = top_entries(np.concatenate([self.entries, records]))
+        for player_id, score in zip(records["player_id"].tolist(), records["score"].tolist()):
+            self._best[player_id] = max(score, self._best.get(player_id, score))
+        self.records += len(records)
+        self.journal_offset = journal_offset
+
+    @property
+    def total_scores(self) -> int:
+        return self.base.total_scores + len(self._scores)
+
+    def best_score(self, player_id: str):
+        best = self.base.best_score(player_id)
+        overlaid = self._best.get(player_id.encode())
+        if overlaid is None:
+            return best
+        return overlaid if best is None else max(best, overlaid)
+
+    def rank(self, score: int) -> int:
+        above = len(self._scores) - int(np.searchsorted(self._scores, score, side="right"))
+        return self.base.rank(score) + above
+
+    def can_serve_page(self, skip: int, limit: int) -> bool:
+        return skip + limit <= len(self.entries) or len(self.entries) == self.total_scores
+
+    def page(self, skip: int, limit: int) -> list:
+        return page_rows(self.entries, skip, limit)
+
+    def catalog(self) -> list:
+        return self.base.catalog()
+
+class LeaderboardSnapshot:
+    """Maps the current snapshot file and, in one worker, rebuilds it"""
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self.dirty_path = path + ".dirty"
+        self.lock_path = path + ".lock"
+        self.journal_path = path + ".journal"
+        self._snapshot = None
+        self._file_id = None
+        self._checked_at = 0.0
+        self._lock_file = None
+        self._own_write = None  # (journal epoch, end offset) of this worker's latest score
+
+    def current(self):
+        """Return the latest LiveSnapshot, remapping if the file was replaced and reading new journal records"""
+        now = time.monotonic()
+        if now - self._checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return self._snapshot
+        self._checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._snapshot
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id != self._file_id:
+            try:
+                with open(self.path, "rb") as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # The old mapping is released once no array views remain
+                self._snapshot = LiveSnapshot(Snapshot(buffer))
+                self._file_id = file_id
+            except (OSError, ValueError, struct.error):
+                logger.exception("Could not map leaderboard snapshot")
+        if self._snapshot is not None:
+            self._read_tail(self._snapshot)
+        return self._snapshot
+
+    def _read_tail(self, snapshot: LiveSnapshot):
+        journal = self._read_journal(snapshot.journal_epoch, snapshot.journal_offset)
+        # Not this epoch's journal: a full rebuild has started, and its snapshot follows
+        snapshot.journal_ok = journal is not None
+        if journal and len(journal[0]):
+            snapshot.extend(*journal)
+
+    def fresh(self):
+        """The current snapshot if it includes this worker's latest score, else None"""
+        snapshot = self.current()
+        if self._own_write is None:
+            return snapshot
+        if snapshot is None or (snapshot.journal_epoch, snapshot.journal_offset) < self._own_write:
+            self._checked_at = 0.0  # Read the journal without waiting for the check interval
+            snapshot = self.current()
+        if snapshot is None or (snapshot.journal_epoch, snapshot.journal_offset) < self._own_write:
+            return None
+        self._own_write = None
+        return snapshot
+
+    def _append(self, score: dict) -> bool:
+        """Journal a new score for the writer to patch in; False if there is no journal yet"""
+        record = np.array([entry_row(score)], dtype=ENTRY_DTYPE).tobytes()
+        try:
+            fd = os.open(self.journal_path, os.O_RDWR | os.O_APPEND)
+        except FileNotFoundError:
+            return False
+        try:
+            magic, epoch = JOURNAL_HEADER.unpack(os.pread(fd, JOURNAL_HEADER.size, 0))
+            if magic != JOURNAL_MAGIC:
+                return False
+            os.write(fd, record)
+            self._own_write = (epoch, os.lseek(fd, 0, os.SEEK_CUR))
+        finally:
+            os.close(fd)
+        return True
+
+    def notify_changed(self, score: dict = None):
+        """Tell the writer the leaderboard changed
+
+        Pass the new score when that is the change: it is journaled for
+        every worker to overlay. Anything else makes the writer reread
+        everything.
+        """
+        try:
+            if score is not None and self._append(score):
+                return
+        except (OSError, struct.error):
+            logger.warning("Could not journal score; marking leaderboard snapshot dirty")
+        try:
+            with open(self.dirty_path, "a"):
+                os.utime(self.dirty_path)
+        except OSError:
+            logger.warning("Could not mark leaderboard snapshot dirty")
+
+    def try_become_writer(self) -> bool:
+        if self._lock_file:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def dirty_since(self, built_at: float) -> bool:
+        try:
+            return os.stat(self.dirty_path).st_mtime >= built_at
+        except FileNotFoundError:
+            return built_at == 0.0
+
+    def _start_journal(self, epoch: int):
+        """Replace the journal with an empty one for a new epoch
+
+        Scores appended to the old one after this are already in Mongo, so
+        the full rebuild that follows reads them.
+        """
+        directory = os.path.dirname(self.journal_path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".leaderboard-journal-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, epoch))
+            os.replace(tmp_path, self.journal_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _read_journal(self, epoch: int, offset: int):
+        """(whole records after offset, new offset), or None if the journal is not this epoch's"""
+        try:
+            with open(self.journal_path, "rb") as f:
+                magic, journal_epoch = JOURNAL_HEADER.unpack(f.read(JOURNAL_HEADER.size))
+                if magic != JOURNAL_MAGIC or journal_epoch != epoch:
+                    return None
+                f.seek(offset)
+                data = f.read()
+        except (FileNotFoundError, struct.error):
+            return None
+        count = len(data) // ENTRY_DTYPE.itemsize
+        records = np.frombuffer(data, dtype=ENTRY_DTYPE, count=count)
+        return records, offset + count * ENTRY_DTYPE.itemsize
+
+    def journal_size(self) -> int:
+        try:
+            return os.stat(self.journal_path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _publish(self, data: bytes):
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".leaderboard-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._checked_at = 0.0
+
+    async def patch(self, fold_records: int = SNAPSHOT_FOLD_RECORDS) -> bool:
+        """Fold the journal tail into a new snapshot file once it holds fold_records records
+
+        Returns False if a full rebuild is needed.
+        """
+        live = self.current()
+        if live is None or not live.journal_ok:
+            return False
+        if not live.records or live.records < fold_records:
+            return True
+        snapshot = live.base
+        journal = self._read_journal(snapshot.journal_epoch, max(snapshot.journal_offset, JOURNAL_HEADER.size))
+        if journal is None:
+            return False
+        records, offset = journal
+        data = await offload.run(
+            patch_snapshot, snapshot.generation + 1, np.array(snapshot.scores), np.array(snapshot.entries),
+            np.array(snapshot.players), snapshot.catalog(), records.copy(), snapshot.journal_epoch, offset,
+            size=len(snapshot.scores) + len(snapshot.players)
+        )
+        self._publish(data)
+        return True
+
+    async def rebuild(self, players_collection, scores_collection, achievements_collection):
+        """Read the leaderboard from Mongo and publish a new snapshot file"""
+        current = self.current()
+        generation = current.generation + 1 if current else 1
+        self._start_journal(generation)
+
+        score_columns = {"score": np.int64}
+        scores = await offload.sorted_columns(
+            iter_column_batches(scores_collection, score_columns), score_columns
+        )
+        players = await read_columns(
+            players_collection,
+            {"id": object, "best_score": np.int64},
+            filter={"total_games": {"$gt": 0}}
+        )
+        top = await scores_collection.find({}, LEADERBOARD_ENTRY_PROJECTION).sort(
+            "score", -1
+        ).limit(SNAPSHOT_TOP_ENTRIES).to_list(length=SNAPSHOT_TOP_ENTRIES)
+        catalog = await achievements_collection.find(
+            {}, ACHIEVEMENT_CATALOG_PROJECTION
+        ).to_list(length=None)
+
+        entries = np.array([entry_row(row) for row in top], dtype=ENTRY_DTYPE)
+        player_rows = np.empty(len(players["id"]), dtype=PLAYER_DTYPE)
+        player_rows["player_id"] = [decode_id(player_id).encode() for player_id in players["id"]]
+        player_rows["best_score"] = players["best_score"]
+
+        # Records journaled while reading are overlaid from the new journal
+        data = await offload.run(
+            encode_snapshot, generation, scores["score"], entries, player_rows, catalog,
+            generation, JOURNAL_HEADER.size, size=len(scores["score"]) + len(player_rows)
+        )
+        self._publish(data)
+
+leaderboard_snapshot = LeaderboardSnapshot()
+
+async def leaderboard_snapshot_loop(players_collection, scores_collection, achievements_collection,
+                                    interval: float = SNAPSHOT_REBUILD_INTERVAL,
+                                    full_interval: float = SNAPSHOT_FULL_REBUILD_INTERVAL):
+    """If this worker is the writer, fold in journaled scores and rebuild when marked dirty"""
+    built_at = 0.0
+    while True:
+        try:
+            if leaderboard_snapshot.try_become_writer():
+                started = time.time()
+                full = (
+                    (leaderboard_snapshot.dirty_since(built_at) and started - built_at >= full_interval)
+                    or leaderboard_snapshot.journal_size() > JOURNAL_MAX_BYTES
+                    or not await leaderboard_snapshot.patch()
+                )
+                if full:
+                    await leaderboard_snapshot.rebuild(
+                        players_collection, scores_collection, achievements_collection
+                    )
+                    built_at = started
+        except Exception:
+            logger.exception("Leaderboard snapshot rebuild failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,252 @@
+"""Admin commands for the Cosmic Defender backend
+
+Run from the backend directory, e.g. ``python manage.py migrate-ids``.
+"""
+import asyncio
+import os
+
+import typer
+
+from database import (
+    db, game_sessions_collection, scores_collection,
+    game_sessions_archive_collection, scores_archive_collection, score_archive_stats_collection,
+    players_collection, achievements_collection, player_achievements_collection,
+    achievement_backfills_collection, game_events_collection, event_snapshots_collection,
+    counters_collection, projection_checkpoints_collection, jobs_collection, stat_counters,
+    PROGRESS_FIELDS, backfill_longest_game, backfill_player_updated_at, dedupe_usernames, dedupe_player_achievements, init_indexes
+)
+from ids import ID_DUAL_READ, ID_STORAGE, MIGRATED_COLLECTIONS, migrate_collection
+from archive import (
+    ARCHIVE_DIR, ARCHIVE_SESSION_AGE_DAYS, ARCHIVE_KEEP_TOP_SCORES,
+    archive_sessions, archive_scores, restore_archived, restore_scores
+)
+from achievement_backfill import BACKFILL_BATCH_SIZE, backfill_achievements
+from event_log import take_snapshot, rebuild_player_views
+from leaderboard_snapshot import leaderboard_snapshot
+from projections import PROJECTION_BATCH_SIZE, projection_worker
+from read_routing import check_routing
+from job_queue import JOB_CONCURRENCY, run_job_workers
+from post_game import GAME_JOB_HANDLERS
+
+app = typer.Typer(help="Cosmic Defender admin commands")
+
+@app.command("migrate-ids")
+def migrate_ids(
+    batch_size: int = typer.Option(1000, help="Documents rewritten per bulk write"),
+):
+    """Rewrite UUID string ids as 16-byte BSON UUIDs in every collection
+
+    Every worker must already run with ID_DUAL_READ=1 (see ids.py for the
+    rollout order), or lookups miss the documents this has rewritten.
+    """
+    if not ID_DUAL_READ:
+        typer.echo("❌ Restart every worker with ID_DUAL_READ=1 and run this with it set too", err=True)
+        raise typer.Exit(1)
+
+    async def run():
+        for name in MIGRATED_COLLECTIONS:
+            migrated = await migrate_collection(
+                db[name],
+                batch_size=batch_size,
+                on_progress=lambda count, name=name: typer.echo(f"  {name}: {count} migrated")
+            )
+            typer.echo(f"✅ {name}: {migrated} documents migrated")
+
+    asyncio.run(run())
+    if ID_STORAGE == "binary":
+        typer.echo("Drop ID_DUAL_READ and restart every worker.")
+    else:
+        typer.echo("Restart every worker with ID_STORAGE=binary (keeping ID_DUAL_READ=1), then run this again.")
+
+@app.command("backfill-updated-at")
+def backfill_updated_at():
+    """Stamp players written before updated_at existed, so they join the sync feed (the API also does this at startup)"""
+    stamped = asyncio.run(backfill_player_updated_at())
+    typer.echo(f"✅ {stamped} players stamped")
+
+def _echo_index_failures(failures: dict):
+    for name, error in sorted(failures.items()):
+        typer.echo(f"❌ Index {name} not built: {error}", err=True)
+    if failures:
+        raise typer.Exit(1)
+    typer.echo("✅ All indexes built")
+
+@app.command("dedupe-usernames")
+def dedupe_usernames_command():
+    """Rename players sharing a username, then build the unique username index"""
+    async def run():
+        renamed = await dedupe_usernames()
+        typer.echo(f"✅ {renamed} players renamed")
+        return dict(await init_indexes())
+
+    _echo_index_failures(asyncio.run(run()))
+
+@app.command("dedupe-achievements")
+def dedupe_achievements_command():
+    """Delete repeated unlocks, then build the unique player achievement index"""
+    async def run():
+        removed = await dedupe_player_achievements()
+        typer.echo(f"✅ {removed} repeated unlocks deleted")
+        return dict(await init_indexes())
+
+    _echo_index_failures(asyncio.run(run()))
+
+@app.command("archive")
+def archive(
+    days: int = typer.Option(ARCHIVE_SESSION_AGE_DAYS, help="Archive rows older than this many days"),
+    keep_top: int = typer.Option(ARCHIVE_KEEP_TOP_SCORES, help="Best scores that always stay hot"),
+):
+    """Move old sessions and scores to the compressed cold tier"""
+    async def run():
+        sessions = await archive_sessions(
+            game_sessions_collection, game_sessions_archive_collection, older_than_days=days
+        )
+        typer.echo(f"✅ {sessions} game sessions archived")
+        scores = await archive_scores(
+            scores_collection, scores_archive_collection, score_archive_stats_collection,
+            older_than_days=days, keep_top=keep_top, counters=stat_counters
+        )
+        typer.echo(f"✅ {scores} scores archived")
+        if scores:
+            leaderboard_snapshot.notify_changed()
+
+    asyncio.run(run())
+
+@app.command("restore")
+def restore(
+    month: str = typer.Option(None, help="Only restore rows archived for this month (YYYY-MM)"),
+):
+    """Move archived sessions and scores back to the hot collections
+
+    Raise ARCHIVE_SESSION_AGE_DAYS first, or the next archive run moves them out again.
+    """
+    if ARCHIVE_DIR:
+        typer.echo("❌ Only the Mongo archive collections can be restored; load Parquet files by hand", err=True)
+        raise typer.Exit(1)
+
+    async def run():
+        sessions = await restore_archived(game_sessions_collection, game_sessions_archive_collection, month)
+        typer.echo(f"✅ {sessions} game sessions restored")
+        scores = await restore_scores(
+            scores_collection, scores_archive_collection, score_archive_stats_collection,
+            month=month, counters=stat_counters
+        )
+        typer.echo(f"✅ {scores} scores restored")
+        if scores:
+            leaderboard_snapshot.notify_changed()
+
+    asyncio.run(run())
+
+@app.command("backfill-achievements")
+def backfill(
+    achievement_ids: list[str] = typer.Argument(..., help="Achievement ids to evaluate"),
+    batch_size: int = typer.Option(BACKFILL_BATCH_SIZE, help="Players evaluated per batch"),
+    restart: bool = typer.Option(False, help="Start over instead of resuming an interrupted run"),
+):
+    """Grant achievements to every existing player who already meets them
+
+    First fills longest_game for players from before it was tracked (the
+    API also does this at startup), so duration requirements see them.
+    """
+    async def run():
+        filled = await backfill_longest_game()
+        if filled:
+            typer.echo(f"  longest_game filled for {filled} players")
+        try:
+            job = await backfill_achievements(
+                achievement_ids, players_collection, achievements_collection,
+                player_achievements_collection, achievement_backfills_collection,
+                PROGRESS_FIELDS, batch_size=batch_size, restart=restart, counters=stat_counters,
+                on_progress=lambda processed, unlocked: typer.echo(
+                    f"  {processed} players evaluated, {unlocked} unlocks"
+                )
+            )
+        except ValueError as e:
+            typer.echo(f"❌ {e}", err=True)
+            raise typer.Exit(1)
+        typer.echo(f"✅ {job['processed']} players evaluated, {job['unlocked']} achievements unlocked")
+
+    asyncio.run(run())
+
+@app.command("snapshot-events")
+def snapshot_events(
+    from_players: bool = typer.Option(
+        False, help="Seed the snapshot from the player documents (first run only)"
+    ),
+):
+    """Fold the game event log into a new snapshot (run periodically, e.g. from cron)"""
+    async def run():
+        seq = await take_snapshot(
+            game_events_collection, event_snapshots_collection, counters_collection,
+            players_collection=players_collection if from_players else None
+        )
+        if seq is None:
+            typer.echo("No new events since the last snapshot")
+        else:
+            typer.echo(f"✅ Snapshot written at event {seq}")
+
+    asyncio.run(run())
+
+@app.command("rebuild-players")
+def rebuild_players():
+    """Recompute player totals and bests from the latest snapshot and the event log"""
+    async def run():
+        result = await rebuild_player_views(
+            game_events_collection, event_snapshots_collection, players_collection,
+            on_progress=lambda done, written: typer.echo(f"  {done} players processed, {written} written")
+        )
+        leaderboard_snapshot.notify_changed()
+        typer.echo(
+            f"✅ Replayed {result['events_replayed']} events after snapshot {result['snapshot_seq']}: "
+            f"{result['players_written']} of {result['players']} players written"
+        )
+
+    asyncio.run(run())
+
+@app.command("reconcile-counters")
+def reconcile_counters():
+    """Recount the maintained totals and fix drift the previous run also saw"""
+    async def run():
+        corrections = await stat_counters.reconcile(
+            scores_collection, players_collection, player_achievements_collection, lease=60
+        )
+        if corrections is None:
+            typer.echo("Another worker is reconciling; try again shortly")
+            return
+        for name, delta in sorted(corrections.items()):
+            typer.echo(f"  {name}: {delta:+d}")
+        typer.echo(f"✅ {len(corrections)} counters corrected")
+
+    asyncio.run(run())
+
+@app.command("projections")
+def projections(
+    batch_size: int = typer.Option(PROJECTION_BATCH_SIZE, help="Game events applied per batch"),
+):
+    """Run the change-stream projection worker (for PROJECTION_MODE=stream)"""
+    typer.echo("Projecting game events; Ctrl+C to stop")
+    asyncio.run(projection_worker(
+        game_events_collection, projection_checkpoints_collection, players_collection, batch_size=batch_size
+    ))
+
+@app.command("read-routing")
+def read_routing():
+    """Run one read per query class and show which replica set member served it"""
+    async def run():
+        results = await check_routing(os.environ["MONGO_URL"], os.environ["DB_NAME"])
+        for query_class, preference, server, is_primary in results:
+            member = "primary" if is_primary else "secondary"
+            typer.echo(f"{query_class:<12} {preference['mode']:<20} {server} ({member})")
+
+    asyncio.run(run())
+
+@app.command("jobs")
+def jobs(
+    concurrency: int = typer.Option(JOB_CONCURRENCY, help="Jobs processed at once"),
+):
+    """Run a dedicated job worker pool (for PROJECTION_MODE=queue)"""
+    typer.echo("Processing jobs; Ctrl+C to stop")
+    asyncio.run(run_job_workers(jobs_collection, GAME_JOB_HANDLERS, concurrency=concurrency))
+
+if __name__ == "__main__":
+    app()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 import uuid
 
@@ -15,10 +15,19 @@ class Player(BaseModel):
     games_won: int = 0
     favorite_powerup: Optional[str] = None
     last_played: Optional[datetime] = None
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
 
 class PlayerCreate(BaseModel):
     username: str
 
+class PlayerSyncResponse(BaseModel):
+    players: List[Player]
+    has_more: bool
+    # Pass both back as updated_since/after_id to fetch the next page. Once
+    # caught up the position overlaps recent changes: upsert players by id
+    next_updated_since: Optional[datetime] = None
+    next_after_id: Optional[str] = None
+
 class PlayerUpdate(BaseModel):
     total_games: Optional[int] = None
     total_score: Optional[int] = None
@@ -97,6 +106,37 @@ class LeaderboardResponse(BaseModel):
     total_entries: int
     user_rank: Optional[int] = None
     user_best_score: Optional[int] = None
+    user_rank_exact: Optional[bool] = None
+    user_top_percent: Optional[float] = None  # from the score sketch
+
+# Group Models
+class Group(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    kind: str = "clan"  # clan, friends
+    owner_id: str
+    member_count: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class GroupCreate(BaseModel):
+    name: str
+    owner_id: str
+
+class GroupMemberAdd(BaseModel):
+    player_id: str
+
+class FriendAdd(BaseModel):
+    friend_id: str
+
+# Replay Models
+class Replay(BaseModel):
+    game_session_id: str
+    player_id: str
+    player_username: str
+    score: int
+    size: int  # bytes, as uploaded (compressed)
+    content_type: str
+    created_at: datetime = Field(default_factory=datetime.utcnow)
 
 # Achievement Models
 class Achievement(BaseModel):
@@ -146,6 +186,14 @@ class AchievementWithStatus(BaseModel):
     unlocked: bool
     unlocked_at: Optional[datetime] = None
     progress: Optional[int] = None  # Current progress towards achievement
+    unlock_percent: Optional[float] = None  # share of all players who have it
+
+class GameResult(BaseModel):
+    game_id: str
+    status: str  # pending, done, failed
+    new_achievements: List[Achievement] = []
+    player_rank: Optional[int] = None
+    error: Optional[str] = None
 
 # Statistics Models
 class GameStats(BaseModel):
@@ -172,4 +220,64 @@ class DetailedStats(BaseModel):
     game_stats: GameStats
     powerup_stats: List[PowerUpStats]
     recent_games: List[GameSession]
-    achievements: List[AchievementWithStatus]
\ No newline at end of file
+    achievements: List[AchievementWithStatus]
+
+class LobbyResponse(BaseModel):
+    stats: DetailedStats
+    leaderboard: LeaderboardResponse
+
+# Global Statistics Models
+class Histogram(BaseModel):
+    edges: List[float]
+    counts: List[int]
+
+class DistributionStats(BaseModel):
+    count: int
+    min: int
+    max: int
+    mean: float
+    percentiles: Dict[str, float]
+    histogram: Histogram
+
+class GlobalStatsResponse(BaseModel):
+    total_players: int
+    score: DistributionStats
+    wave: DistributionStats
+    game_duration: DistributionStats
+    score_beaten_fraction: Optional[float] = None  # share of players below the given score
+    score_cdf: Optional[List[float]] = None
+
+class DailyGames(BaseModel):
+    date: str  # YYYY-MM-DD (UTC)
+    games: int
+
+class ActivityStats(BaseModel):
+    total_players: int
+    total_scores: int  # including archived scores
+    games_per_day: List[DailyGames]  # oldest first
+
+# Mongo Projections
+def model_projection(model, exclude=()) -> dict:
+    """Build a Mongo projection that returns exactly the fields of a model"""
+    projection = {"_id": 0}
+    projection.update({name: 1 for name in model.model_fields if name not in exclude})
+    return projection
+
+PLAYER_PROJECTION = model_projection(Player)
+# Aggregate counters stored on the player document but not exposed on Player
+PLAYER_STATS_PROJECTION = {
+    **PLAYER_PROJECTION,
+    "total_enemies_destroyed": 1,
+    "total_asteroids_destroyed": 1,
+    "total_powerups_collected": 1,
+    "best_wave": 1,
+    "longest_game": 1,
+}
+PLAYER_ID_PROJECTION = {"_id": 0, "id": 1}
+GAME_SESSION_PROJECTION = model_projection(GameSession)
+LEADERBOARD_ENTRY_PROJECTION = model_projection(LeaderboardEntry, exclude=("rank",))
+GROUP_PROJECTION = model_projection(Group)
+REPLAY_PROJECTION = model_projection(Replay)
+ACHIEVEMENT_PROJECTION = model_projection(Achievement)
+ACHIEVEMENT_CATALOG_PROJECTION = model_projection(Achievement, exclude=("created_at",))
+PLAYER_ACHIEVEMENT_PROJECTION = {"_id": 0, "achievement_id": 1, "unlocked_at": 1}
@@ -0,0 +1,142 @@
+"""Process-pool offload for CPU-bound work
+
+Sorting score columns, building the leaderboard snapshot, describing the
+global distributions and evaluating achievement batches are pure NumPy /
+Python work that would hold the GIL and stall every request on the event
+loop. They run in a shared ``ProcessPoolExecutor`` instead:
+
+* ``run(fn, *args)`` awaits one call in the pool. Work smaller than
+  ``OFFLOAD_MIN_ITEMS`` runs inline, where pickling would cost more than
+  it saves.
+* ``imap(fn, chunks)`` streams chunks (a list or an async iterator such as
+  cursor batches) through the pool with at most ``OFFLOAD_MAX_PENDING`` in
+  flight, yielding results in chunk order while later chunks are still
+  being read or computed. ``on_progress(done, submitted)`` is called as
+  chunks finish.
+* ``map_reduce(fn, chunks, merge)`` folds those results into one value.
+
+Leaving ``imap`` early (an error, ``break`` or task cancellation) cancels
+every chunk that has not started; chunks already running finish in their
+worker and are discarded.
+
+Workers are started with ``OFFLOAD_START_METHOD`` (``forkserver`` by
+default, so they never inherit Motor's threads) and functions sent to them
+must be importable module-level functions. ``OFFLOAD_WORKERS=0`` disables
+the pool and runs the work on the default thread executor instead.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+OFFLOAD_WORKERS = int(os.environ.get("OFFLOAD_WORKERS", str(os.cpu_count() or 1)))
+OFFLOAD_MAX_PENDING = int(os.environ.get("OFFLOAD_MAX_PENDING", str(2 * max(OFFLOAD_WORKERS, 1))))
+OFFLOAD_MIN_ITEMS = int(os.environ.get("OFFLOAD_MIN_ITEMS", "100000"))
+OFFLOAD_START_METHOD = os.environ.get("OFFLOAD_START_METHOD", "forkserver")
+
+_pool = None
+
+def _executor():
+    global _pool
+    if OFFLOAD_WORKERS <= 0:
+        return None  # The loop's default thread executor
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=OFFLOAD_WORKERS,
+            mp_context=multiprocessing.get_context(OFFLOAD_START_METHOD)
+        )
+    return _pool
+
+def _submit(fn, args, kwargs):
+    return asyncio.get_running_loop().run_in_executor(_executor(), partial(fn, *args, **kwargs))
+
+async def run(fn, *args, size: int = None, **kwargs):
+    """Await fn(*args, **kwargs) in the pool (inline when size is small)"""
+    if size is not None and size < OFFLOAD_MIN_ITEMS:
+        return fn(*args, **kwargs)
+    try:
+        return await _submit(fn, args, kwargs)
+    except BrokenProcessPool:
+        shutdown()  # A worker died; the next call starts a fresh pool
+        raise
+
+async def _iterate(chunks):
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+async def imap(fn, chunks, *args, max_pending: int = OFFLOAD_MAX_PENDING, on_progress=None, **kwargs):
+    """Yield fn(chunk, *args, **kwargs) for every chunk, in order, computed in the pool"""
+    pending = []
+    done = submitted = 0
+    try:
+        async for chunk in _iterate(chunks):
+            pending.append(_submit(fn, (chunk, *args), kwargs))
+            submitted += 1
+            while len(pending) >= max_pending:
+                yield await pending.pop(0)
+                done += 1
+                if on_progress:
+                    on_progress(done, submitted)
+        while pending:
+            yield await pending.pop(0)
+            done += 1
+            if on_progress:
+                on_progress(done, submitted)
+    except BrokenProcessPool:
+        shutdown()  # A worker died; the next call starts a fresh pool
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+async def map_reduce(fn, chunks, merge, *args, on_progress=None, **kwargs):
+    """Fold the per-chunk results of fn, in chunk order, with merge(accumulated, result)"""
+    result = None
+    first = True
+    async for chunk_result in imap(fn, chunks, *args, on_progress=on_progress, **kwargs):
+        result = chunk_result if first else merge(result, chunk_result)
+        first = False
+    return result
+
+def sort_columns(batch: dict) -> dict:
+    return {field: np.sort(values) for field, values in batch.items()}
+
+def merge_sorted(runs: list, dtype):
+    """Merge sorted arrays; the stable sort detects the runs and merges them"""
+    if not runs:
+        return np.empty(0, dtype=dtype)
+    return np.sort(np.concatenate(runs).astype(dtype, copy=False), kind="stable")
+
+async def sorted_columns(batches, columns: dict) -> dict:
+    """Sort columns that arrive in {field: array} batches
+
+    Each batch is sorted in the pool while the next one is read, then the
+    sorted runs of every column are merged in parallel.
+    """
+    runs = {field: [] for field in columns}
+    async for batch in imap(sort_columns, batches):
+        for field, values in batch.items():
+            runs[field].append(values)
+    merged = await asyncio.gather(*(
+        run(merge_sorted, runs[field], dtype, size=sum(len(part) for part in runs[field]))
+        for field, dtype in columns.items()
+    ))
+    return dict(zip(columns, merged))
+
+def shutdown():
+    """Stop the pool, cancelling queued work (called on application shutdown)"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,83 @@
+"""In-process LRU cache for player lookups by username and id
+
+Entries expire after ``PLAYER_CACHE_TTL`` seconds, which bounds how stale
+another worker's writes can look; writes made by this worker refresh the
+cache directly. Lookups that found nothing are cached too (negative
+caching) for a shorter ``PLAYER_CACHE_NEGATIVE_TTL``.
+"""
+import os
+import time
+from collections import OrderedDict
+
+PLAYER_CACHE_SIZE = int(os.environ.get("PLAYER_CACHE_SIZE", "50000"))
+PLAYER_CACHE_TTL = float(os.environ.get("PLAYER_CACHE_TTL", "60"))
+PLAYER_CACHE_NEGATIVE_TTL = float(os.environ.get("PLAYER_CACHE_NEGATIVE_TTL", "5"))
+
+MISSING = object()
+
+class LRUCache:
+    """Size-bounded LRU cache with per-entry expiry and negative entries"""
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value or MISSING)
+
+    def get(self, key):
+        """Return the cached value, MISSING for a cached miss, or None if unknown"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        ttl = self.negative_ttl if value is MISSING else self.ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def set_missing(self, key):
+        self.set(key, MISSING)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+class PlayerCache:
+    """Player documents indexed by both username and id"""
+
+    def __init__(self, max_size: int = PLAYER_CACHE_SIZE, ttl: float = PLAYER_CACHE_TTL,
+                 negative_ttl: float = PLAYER_CACHE_NEGATIVE_TTL):
+        self._cache = LRUCache(max_size, ttl, negative_ttl)
+
+    def by_username(self, username: str):
+        return self._cache.get(("username", username))
+
+    def by_id(self, player_id: str):
+        return self._cache.get(("id", player_id))
+
+    def put(self, player: dict):
+        self._cache.set(("username", player["username"]), player)
+        self._cache.set(("id", player["id"]), player)
+
+    def put_missing_username(self, username: str):
+        self._cache.set_missing(("username", username))
+
+    def put_missing_id(self, player_id: str):
+        self._cache.set_missing(("id", player_id))
+
+    def invalidate(self, player_id: str, username: str = None):
+        self._cache.invalidate(("id", player_id))
+        if username is not None:
+            self._cache.invalidate(("username", username))
+
+player_cache = PlayerCache()
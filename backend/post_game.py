@@ -0,0 +1,41 @@
+"""End-of-game post-processing: player totals, achievements and rank
+
+With ``PROJECTION_MODE=queue``, ``end_game`` stores the session and score,
+enqueues a ``game_end`` job and returns. The job applies the game to the
+player's aggregates (idempotently), evaluates achievements, updates the
+player's group boards and computes the rank; clients poll ``GET /games/{id}/result`` for the outcome.
+"""
+from database import (
+    game_sessions_collection,
+    record_player_game, check_achievements, get_game_achievements, get_player_rank
+)
+from global_stats import global_stats
+from groups import record_group_games
+from models import GAME_SESSION_PROJECTION
+
+GAME_END_JOB = "game_end"
+
+def game_end_job_key(game_id: str) -> str:
+    return f"{GAME_END_JOB}:{game_id}"
+
+async def game_result(game: dict) -> dict:
+    """Achievements unlocked in the game and the player's current rank"""
+    return {
+        "new_achievements": await get_game_achievements(game["player_id"], game["id"]),
+        "player_rank": await get_player_rank(game["player_id"], consistent=True),
+    }
+
+async def process_game_end(payload: dict) -> dict:
+    """Job handler; safe to run again after a partial failure"""
+    game = await game_sessions_collection.find_one({"id": payload["game_id"]}, GAME_SESSION_PROJECTION)
+    if not game:
+        raise ValueError(f"Game session {payload['game_id']} not found")
+
+    player = await record_player_game(game["player_id"], game)
+    if player:
+        global_stats.record_game(player, game)
+    await check_achievements(game["player_id"], game)
+    await record_group_games([game["id"]])
+    return await game_result(game)
+
+GAME_JOB_HANDLERS = {GAME_END_JOB: process_game_end}
@@ -0,0 +1,138 @@
+"""Change-stream workers that keep derived views in step with the event log
+
+With ``PROJECTION_MODE=stream`` the ``end_game`` request only writes the
+authoritative records (session, score, game event) and returns. A separate
+process, ``python manage.py projections``, tails the ``game_events`` change
+stream and, one batch at a time:
+
+* adds each game to its player's aggregates with one $inc/$max update;
+* evaluates achievements for every game;
+* fans the games' scores out to the players' group boards.
+
+The leaderboard snapshot needs nothing from here: ``end_game`` adds each
+new score to the snapshot's journal, in every mode.
+
+The resume token is saved in ``projection_checkpoints`` after every batch,
+so a restarted worker carries on where it stopped. Player updates record the
+game ids they applied (``projected_games``), so a batch replayed after a
+crash is not counted twice, even when it overlaps games that were already
+applied; achievement unlocks are already idempotent.
+
+API workers in stream mode also watch the players collection and drop
+changed players from their in-process cache. Change streams need a replica
+set (a single-node one is fine locally).
+
+``PROJECTION_MODE=inline`` (the default) keeps doing all of this inside
+``end_game``; ``PROJECTION_MODE=queue`` hands it to a ``game_end`` job
+instead (see post_game.py).
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from database import player_games_update, check_achievements
+from event_log import decode_event
+from groups import record_group_games
+from ids import decode_id, match_id
+from player_cache import player_cache
+
+logger = logging.getLogger(__name__)
+
+PROJECTION_MODE = os.environ.get("PROJECTION_MODE", "inline")
+PROJECTION_BATCH_SIZE = int(os.environ.get("PROJECTION_BATCH_SIZE", "500"))
+PROJECTION_MAX_AWAIT_MS = int(os.environ.get("PROJECTION_MAX_AWAIT_MS", "500"))
+PROJECTION_CONCURRENCY = int(os.environ.get("PROJECTION_CONCURRENCY", "16"))
+PROJECTION_RETRY_DELAY = float(os.environ.get("PROJECTION_RETRY_DELAY", "5"))
+CHECKPOINT_ID = "game_events"
+
+def _player_updates(games: list) -> list:
+    """One guarded update per game, so a replayed batch skips exactly the games already applied"""
+    return [
+        UpdateOne(
+            {"id": match_id(game["player_id"]), "projected_games": {"$ne": game["id"]}},
+            player_games_update([game])
+        )
+        for game in games
+    ]
+
+async def apply_batch(events: list, players_collection):
+    """Project one batch of game events into the derived views"""
+    games = [decode_event(event) for event in events]
+
+    operations = _player_updates(games)
+    if operations:
+        await players_collection.bulk_write(operations, ordered=False)
+
+    # Achievements depend on the updated aggregates, so they run afterwards;
+    # games of one player are checked in order, players in parallel
+    by_player = {}
+    for game in games:
+        by_player.setdefault(game["player_id"], []).append(game)
+    semaphore = asyncio.Semaphore(PROJECTION_CONCURRENCY)
+
+    async def check_player(player_games):
+        async with semaphore:
+            for game in player_games:
+                await check_achievements(game["player_id"], game)
+
+    await asyncio.gather(*(check_player(player_games) for player_games in by_player.values()))
+    await record_group_games([game["id"] for game in games])
+
+async def _load_token(checkpoints_collection):
+    checkpoint = await checkpoints_collection.find_one({"_id": CHECKPOINT_ID})
+    return checkpoint["resume_token"] if checkpoint else None
+
+async def _save_token(checkpoints_collection, token):
+    await checkpoints_collection.update_one(
+        {"_id": CHECKPOINT_ID},
+        {"$set": {"resume_token": token, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def projection_worker(events_collection, checkpoints_collection, players_collection,
+                            batch_size: int = PROJECTION_BATCH_SIZE):
+    """Tail the game event change stream forever, applying it in batches"""
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    while True:
+        try:
+            token = await _load_token(checkpoints_collection)
+            async with events_collection.watch(
+                pipeline, resume_after=token, batch_size=batch_size,
+                max_await_time_ms=PROJECTION_MAX_AWAIT_MS
+            ) as stream:
+                while stream.alive:
+                    events = []
+                    while len(events) < batch_size:
+                        change = await stream.try_next()
+                        if change is None:
+                            break
+                        events.append(change["fullDocument"])
+                    if events:
+                        await apply_batch(events, players_collection)
+                        logger.info("Projected %d game events", len(events))
+                    if stream.resume_token and stream.resume_token != token:
+                        token = stream.resume_token
+                        await _save_token(checkpoints_collection, token)
+        except Exception:
+            logger.exception("Projection worker failed; restarting from the last checkpoint")
+            await asyncio.sleep(PROJECTION_RETRY_DELAY)
+
+async def player_cache_invalidation_loop(players_collection):
+    """Drop players changed by other processes from this worker's cache"""
+    pipeline = [
+        {"$match": {"operationType": {"$in": ["update", "replace"]}}},
+        {"$project": {"fullDocument.id": 1, "fullDocument.username": 1}},
+    ]
+    while True:
+        try:
+            async with players_collection.watch(pipeline, full_document="updateLookup") as stream:
+                async for change in stream:
+                    player = change.get("fullDocument")
+                    if player:
+                        player_cache.invalidate(decode_id(player["id"]), player.get("username"))
+        except Exception:
+            logger.exception("Player cache invalidation stream failed")
+            await asyncio.sleep(PROJECTION_RETRY_DELAY)
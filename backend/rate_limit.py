@@ -0,0 +1,91 @@
+"""Token-bucket rate limiting per client and route
+
+Limits are checked in a FastAPI dependency, before any database work.
+Buckets live in a process-local backend; with ``uvicorn --workers N`` each
+worker enforces ``1/N`` of the configured rate (``WEB_CONCURRENCY``), so
+the aggregate limit per client stays the configured one.
+
+Clients are keyed by address. ``X-Forwarded-For`` is only believed when
+the connection comes from a proxy in ``TRUSTED_PROXIES`` (comma-separated
+addresses or CIDR ranges); the client is then the right-most hop that is
+not itself a trusted proxy, since everything left of it is client-supplied.
+"""
+import ipaddress
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import Depends, HTTPException, Request
+
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", "20"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "40"))
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", "100000"))
+WORKER_COUNT = max(int(os.environ.get("WEB_CONCURRENCY", "1")), 1)
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get("TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+
+class LocalBucketBackend:
+    """Token buckets held in an LRU-bounded dict"""
+
+    def __init__(self, max_entries: int = RATE_LIMIT_MAX_CLIENTS, worker_count: int = WORKER_COUNT):
+        self.max_entries = max_entries
+        self.worker_count = worker_count
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+
+    def take(self, key, rate: float, burst: float) -> float:
+        """Take one token; return 0 if allowed, else seconds until one is free"""
+        rate = rate / self.worker_count
+        burst = max(burst / self.worker_count, 1.0)
+        now = time.monotonic()
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+rate_limit_backend = LocalBucketBackend()
+
+def is_trusted_proxy(host: str, trusted: list = TRUSTED_PROXIES) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in trusted)
+
+def client_key(request: Request, trusted: list = TRUSTED_PROXIES) -> str:
+    """Identify the caller, following X-Forwarded-For only through trusted proxies"""
+    peer = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if not forwarded or not is_trusted_proxy(peer, trusted):
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop, trusted):
+            return hop
+    return hops[0] if hops else peer
+
+def rate_limit(route: str, rate: float = RATE_LIMIT_PER_SECOND, burst: float = RATE_LIMIT_BURST):
+    """Dependency that rejects requests over the route's per-client budget"""
+    async def check_rate_limit(request: Request):
+        retry_after = rate_limit_backend.take((client_key(request), route), rate, burst)
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(max(int(retry_after + 0.999), 1))}
+            )
+    return Depends(check_rate_limit)
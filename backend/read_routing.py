@@ -0,0 +1,83 @@
+"""Read-preference routing per query class
+
+Writes, and reads that must see the caller's own writes (the rank returned
+by ``end_game``, player lookups), always go to the primary. Reads that can
+tolerate bounded staleness are grouped into query classes, each with its
+own read preference:
+
+    leaderboard   leaderboard pages, ranks, snapshot rebuilds
+    catalog       achievement definitions
+    stats         global stats scans
+
+Set ``READ_PREFERENCE_<CLASS>`` to ``primary``, ``primaryPreferred``,
+``secondary``, ``secondaryPreferred`` or ``nearest`` (default
+``secondaryPreferred``, which falls back to the primary on a single node).
+``READ_MAX_STALENESS_SECONDS`` bounds how far behind a secondary may be
+(MongoDB requires at least 90; -1 means no limit). Adding replicas then adds
+read capacity for these classes.
+
+``python manage.py read-routing`` shows which member serves each class.
+"""
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.read_preferences import (
+    Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+)
+
+QUERY_CLASSES = ("leaderboard", "catalog", "stats")
+READ_MAX_STALENESS_SECONDS = int(os.environ.get("READ_MAX_STALENESS_SECONDS", "90"))
+
+_MODES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def read_preference(query_class: str):
+    """The read preference configured for a query class"""
+    mode = os.environ.get(f"READ_PREFERENCE_{query_class.upper()}", "secondaryPreferred")
+    if mode == "primary":
+        return Primary()
+    if mode not in _MODES:
+        raise ValueError(f"Unknown read preference {mode!r} for {query_class} reads")
+    return _MODES[mode](max_staleness=READ_MAX_STALENESS_SECONDS)
+
+def routed(collection, query_class: str):
+    """A view of collection whose reads follow the query class's preference"""
+    preference = read_preference(query_class)
+    if isinstance(preference, Primary):
+        return collection
+    return collection.with_options(read_preference=preference)
+
+class _ServerRecorder(monitoring.CommandListener):
+    def __init__(self):
+        self.servers = {}
+
+    def started(self, event):
+        if event.command_name == "find":
+            self.servers[event.command.get("comment")] = event.connection_id
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+async def check_routing(mongo_url: str, db_name: str, collection_name: str = "scores"):
+    """Run one read per query class and report (class, preference, server, is primary)"""
+    recorder = _ServerRecorder()
+    client = AsyncIOMotorClient(mongo_url, event_listeners=[recorder])
+    try:
+        collection = client[db_name][collection_name]
+        results = []
+        for query_class in ("primary",) + QUERY_CLASSES:
+            target = collection if query_class == "primary" else routed(collection, query_class)
+            await target.find_one({}, {"_id": 1}, comment=query_class)
+            server = recorder.servers.get(query_class)
+            results.append((query_class, target.read_preference.document, server, server == client.primary))
+        return results
+    finally:
+        client.close()
@@ -0,0 +1,220 @@
+"""Replays of top-scoring games, stored on disk and streamed with range support
+
+A replay is the client's compressed recording of a finished game's inputs.
+It is uploaded once as an opaque binary body (``PUT /games/{id}/replay``)
+and stored byte for byte in ``REPLAY_DIR``, one file per game, written to a
+temporary file and moved into place with ``os.replace``. The ``replays``
+collection holds only its metadata::
+
+    {game_session_id, player_id, player_username, score, size, content_type, etag, created_at}
+
+Only the ``REPLAY_TOP_N`` best-scoring games keep a replay. An upload for
+a game outside the top N of the leaderboard is refused with 409, and every
+accepted upload evicts the replays (documents and files) that fall out of
+the top N.
+
+``ReplayFileResponse`` serves a replay with ``Accept-Ranges: bytes``: a
+single-range ``Range`` header (honouring ``If-Range``) gets a 206 with that
+slice, an unsatisfiable one a 416. The file is handed to the server with the
+ASGI zero-copy send extension when the server offers it, and otherwise read
+in ``REPLAY_CHUNK_SIZE`` pieces off the event loop.
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+from fastapi import HTTPException
+from starlette.responses import Response
+
+from database import replays_collection, scores_collection
+from models import Replay, REPLAY_PROJECTION
+
+REPLAY_DIR = os.environ.get("REPLAY_DIR", str(Path(__file__).parent / "replays"))
+REPLAY_TOP_N = int(os.environ.get("REPLAY_TOP_N", "100"))
+REPLAY_MAX_BYTES = int(os.environ.get("REPLAY_MAX_BYTES", str(8 * 1024 * 1024)))
+REPLAY_CHUNK_SIZE = int(os.environ.get("REPLAY_CHUNK_SIZE", str(64 * 1024)))
+REPLAY_CONTENT_TYPES = ("application/octet-stream", "application/zstd", "application/gzip")
+
+REPLAY_ORDER = [("score", -1), ("created_at", 1)]
+
+def replay_path(game_id: str) -> str:
+    return os.path.join(REPLAY_DIR, f"{game_id}.replay")
+
+def _remove_file(game_id: str):
+    try:
+        os.unlink(replay_path(game_id))
+    except FileNotFoundError:
+        pass
+
+async def qualifies(game_id: str, score: int) -> bool:
+    """Whether a game with this score is among the top N of the leaderboard
+
+    The top ``ARCHIVE_KEEP_TOP_SCORES`` always stay hot, so ``scores`` holds
+    every game that could rank above it.
+    """
+    better = await scores_collection.count_documents(
+        {"score": {"$gt": score}, "game_session_id": {"$ne": game_id}}, limit=REPLAY_TOP_N
+    )
+    return better < REPLAY_TOP_N
+
+async def _write_file(game_id: str, chunks) -> tuple:
+    """Stream the upload to its file; returns (size, sha256 hex digest)"""
+    os.makedirs(REPLAY_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=REPLAY_DIR, prefix=".upload-")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > REPLAY_MAX_BYTES:
+                    raise HTTPException(
+                        status_code=413, detail=f"Replay exceeds {REPLAY_MAX_BYTES} bytes"
+                    )
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+        if not size:
+            raise HTTPException(status_code=400, detail="Replay is empty")
+        os.replace(tmp_path, replay_path(game_id))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return size, digest.hexdigest()
+
+async def save_replay(game: dict, chunks, content_type: str) -> dict:
+    """Store the replay of a completed game and evict those that drop out of the top N"""
+    if content_type not in REPLAY_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=415, detail=f"Replays must be one of {', '.join(REPLAY_CONTENT_TYPES)}"
+        )
+    if game["status"] != "completed":
+        raise HTTPException(status_code=409, detail="Game has not ended")
+    if not await qualifies(game["id"], game["final_score"]):
+        raise HTTPException(status_code=409, detail=f"Score is not in the top {REPLAY_TOP_N} of the leaderboard")
+
+    size, digest = await _write_file(game["id"], chunks)
+    replay = Replay(
+        game_session_id=game["id"],
+        player_id=game["player_id"],
+        player_username=game["player_username"],
+        score=game["final_score"],
+        size=size,
+        content_type=content_type,
+    )
+    await replays_collection.replace_one(
+        {"game_session_id": game["id"]}, {**replay.dict(), "etag": digest}, upsert=True
+    )
+    await evict_replays()
+    return replay.dict()
+
+async def evict_replays(keep: int = REPLAY_TOP_N) -> int:
+    """Drop every replay below the top `keep`; returns how many were removed"""
+    evicted = [
+        doc["game_session_id"]
+        async for doc in replays_collection.find(
+            {}, {"_id": 0, "game_session_id": 1}
+        ).sort(REPLAY_ORDER).skip(keep)
+    ]
+    if evicted:
+        await replays_collection.delete_many({"game_session_id": {"$in": evicted}})
+        for game_id in evicted:
+            _remove_file(game_id)
+    return len(evicted)
+
+async def get_top_replays(limit: int = 10):
+    return await replays_collection.find({}, REPLAY_PROJECTION).sort(REPLAY_ORDER).limit(limit).to_list(length=limit)
+
+async def open_replay(game_id: str):
+    """(metadata, open file) for a stored replay, or None"""
+    replay = await replays_collection.find_one({"game_session_id": game_id}, {"_id": 0})
+    if not replay:
+        return None
+    try:
+        return replay, open(replay_path(game_id), "rb")
+    except FileNotFoundError:
+        return None  # Evicted since the lookup
+
+def parse_range(header: str, size: int):
+    """(start, end) with end exclusive for a single-range header
+
+    None when the header should be ignored (malformed or several ranges),
+    and ``(size, size)`` when no byte of the range exists.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+        else:
+            suffix = int(last)
+            if suffix == 0:
+                return size, size
+            start, end = max(size - suffix, 0), size
+    except ValueError:
+        return None
+    if start < 0 or (end <= start and start < size):
+        return None
+    if start >= size:
+        return size, size
+    return start, min(end, size)
+
+class ReplayFileResponse(Response):
+    """A replay file, or a byte range of it, streamed to the client"""
+
+    def __init__(self, replay: dict, file, range_header: str = None, if_range: str = None):
+        self.file = file
+        self.status_code = 200
+        self.media_type = replay["content_type"]
+        self.background = None
+        size = os.fstat(file.fileno()).st_size
+        etag = f'"{replay["etag"]}"'
+        headers = {"accept-ranges": "bytes", "etag": etag}
+        self.start, self.end = 0, size
+
+        byte_range = parse_range(range_header, size) if range_header and if_range in (None, etag) else None
+        if byte_range == (size, size):
+            self.status_code = 416
+            self.end = 0
+            headers["content-range"] = f"bytes */{size}"
+        elif byte_range:
+            self.status_code = 206
+            self.start, self.end = byte_range
+            headers["content-range"] = f"bytes {self.start}-{self.end - 1}/{size}"
+        headers["content-length"] = str(self.end - self.start)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            count = self.end - self.start
+            if count <= 0:
+                await send({"type": "http.response.body", "body": b""})
+            elif "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": self.file,
+                    "offset": self.start,
+                    "count": count,
+                })
+            else:
+                offset = self.start
+                while count > 0:
+                    chunk = await asyncio.to_thread(
+                        os.pread, self.file.fileno(), min(REPLAY_CHUNK_SIZE, count), offset
+                    )
+                    if not chunk:
+                        break  # Truncated underneath us; end the body early
+                    offset += len(chunk)
+                    count -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+                if count > 0:
+                    await send({"type": "http.response.body", "body": b""})
+        finally:
+            self.file.close()
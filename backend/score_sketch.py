@@ -0,0 +1,201 @@
+"""Mergeable quantile sketch for approximate leaderboard ranks
+
+Implements a DDSketch: values are counted in logarithmic buckets, so any
+quantile is answered with a bounded *relative* error (``SKETCH_RELATIVE_ACCURACY``)
+and memory is capped at ``SKETCH_MAX_BUCKETS`` buckets however many scores
+are added. Two sketches merge by summing bucket counts, which is what lets
+every worker keep a local copy and share it through a single Mongo document
+updated with ``$inc``.
+"""
+import asyncio
+import logging
+import math
+import os
+
+import numpy as np
+from pymongo.errors import DuplicateKeyError
+
+from bulk_reads import read_columns
+
+logger = logging.getLogger(__name__)
+
+SKETCH_RELATIVE_ACCURACY = float(os.environ.get("SKETCH_RELATIVE_ACCURACY", "0.01"))
+SKETCH_MAX_BUCKETS = int(os.environ.get("SKETCH_MAX_BUCKETS", "2048"))
+SKETCH_SYNC_INTERVAL = int(os.environ.get("SKETCH_SYNC_INTERVAL", "10"))
+SKETCH_DOCUMENT_ID = "scores"
+
+class DDSketch:
+    """Log-bucketed quantile sketch over non-negative values"""
+
+    def __init__(self, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY,
+                 max_buckets: int = SKETCH_MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def key(self, value) -> int:
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def value(self, key: int) -> float:
+        """Representative value of a bucket (within the relative accuracy)"""
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count: int = 1):
+        if value <= 0:
+            self.zero_count += count
+        else:
+            key = self.key(value)
+            self.buckets[key] = self.buckets.get(key, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+        self.count += count
+
+    def add_many(self, values):
+        """Add a NumPy array of values in one vectorised pass"""
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > 0]
+        self.zero_count += int(len(values) - len(positive))
+        if len(positive):
+            keys = np.ceil(np.log(positive) / self._log_gamma).astype(np.int64)
+            uniq, counts = np.unique(keys, return_counts=True)
+            for key, count in zip(uniq.tolist(), counts.tolist()):
+                self.buckets[key] = self.buckets.get(key, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+        self.count += int(len(values))
+
+    def _collapse(self):
+        """Fold the lowest buckets together to stay within max_buckets"""
+        keys = sorted(self.buckets)
+        excess = len(keys) - self.max_buckets
+        target = keys[excess]
+        for key in keys[:excess]:
+            self.buckets[target] += self.buckets.pop(key)
+
+    def merge(self, other: "DDSketch"):
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def count_above(self, value) -> int:
+        """Estimated number of values strictly greater than value"""
+        if value <= 0:
+            return self.count - self.zero_count
+        threshold = self.key(value)
+        above = sum(count for key, count in self.buckets.items() if key > threshold)
+        # Interpolate inside the bucket holding value
+        lower, upper = self.gamma ** (threshold - 1), self.gamma ** threshold
+        share = (upper - value) / (upper - lower)
+        return above + int(round(self.buckets.get(threshold, 0) * share))
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.buckets))
+
+    def to_document(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "buckets": {str(key): count for key, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_document(cls, doc: dict) -> "DDSketch":
+        sketch = cls(relative_accuracy=doc.get("relative_accuracy", SKETCH_RELATIVE_ACCURACY))
+        sketch.buckets = {int(key): count for key, count in doc.get("buckets", {}).items()}
+        sketch.zero_count = doc.get("zero_count", 0)
+        sketch.count = doc.get("count", 0)
+        return sketch
+
+class SharedScoreSketch:
+    """Worker-local sketch kept in sync with a shared Mongo document
+
+    New scores go into both the merged view and a pending delta; ``sync``
+    pushes the delta with ``$inc`` and reloads the merged total written by
+    every worker.
+    """
+
+    def __init__(self):
+        self.sketch = DDSketch()
+        self._pending = DDSketch()
+        self.loaded = False
+
+    def add(self, score: int):
+        self.sketch.add(score)
+        self._pending.add(score)
+
+    def rank(self, score: int) -> int:
+        return self.sketch.count_above(score) + 1
+
+    def top_percent(self, score: int) -> float:
+        """Share of all scores at or above this one, as a percentage"""
+        if self.sketch.count == 0:
+            return 0.0
+        return 100.0 * min(self.rank(score), self.sketch.count) / self.sketch.count
+
+    async def build(self, sketches_collection, scores_collection):
+        """Create the shared document from the full score table if it is missing"""
+        if await sketches_collection.find_one({"_id": SKETCH_DOCUMENT_ID}, {"_id": 1}):
+            return
+        # Scores recorded so far are already in the table being read
+        self._pending = DDSketch()
+        columns = await read_columns(scores_collection, {"score": np.int64})
+        sketch = DDSketch()
+        sketch.add_many(columns["score"])
+        try:
+            await sketches_collection.insert_one({"_id": SKETCH_DOCUMENT_ID, **sketch.to_document()})
+        except DuplicateKeyError:
+            pass  # Another worker built it first
+
+    async def sync(self, sketches_collection):
+        """Push the local delta and reload the merged sketch"""
+        pending, self._pending = self._pending, DDSketch()
+        if pending.count:
+            increments = {f"buckets.{key}": count for key, count in pending.buckets.items()}
+            increments["zero_count"] = pending.zero_count
+            increments["count"] = pending.count
+            try:
+                await sketches_collection.update_one(
+                    {"_id": SKETCH_DOCUMENT_ID}, {"$inc": increments}, upsert=True
+                )
+            except Exception:
+                self._pending.merge(pending)
+                raise
+        doc = await sketches_collection.find_one({"_id": SKETCH_DOCUMENT_ID})
+        if doc:
+            merged = DDSketch.from_document(doc)
+            # Scores added while the round trip was in flight
+            merged.merge(self._pending)
+            self.sketch = merged
+            self.loaded = True
+
+score_sketch = SharedScoreSketch()
+
+async def score_sketch_sync_loop(sketches_collection, scores_collection,
+                                 interval: int = SKETCH_SYNC_INTERVAL):
+    """Build the shared sketch once, then keep this worker's copy in sync"""
+    while True:
+        try:
+            if not score_sketch.loaded:
+                await score_sketch.build(sketches_collection, scores_collection)
+            await score_sketch.sync(sketches_collection)
+        except Exception:
+            logger.exception("Score sketch sync failed")
+        await asyncio.sleep(interval)
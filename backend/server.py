@@ -1,22 +1,18 @@
 from fastapi import FastAPI, APIRouter
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
 import logging
 from pathlib import Path
 
 # Import game API
 from game_api import router as game_router
+import offload
+from database import client, index_failures
+from content_negotiation import CompressionMiddleware
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
 # Create the main app without a prefix
 app = FastAPI(title="Cosmic Defender API", version="1.0.0")
 
@@ -31,6 +27,9 @@ async def root():
 # Health check endpoint
 @api_router.get("/health")
 async def health_check():
+    if index_failures:
+        # Serving, but without indexes that queries or uniqueness rely on (see the logs)
+        return {"status": "degraded", "service": "cosmic-defender-api", "index_failures": sorted(index_failures)}
     return {"status": "healthy", "service": "cosmic-defender-api"}
 
 # Include the game API routes
@@ -39,6 +38,8 @@ api_router.include_router(game_router, prefix="/game", tags=["game"])
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -61,6 +62,7 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+    offload.shutdown()
     logger.info("Cosmic Defender API shutdown complete.")
 
 if __name__ == "__main__":
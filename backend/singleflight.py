@@ -0,0 +1,33 @@
+"""Request coalescing for identical concurrent reads
+
+Concurrent callers asking for the same key share one in-flight coroutine
+instead of each running the same Mongo queries.
+"""
+import asyncio
+
+class SingleFlight:
+    """Run at most one coroutine per key at a time and share its result"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, fn):
+        """Await ``fn()``, or the call already running for ``key``"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # A cancelled caller must not cancel the work shared with the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            future.exception()  # Mark as retrieved even when nobody is left waiting
+
+    def __len__(self):
+        return len(self._inflight)
+
+read_coalescer = SingleFlight()
@@ -4,10 +4,12 @@ Comprehensive Backend API Test Suite for Cosmic Defender Game
 Tests all API endpoints including player management, game sessions, leaderboard, and achievements.
 """
 
+import msgpack
 import requests
 import json
 import time
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
 
 # Get backend URL from environment
@@ -25,9 +27,66 @@ else:
 
 API_BASE = f"{BACKEND_URL}/api"
 
+# BACKEND_TEST_IN_PROCESS=1 serves the app from this process on the embedded
+# storage backend, so the suite needs neither a running server nor MongoDB
+IN_PROCESS = os.getenv("BACKEND_TEST_IN_PROCESS") == "1"
+
+class InProcessBackend:
+    """requests-style get/post/put against the app running on a background event loop"""
+
+    def __init__(self):
+        import asyncio
+        import sys
+        import threading
+
+        os.environ.setdefault("STORAGE_BACKEND", "memory")
+        os.environ.setdefault("DB_NAME", "cosmic_defender_test")
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        self._asyncio = asyncio
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._client = self._run(self._start())
+
+    async def _start(self):
+        import logging
+        import httpx
+        import server  # game_api schedules its background tasks on import
+
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        await server.app.router.startup()
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url=BACKEND_URL)
+
+    def _run(self, coro, timeout: float = None):
+        return self._asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def run(self, coro, timeout: float = 30):
+        """Run a coroutine against the app's modules on the app's event loop"""
+        return self._run(coro, timeout)
+
+    def _request(self, method: str, url: str, timeout: float = None, data: bytes = None, **kwargs):
+        import httpx
+
+        try:
+            return self._run(
+                self._client.request(method, url, content=data, timeout=timeout, **kwargs), timeout
+            )
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+    def get(self, url: str, **kwargs):
+        return self._request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self._request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self._request("PUT", url, **kwargs)
+
 class CosmicDefenderAPITester:
     def __init__(self):
         self.base_url = API_BASE
+        self.http = InProcessBackend() if IN_PROCESS else requests
         self.test_results = []
         self.test_player_id = None
         self.test_game_id = None
@@ -45,16 +104,17 @@ class CosmicDefenderAPITester:
         status = "✅ PASS" if success else "❌ FAIL"
         print(f"{status} {test_name}: {message}")
         
-    def make_request(self, method: str, endpoint: str, data: Dict = None, params: Dict = None) -> tuple:
+    def make_request(self, method: str, endpoint: str, data: Dict = None, params: Dict = None,
+                     headers: Dict = None, body: bytes = None) -> tuple:
         """Make HTTP request and return response and success status"""
         url = f"{self.base_url}{endpoint}"
         try:
             if method.upper() == "GET":
-                response = requests.get(url, params=params, timeout=10)
+                response = self.http.get(url, params=params, headers=headers, timeout=10)
             elif method.upper() == "POST":
-                response = requests.post(url, json=data, timeout=10)
+                response = self.http.post(url, json=data, headers=headers, timeout=10)
             elif method.upper() == "PUT":
-                response = requests.put(url, json=data, timeout=10)
+                response = self.http.put(url, json=data, data=body, headers=headers, timeout=10)
             else:
                 return None, False, f"Unsupported method: {method}"
                 
@@ -62,6 +122,15 @@ class CosmicDefenderAPITester:
         except requests.exceptions.RequestException as e:
             return None, False, str(e)
     
+    def wait_for_result(self, game_id: str, timeout: float = 10):
+        """Wait for a game's post-processing (a job with PROJECTION_MODE=queue)"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            response, success, _ = self.make_request("GET", f"/game/games/{game_id}/result")
+            if not success or response.status_code != 200 or response.json()["status"] != "pending":
+                return
+            time.sleep(0.2)
+    
     def test_health_endpoints(self):
         """Test basic health and root endpoints"""
         print("\n=== Testing Health Endpoints ===")
@@ -239,7 +308,18 @@ class CosmicDefenderAPITester:
                 self.log_test("End Game Session", False, f"End game response invalid: {end_result}")
         else:
             self.log_test("End Game Session", False, f"End game failed: {error or response.status_code}")
-        
+
+        # Test game result (pending while the post-game job is queued)
+        response, success, error = self.make_request("GET", f"/game/games/{self.test_game_id}/result")
+        if success and response.status_code == 200:
+            result = response.json()
+            if result.get("status") in ("pending", "done") and result.get("game_id") == self.test_game_id:
+                self.log_test("Get Game Result", True, f"Game result status: {result['status']}, rank: {result.get('player_rank')}")
+            else:
+                self.log_test("Get Game Result", False, f"Game result invalid: {result}")
+        else:
+            self.log_test("Get Game Result", False, f"Game result failed: {error or response.status_code}")
+
         # Test get non-existent game
         response, success, error = self.make_request("GET", "/game/games/non-existent-game")
         if success and response.status_code == 404:
@@ -288,6 +368,20 @@ class CosmicDefenderAPITester:
                     self.log_test("Leaderboard with Player Rank", False, "Player rank not included in response")
             else:
                 self.log_test("Leaderboard with Player Rank", False, f"Player rank leaderboard failed: {error or response.status_code}")
+            
+            # Test approximate rank mode
+            params = {"player_id": self.test_player_id, "approximate": "true"}
+            response, success, error = self.make_request("GET", "/game/leaderboard", params=params)
+            if success and response.status_code == 200:
+                leaderboard = response.json()
+                if "user_rank_exact" in leaderboard and "user_top_percent" in leaderboard:
+                    self.log_test("Leaderboard Approximate Rank", True,
+                        f"Rank {leaderboard.get('user_rank')} (exact: {leaderboard.get('user_rank_exact')}), "
+                        f"top {leaderboard.get('user_top_percent')}%")
+                else:
+                    self.log_test("Leaderboard Approximate Rank", False, "Approximate rank fields missing")
+            else:
+                self.log_test("Leaderboard Approximate Rank", False, f"Approximate rank leaderboard failed: {error or response.status_code}")
     
     def test_achievements(self):
         """Test achievement system"""
@@ -304,6 +398,14 @@ class CosmicDefenderAPITester:
         else:
             self.log_test("Get All Achievements", False, f"Get achievements failed: {error or response.status_code}")
         
+        # The anonymous catalog reports rarity too; the test player has unlocked some by now
+        if success and response.status_code == 200:
+            rarities = [a.get("unlock_percent") for a in response.json()]
+            if all(r is None or 0 <= r <= 100 for r in rarities) and any(r for r in rarities):
+                self.log_test("Catalog Achievement Rarity", True, f"Rarity reported for {len(rarities)} achievements")
+            else:
+                self.log_test("Catalog Achievement Rarity", False, f"Missing or invalid rarity: {rarities}")
+        
         # Test get achievements with player progress
         if self.test_player_id:
             params = {"player_id": self.test_player_id}
@@ -328,7 +430,21 @@ class CosmicDefenderAPITester:
                     self.log_test("Get Player Achievements Endpoint", False, "Invalid player achievements endpoint response")
             else:
                 self.log_test("Get Player Achievements Endpoint", False, f"Player achievements endpoint failed: {error or response.status_code}")
-    
+
+            # Unlocked achievements report how rare they are
+            if success and response.status_code == 200:
+                achievements = response.json()
+                unlocked = [a for a in achievements if a.get("unlocked")]
+                rarities = [a.get("unlock_percent") for a in unlocked]
+                if all("unlock_percent" in a for a in achievements) and all(
+                    r is not None and 0 < r <= 100 for r in rarities
+                ):
+                    self.log_test("Achievement Rarity", True,
+                        f"Rarity reported for {len(achievements)} achievements "
+                        f"({len(unlocked)} unlocked)")
+                else:
+                    self.log_test("Achievement Rarity", False, f"Missing or invalid rarity: {rarities}")
+
     def test_player_stats(self):
         """Test player statistics"""
         print("\n=== Testing Player Statistics ===")
@@ -360,6 +476,1000 @@ class CosmicDefenderAPITester:
         else:
             self.log_test("Get Non-existent Player Stats", False, f"Non-existent player stats test failed: {response.status_code if success else error}")
     
+    def test_lobby(self):
+        """Test the composite lobby endpoint"""
+        print("\n=== Testing Lobby ===")
+        
+        if not self.test_player_id:
+            self.log_test("Lobby", False, "Cannot test lobby without valid player ID")
+            return
+        
+        params = {"player_id": self.test_player_id, "leaderboard_limit": 5}
+        response, success, error = self.make_request("GET", "/game/lobby", params=params)
+        if success and response.status_code == 200:
+            lobby = response.json()
+            stats = lobby.get("stats", {})
+            leaderboard = lobby.get("leaderboard", {})
+            if stats.get("player", {}).get("id") == self.test_player_id and "entries" in leaderboard:
+                self.log_test("Get Lobby", True,
+                    f"Lobby loaded - Achievements: {len(stats.get('achievements', []))}, "
+                    f"Leaderboard entries: {len(leaderboard['entries'])}, Rank: {leaderboard.get('user_rank')}")
+            else:
+                self.log_test("Get Lobby", False, f"Lobby response invalid: {lobby}")
+        else:
+            self.log_test("Get Lobby", False, f"Get lobby failed: {error or response.status_code}")
+        
+        response, success, error = self.make_request("GET", "/game/lobby", params={"player_id": "non-existent-id"})
+        if success and response.status_code == 404:
+            self.log_test("Lobby for Non-existent Player", True, "Non-existent player lobby correctly returned 404")
+        else:
+            self.log_test("Lobby for Non-existent Player", False, f"Non-existent player lobby test failed: {response.status_code if success else error}")
+    
+    def test_player_sync(self):
+        """Test bulk player lookup and the incremental change feed"""
+        print("\n=== Testing Player Sync ===")
+        
+        if not self.test_player_id:
+            self.log_test("Player Sync", False, "Cannot test player sync without valid player ID")
+            return
+        
+        params = {"ids": f"{self.test_player_id},non-existent-id"}
+        response, success, error = self.make_request("GET", "/game/players", params=params)
+        if success and response.status_code == 200:
+            players = response.json()
+            if [player.get("id") for player in players] == [self.test_player_id]:
+                self.log_test("Bulk Player Lookup", True, "Known player returned, unknown ID skipped")
+            else:
+                self.log_test("Bulk Player Lookup", False, f"Unexpected players: {players}")
+        else:
+            self.log_test("Bulk Player Lookup", False, f"Bulk lookup failed: {error or response.status_code}")
+        
+        seen = set()
+        params = {"limit": 100}
+        for _ in range(1000):
+            response, success, error = self.make_request("GET", "/game/players/changes", params=params)
+            if not success or response.status_code != 200:
+                self.log_test("Player Change Feed", False, f"Change feed failed: {error or response.status_code}")
+                return
+            page = response.json()
+            seen.update(player["id"] for player in page["players"])
+            if not page["has_more"]:
+                break
+            params = {"limit": 100, "updated_since": page["next_updated_since"], "after_id": page["next_after_id"]}
+        
+        if self.test_player_id in seen:
+            self.log_test("Player Change Feed", True, f"Full sync returned {len(seen)} players")
+        else:
+            self.log_test("Player Change Feed", False, "Test player missing from full sync")
+        
+        if not IN_PROCESS:
+            return
+        
+        # Players written before updated_at existed page through the feed first
+        legacy_ids = sorted(str(uuid.uuid4()) for _ in range(2))
+        
+        async def insert_legacy_players():
+            from database import players_collection
+            await players_collection.insert_many([
+                {"id": player_id, "username": f"legacy_{player_id[:8]}", "created_at": datetime.utcnow(),
+                 "total_games": 0, "total_score": 0, "best_score": 0}
+                for player_id in legacy_ids
+            ])
+        
+        self.http.run(insert_legacy_players())
+        seen = []
+        params = {"limit": 1}
+        for _ in range(3):
+            response, success, error = self.make_request("GET", "/game/players/changes", params=params)
+            if not success or response.status_code != 200:
+                self.log_test("Legacy Player Sync", False, f"Change feed failed: {error or response.status_code}")
+                return
+            page = response.json()
+            seen.extend(player["id"] for player in page["players"])
+            params = {"limit": 1, "updated_since": page["next_updated_since"], "after_id": page["next_after_id"]}
+        if seen[:2] == legacy_ids and len(set(seen)) == 3:
+            self.log_test("Legacy Player Sync", True, "Unstamped players paged through, then stamped ones")
+        else:
+            self.log_test("Legacy Player Sync", False, f"Unexpected pages: {seen}")
+    
+    def test_groups(self):
+        """Test clan and friend leaderboards"""
+        print("\n=== Testing Group Leaderboards ===")
+        
+        if not self.test_player_id:
+            self.log_test("Group Leaderboards", False, "No test player available")
+            return
+        
+        group_data = {"name": f"Test Clan {uuid.uuid4().hex[:6]}", "owner_id": self.test_player_id}
+        response, success, error = self.make_request("POST", "/game/groups", group_data)
+        if not success or response.status_code != 200:
+            self.log_test("Create Group", False, f"Create group failed: {error or response.status_code}")
+            return
+        group = response.json()
+        self.log_test("Create Group", group.get("member_count") == 1, f"Group created - ID: {group.get('id')}")
+        
+        friend_data = {"username": f"test_friend_{uuid.uuid4().hex[:8]}"}
+        response, success, error = self.make_request("POST", "/game/players", friend_data)
+        if not success or response.status_code != 200:
+            self.log_test("Create Friend", False, f"Create friend failed: {error or response.status_code}")
+            return
+        friend_id = response.json()["id"]
+        
+        response, success, error = self.make_request(
+            "POST", f"/game/groups/{group['id']}/members", {"player_id": friend_id}
+        )
+        if success and response.status_code == 200 and response.json().get("member_count") == 2:
+            self.log_test("Join Group", True, "Friend joined the clan")
+        else:
+            self.log_test("Join Group", False, f"Join group failed: {error or response.status_code}")
+        
+        game_data = {"player_id": friend_id, "player_username": friend_data["username"]}
+        response, success, _ = self.make_request("POST", "/game/games", game_data)
+        if success and response.status_code == 200:
+            final_data = {"final_score": 7700, "max_wave": 5, "game_duration": 80}
+            self.make_request("POST", f"/game/games/{response.json()['id']}/end", final_data)
+            self.wait_for_result(response.json()["id"])
+        
+        params = {"player_id": friend_id}
+        response, success, error = self.make_request("GET", f"/game/groups/{group['id']}/leaderboard", params=params)
+        if success and response.status_code == 200:
+            board = response.json()
+            if any(entry["player_id"] == friend_id for entry in board["entries"]) and board.get("user_rank"):
+                self.log_test("Group Leaderboard", True,
+                    f"Group board has {board['total_entries']} entries, friend rank {board['user_rank']}")
+            else:
+                self.log_test("Group Leaderboard", False, f"Friend's game missing from group board: {board}")
+        else:
+            self.log_test("Group Leaderboard", False, f"Group leaderboard failed: {error or response.status_code}")
+        
+        response, success, error = self.make_request(
+            "POST", f"/game/players/{self.test_player_id}/friends", {"friend_id": friend_id}
+        )
+        board_response, board_success, _ = self.make_request(
+            "GET", f"/game/players/{friend_id}/friends/leaderboard"
+        )
+        if success and response.status_code == 200 and board_success and board_response.status_code == 200:
+            player_ids = {entry["player_id"] for entry in board_response.json()["entries"]}
+            if self.test_player_id in player_ids:
+                self.log_test("Friend Leaderboard", True, f"Friend board has {len(player_ids)} entries")
+            else:
+                self.log_test("Friend Leaderboard", False, "Befriended player missing from friend board")
+        else:
+            self.log_test("Friend Leaderboard", False, f"Friend leaderboard failed: {error or response.status_code}")
+        
+        if IN_PROCESS:
+            # A member whose best game was archived still joins with it
+            async def archive_friend_scores():
+                from database import scores_collection
+                await scores_collection.delete_many({"player_id": friend_id})
+            
+            self.http.run(archive_friend_scores())
+            response, success, error = self.make_request("POST", "/game/groups", {
+                "name": f"Archive Clan {uuid.uuid4().hex[:6]}", "owner_id": self.test_player_id
+            })
+            if success and response.status_code == 200:
+                archive_group_id = response.json()["id"]
+                self.make_request("POST", f"/game/groups/{archive_group_id}/members", {"player_id": friend_id})
+                response, success, error = self.make_request(
+                    "GET", f"/game/groups/{archive_group_id}/leaderboard", params={"player_id": friend_id}
+                )
+            if success and response.status_code == 200 and response.json().get("user_best_score") == 7700:
+                self.log_test("Group Archived Best", True, "Archived best game kept on the group board")
+            else:
+                self.log_test("Group Archived Best", False,
+                    f"Archived best missing: {response.json() if success else error}")
+    
+    def test_replays(self):
+        """Test replay upload and ranged playback"""
+        print("\n=== Testing Replays ===")
+        
+        if not self.test_player_id:
+            self.log_test("Replays", False, "No test player available")
+            return
+        
+        game_data = {"player_id": self.test_player_id, "player_username": "replay_test"}
+        response, success, error = self.make_request("POST", "/game/games", game_data)
+        if not success or response.status_code != 200:
+            self.log_test("Replay Game", False, f"Create game failed: {error or response.status_code}")
+            return
+        game_id = response.json()["id"]
+        self.make_request("POST", f"/game/games/{game_id}/end", {"final_score": 10_000_000, "max_wave": 40})
+        
+        replay = os.urandom(100_000)
+        response, success, error = self.make_request(
+            "PUT", f"/game/games/{game_id}/replay", body=replay,
+            headers={"Content-Type": "application/octet-stream"}
+        )
+        if success and response.status_code == 200 and response.json().get("size") == len(replay):
+            self.log_test("Upload Replay", True, f"Replay stored ({len(replay)} bytes)")
+        else:
+            self.log_test("Upload Replay", False, f"Upload failed: {error or response.status_code}")
+            return
+        
+        response, success, error = self.make_request("GET", f"/game/games/{game_id}/replay")
+        if success and response.status_code == 200 and response.content == replay:
+            self.log_test("Download Replay", True, "Replay served intact")
+        else:
+            self.log_test("Download Replay", False, f"Download failed: {error or response.status_code}")
+        
+        response, success, error = self.make_request(
+            "GET", f"/game/games/{game_id}/replay", headers={"Range": "bytes=1000-1999"}
+        )
+        if (success and response.status_code == 206 and response.content == replay[1000:2000]
+                and response.headers.get("Content-Range") == f"bytes 1000-1999/{len(replay)}"):
+            self.log_test("Replay Range", True, "Range request returned the requested slice")
+        else:
+            self.log_test("Replay Range", False, f"Range request failed: {error or response.status_code}")
+        
+        response, success, error = self.make_request("GET", "/game/replays", params={"limit": 100})
+        if success and response.status_code == 200 and any(
+            entry["game_session_id"] == game_id for entry in response.json()
+        ):
+            self.log_test("Top Replays", True, f"{len(response.json())} replays listed")
+        else:
+            self.log_test("Top Replays", False, f"Replay list failed: {error or response.status_code}")
+        
+        if not IN_PROCESS:
+            return
+        
+        # With a top 2, a low score is refused: earlier games outscore it though they have no replay
+        game_data = {"player_id": self.test_player_id, "player_username": "replay_test"}
+        response, success, error = self.make_request("POST", "/game/games", game_data)
+        if not success or response.status_code != 200:
+            self.log_test("Replay Cut-off", False, f"Create game failed: {error or response.status_code}")
+            return
+        low_game_id = response.json()["id"]
+        self.make_request("POST", f"/game/games/{low_game_id}/end", {"final_score": 1, "max_wave": 1})
+        import replays
+        top_n, replays.REPLAY_TOP_N = replays.REPLAY_TOP_N, 2
+        try:
+            response, success, error = self.make_request(
+                "PUT", f"/game/games/{low_game_id}/replay", body=b"replay",
+                headers={"Content-Type": "application/octet-stream"}
+            )
+        finally:
+            replays.REPLAY_TOP_N = top_n
+        if success and response.status_code == 409:
+            self.log_test("Replay Cut-off", True, "Game outside the leaderboard top N refused")
+        else:
+            self.log_test("Replay Cut-off", False, f"Expected 409: {error or response.status_code}")
+    
+    def test_response_encodings(self):
+        """Test compressed and MessagePack responses"""
+        print("\n=== Testing Response Encodings ===")
+        
+        if not self.test_player_id:
+            self.log_test("Response Encodings", False, "No test player available")
+            return
+        
+        headers = {"Accept-Encoding": "gzip"}
+        response, success, error = self.make_request("GET", f"/game/players/{self.test_player_id}/stats", headers=headers)
+        if success and response.status_code == 200 and response.headers.get("Content-Encoding") == "gzip":
+            self.log_test("Compressed Response", True,
+                f"Stats served gzipped ({response.headers.get('Content-Length')} bytes on the wire)")
+        else:
+            self.log_test("Compressed Response", False, f"Stats not gzipped: {error or response.headers}")
+        
+        headers = {"Accept": "application/msgpack"}
+        response, success, error = self.make_request("GET", "/game/leaderboard", headers=headers)
+        if not success or response.status_code != 200:
+            self.log_test("MessagePack Response", False, f"MessagePack leaderboard failed: {error or response.status_code}")
+            return
+        content_type = response.headers.get("Content-Type", "")
+        vary = [value.strip().lower() for value in response.headers.get("Vary", "").split(",")]
+        try:
+            board = msgpack.unpackb(response.content)
+        except ValueError as e:
+            board = f"undecodable body: {e}"
+        if not content_type.startswith("application/msgpack"):
+            self.log_test("MessagePack Response", False, f"Leaderboard served as {content_type}")
+        elif "accept" not in vary:
+            self.log_test("MessagePack Response", False, f"Missing Vary: Accept ({response.headers.get('Vary')})")
+        elif not isinstance(board, dict) or "entries" not in board:
+            self.log_test("MessagePack Response", False, f"Body is not a MessagePack leaderboard: {board}")
+        else:
+            self.log_test("MessagePack Response", True,
+                f"Leaderboard served as {content_type} ({len(response.content)} bytes, {len(board['entries'])} entries)")
+    
+    def test_activity_stats(self):
+        """Test maintained activity counters"""
+        print("\n=== Testing Activity Statistics ===")
+        
+        response, success, error = self.make_request("GET", "/game/stats/activity", params={"days": 3})
+        if success and response.status_code == 200:
+            stats = response.json()
+            games_today = stats["games_per_day"][-1]["games"] if len(stats["games_per_day"]) == 3 else 0
+            if stats["total_players"] > 0 and stats["total_scores"] > 0 and games_today > 0:
+                self.log_test("Get Activity Stats", True,
+                    f"Players: {stats['total_players']}, scores: {stats['total_scores']}, games today: {games_today}")
+            else:
+                self.log_test("Get Activity Stats", False, f"Counters not maintained: {stats}")
+        else:
+            self.log_test("Get Activity Stats", False, f"Activity stats failed: {error or response.status_code}")
+        
+        if not IN_PROCESS:
+            return
+        
+        # A deployment upgraded with existing data starts without counter documents
+        async def reconcile_from_empty():
+            from counters import PLAYERS_COUNTER, SCORES_COUNTER
+            from database import players_collection, player_achievements_collection, scores_collection, stat_counters
+            
+            await stat_counters.collection.delete_many({})  # The reconcile lease goes too
+            await stat_counters.reconcile(scores_collection, players_collection, player_achievements_collection)
+            await stat_counters.refresh()
+            return (
+                (stat_counters.get(SCORES_COUNTER), await scores_collection.count_documents({})),
+                (stat_counters.get(PLAYERS_COUNTER), await players_collection.count_documents({})),
+            )
+        
+        seeded = self.http.run(reconcile_from_empty())
+        if all(counted == exact for counted, exact in seeded):
+            self.log_test("Counter Seeding", True, f"First reconcile seeded exact counts {seeded}")
+        else:
+            self.log_test("Counter Seeding", False, f"Counters not seeded (counted, exact): {seeded}")
+    
+    def test_global_stats(self):
+        """Test global score distribution endpoint"""
+        print("\n=== Testing Global Statistics ===")
+        
+        params = {"score": 12500, "bins": 10, "cdf": [1000, 10000]}
+        response, success, error = self.make_request("GET", "/game/stats/global", params=params)
+        if success and response.status_code == 200:
+            stats = response.json()
+            required_fields = ["total_players", "score", "wave", "game_duration"]
+            if all(field in stats for field in required_fields):
+                self.log_test("Get Global Stats", True,
+                    f"Global stats retrieved - Players: {stats['total_players']}, "
+                    f"Beaten: {stats.get('score_beaten_fraction')}")
+            else:
+                missing = [f for f in required_fields if f not in stats]
+                self.log_test("Get Global Stats", False, f"Missing required fields: {missing}")
+            if len(stats.get("score_cdf") or []) == 2:
+                self.log_test("Global Stats CDF", True, f"CDF points: {stats['score_cdf']}")
+            else:
+                self.log_test("Global Stats CDF", False, f"CDF not returned for both points: {stats.get('score_cdf')}")
+        else:
+            self.log_test("Get Global Stats", False, f"Global stats failed: {error or response.status_code}")
+    
+    def test_projection_replay(self):
+        """Test that replaying an overlapping projection batch applies every game once"""
+        print("\n=== Testing Projection Replay ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        response, success, error = self.make_request(
+            "POST", "/game/players", {"username": f"projection_{uuid.uuid4().hex[:8]}"}
+        )
+        if not success or response.status_code != 200:
+            self.log_test("Projection Replay", False, f"Create player failed: {error or response.status_code}")
+            return
+        player_id = response.json()["id"]
+        
+        async def replay_overlapping_batches():
+            from database import players_collection
+            from event_log import encode_event
+            from projections import apply_batch
+            
+            events = [
+                encode_event(seq, {
+                    "id": str(uuid.uuid4()), "player_id": player_id, "end_time": datetime.utcnow(),
+                    "final_score": score, "max_wave": 2, "game_duration": 60,
+                })
+                for seq, score in enumerate((100, 200, 300), start=1)
+            ]
+            await apply_batch(events[:2], players_collection)
+            # A resumed worker cuts batches differently: the first game is replayed with a new one
+            await apply_batch([events[0], events[2]], players_collection)
+            await apply_batch(events, players_collection)
+            return await players_collection.find_one({"id": player_id}, {"_id": 0})
+        
+        player = self.http.run(replay_overlapping_batches())
+        if player and player.get("total_games") == 3 and player.get("total_score") == 600:
+            self.log_test("Projection Replay", True, "Overlapping replays counted every game exactly once")
+        else:
+            self.log_test("Projection Replay", False,
+                f"Wrong aggregates: {player and (player.get('total_games'), player.get('total_score'))}")
+    
+    def test_id_migration(self):
+        """Test migrate-ids over mixed string and binary ids, with dual-read lookups"""
+        print("\n=== Testing ID Migration ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        async def migrate_mixed_collection():
+            import ids
+            from database import db
+            
+            raw = db["id_migration_test"]
+            wrapped = ids.IdCodecCollection(raw)
+            string_id, binary_id, mixed_id, player_id = (str(uuid.uuid4()) for _ in range(4))
+            await raw.delete_many({})
+            await raw.insert_many([
+                {"id": string_id, "player_id": player_id},
+                {"id": ids.encode_id(binary_id), "player_id": ids.encode_id(player_id)},
+                {"id": ids.encode_id(mixed_id), "player_id": player_id},
+                {"id": "not-a-uuid", "player_id": player_id},
+            ])
+            
+            dual_read = ids.ID_DUAL_READ
+            ids.ID_DUAL_READ = True  # Widens lookups only, so the app keeps working meanwhile
+            try:
+                async def dual_read_lookups():
+                    found = [await wrapped.find_one({"id": value}) for value in (string_id, binary_id, mixed_id)]
+                    return (
+                        [doc and doc["id"] for doc in found] == [string_id, binary_id, mixed_id]
+                        and await wrapped.count_documents({"player_id": player_id}) == 4
+                    )
+                
+                before = await dual_read_lookups()
+                first = await ids.migrate_collection(raw, batch_size=2)
+                after = await dual_read_lookups()
+                second = await ids.migrate_collection(raw, batch_size=2)
+            finally:
+                ids.ID_DUAL_READ = dual_read
+            
+            # Once ID_DUAL_READ is dropped, binary storage only looks up the binary form
+            binary_only = all([
+                await raw.find_one({"id": ids.encode_id(value)}) for value in (string_id, binary_id, mixed_id)
+            ]) and await raw.count_documents({"player_id": ids.encode_id(player_id)}) == 4
+            untouched = await raw.find_one({"id": "not-a-uuid"})
+            await raw.drop()
+            return before, first, after, second, binary_only, untouched["player_id"] == ids.encode_id(player_id)
+        
+        before, first, after, second, binary_only, bad_id_kept = self.http.run(migrate_mixed_collection())
+        if before and after and first == 3 and second == 0 and binary_only and bad_id_kept:
+            self.log_test("ID Migration", True, "Mixed ids migrated once, found before and after")
+        else:
+            self.log_test("ID Migration", False,
+                f"before={before} migrated={first} after={after} rerun={second} binary_only={binary_only}")
+        
+        async def migrate_replays():
+            import ids
+            from database import db
+            
+            if "replays" not in ids.MIGRATED_COLLECTIONS:
+                return "replays are not migrated"
+            if not (ids.ID_STORAGE == "binary" and ids.ID_DUAL_READ):
+                return None  # Only rollout step 4 may migrate the live collections
+            game_id = str(uuid.uuid4())
+            await db.replays.insert_one({
+                "game_session_id": game_id, "player_id": str(uuid.uuid4()), "score": 0, "created_at": datetime.utcnow()
+            })
+            await ids.migrate_collection(db.replays)
+            # What a lookup matches once ID_DUAL_READ is dropped
+            migrated = await db.replays.delete_one({"game_session_id": ids.encode_id(game_id)})
+            return None if migrated.deleted_count else "string replay id not migrated"
+        
+        problem = self.http.run(migrate_replays())
+        if problem:
+            self.log_test("Replay ID Migration", False, problem)
+        else:
+            self.log_test("Replay ID Migration", True, "Replays are migrated with the other id collections")
+    
+    def test_archive_restore(self):
+        """Test that archiving keeps the all-time aggregates and restore brings the rows back"""
+        print("\n=== Testing Archive and Restore ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        old = datetime.utcnow() - timedelta(days=400)
+        player_id = str(uuid.uuid4())
+        scores = [
+            {"id": str(uuid.uuid4()), "player_id": player_id, "player_username": "archived",
+             "game_session_id": str(uuid.uuid4()), "score": score, "wave": 1, "powerups_collected": 0,
+             "enemies_destroyed": 0, "asteroids_destroyed": 0, "game_duration": 4321, "created_at": old}
+            for score in (1, 2, 3)
+        ]
+        session = {"id": scores[0]["game_session_id"], "player_id": player_id, "player_username": "archived",
+                   "status": "completed", "start_time": old, "end_time": old}
+        
+        async def refresh():
+            from archive import archived_scores
+            from database import score_archive_stats_collection, stats_players_collection, stats_scores_collection
+            from global_stats import global_stats
+            
+            await archived_scores.refresh(score_archive_stats_collection)
+            await global_stats.rebuild(stats_players_collection, stats_scores_collection)
+        
+        async def seed():
+            from counters import SCORES_COUNTER
+            from database import game_sessions_collection, scores_collection, stat_counters
+            
+            await scores_collection.insert_many([dict(score) for score in scores])
+            await stat_counters.incr(SCORES_COUNTER, len(scores))
+            await game_sessions_collection.insert_one(dict(session))
+            await refresh()
+        
+        async def archive():
+            from archive import archive_scores, archive_sessions
+            from database import (
+                game_sessions_collection, game_sessions_archive_collection, score_archive_stats_collection,
+                scores_archive_collection, scores_collection, stat_counters
+            )
+            
+            archived = await archive_scores(
+                scores_collection, scores_archive_collection, score_archive_stats_collection,
+                older_than_days=300, keep_top=1, counters=stat_counters
+            )
+            archived += await archive_sessions(game_sessions_collection, game_sessions_archive_collection, 300)
+            await refresh()
+            return archived, await scores_collection.count_documents({"player_id": player_id})
+        
+        async def restore():
+            from archive import restore_archived, restore_scores
+            from database import (
+                game_sessions_collection, game_sessions_archive_collection, score_archive_stats_collection,
+                scores_archive_collection, scores_collection, stat_counters
+            )
+            
+            restored = await restore_scores(
+                scores_collection, scores_archive_collection, score_archive_stats_collection, counters=stat_counters
+            )
+            restored += await restore_archived(game_sessions_collection, game_sessions_archive_collection)
+            await refresh()
+            return (
+                restored, await scores_collection.count_documents({"player_id": player_id}),
+                await game_sessions_collection.find_one({"id": session["id"]}) is not None
+            )
+        
+        def aggregates():
+            response, success, error = self.make_request("GET", "/game/stats/global")
+            durations = response.json()["game_duration"] if success and response.status_code == 200 else {}
+            response, success, error = self.make_request("GET", "/game/stats/activity")
+            total_scores = response.json()["total_scores"] if success and response.status_code == 200 else None
+            return durations.get("count"), durations.get("max"), total_scores
+        
+        self.http.run(seed())
+        before = aggregates()
+        archived, hot_left = self.http.run(archive())
+        after_archive = aggregates()
+        # 3 scores and their session archived; the stats must not change
+        if archived == 4 and hot_left == 0 and after_archive[0] == before[0] and after_archive[2] == before[2] \
+                and abs(after_archive[1] - 4321) <= 4321 * 0.02:
+            self.log_test("Archive Aggregates", True, f"Durations {before[0]} games, {before[2]} scores kept")
+        else:
+            self.log_test("Archive Aggregates", False,
+                f"archived={archived} hot_left={hot_left} before={before} after={after_archive}")
+        
+        restored, hot_back, session_back = self.http.run(restore())
+        after_restore = aggregates()
+        if restored == 4 and hot_back == 3 and session_back and after_restore == before:
+            self.log_test("Archive Restore", True, "Rows restored and aggregates back to their originals")
+        else:
+            self.log_test("Archive Restore", False,
+                f"restored={restored} hot={hot_back} session={session_back} before={before} after={after_restore}")
+    
+    def test_embedded_journal(self):
+        """Test that embedded storage recovers acknowledged writes from its journal and snapshots"""
+        print("\n=== Testing Embedded Storage Journal ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        import shutil
+        import tempfile
+        data_dir = tempfile.mkdtemp(prefix="embedded-test-")
+        
+        async def contents(client):
+            return await client["journal_test"]["items"].find({}, {"_id": 0}).sort("n", 1).to_list(length=None)
+        
+        async def write_then_reopen():
+            from pymongo import UpdateOne
+            from embedded_storage import EmbeddedClient
+            
+            client = EmbeddedClient(data_dir)
+            items = client["journal_test"]["items"]
+            await items.insert_many([{"n": n, "seen": None} for n in range(5)])
+            await items.update_one({"n": 0}, {"$max": {"seen": datetime(2024, 1, 1)}, "$inc": {"hits": 1}})
+            await items.update_many({"n": {"$gte": 3}}, {"$set": {"tag": "high"}})
+            await items.delete_one({"n": 1})
+            await items.bulk_write([
+                UpdateOne({"n": 9}, {"$set": {"tag": "upserted"}}, upsert=True),
+                UpdateOne({"n": 2}, {"$min": {"seen": datetime(2023, 1, 1)}}),
+            ], ordered=False)
+            expected = await contents(client)
+            
+            # No close and no snapshot: as after a crash
+            after_crash = await contents(EmbeddedClient(data_dir))
+            await client.save()
+            await items.insert_one({"n": 10})
+            client.close()
+            after_snapshot = await contents(EmbeddedClient(data_dir))
+            return expected, after_crash, after_snapshot
+        
+        try:
+            expected, after_crash, after_snapshot = self.http.run(write_then_reopen())
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        # In BSON order null sorts below every date: $max replaces it, $min keeps it
+        bson_order = expected[0]["seen"] == datetime(2024, 1, 1) and expected[1]["seen"] is None
+        if after_crash == expected and after_snapshot == expected + [{"n": 10}] and bson_order:
+            self.log_test("Embedded Journal", True, f"{len(expected)} documents recovered from journal and snapshot")
+        else:
+            self.log_test("Embedded Journal", False,
+                f"expected={expected} after_crash={after_crash} after_snapshot={after_snapshot}")
+    
+    def test_longest_game_backfill(self):
+        """Test that players from before longest_game existed get it from their scores"""
+        print("\n=== Testing Longest Game Backfill ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        player_id = str(uuid.uuid4())
+        
+        async def seed_and_backfill():
+            from database import backfill_longest_game, players_collection, scores_collection
+            
+            # As written before longest_game was tracked
+            await players_collection.insert_one({
+                "id": player_id, "username": f"legacy_{player_id[:8]}", "created_at": datetime.utcnow(),
+                "total_games": 2, "total_score": 30, "best_score": 20, "total_playtime": 140,
+                "updated_at": datetime.utcnow(),
+            })
+            await scores_collection.insert_many([
+                {"id": str(uuid.uuid4()), "player_id": player_id, "player_username": f"legacy_{player_id[:8]}",
+                 "game_session_id": str(uuid.uuid4()), "score": score, "wave": 1, "powerups_collected": 0,
+                 "enemies_destroyed": 0, "asteroids_destroyed": 0, "game_duration": duration,
+                 "created_at": datetime.utcnow()}
+                for score, duration in ((10, 95), (20, 45))
+            ])
+            return await backfill_longest_game(), await backfill_longest_game()
+        
+        filled, refilled = self.http.run(seed_and_backfill())
+        response, success, error = self.make_request("GET", "/game/achievements", params={"player_id": player_id})
+        progress = None
+        if success and response.status_code == 200:
+            progress = next((a.get("progress") for a in response.json() if a["id"] == "survivor"), None)
+        if filled >= 1 and refilled == 0 and progress == 95:
+            self.log_test("Longest Game Backfill", True, "Survivor progress filled from the longest score")
+        else:
+            self.log_test("Longest Game Backfill", False,
+                f"filled={filled} refilled={refilled} survivor progress={progress}")
+    
+    def test_achievement_backfill(self):
+        """Test backfilling a new achievement over legacy players, and that a re-run unlocks nothing"""
+        print("\n=== Testing Achievement Backfill ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        achievement_id = f"backfill_test_{uuid.uuid4().hex[:8]}"
+        # Player ids by longest game; none has a longest_game field yet
+        durations = {str(uuid.uuid4()): duration for duration in (300, 90, 20)}
+        
+        async def seed():
+            from database import achievements_collection, players_collection, scores_collection
+            
+            await achievements_collection.insert_one({
+                "id": achievement_id, "name": "Backfill Test", "description": "Survive for a minute",
+                "icon": "⏱️", "category": "survival", "requirement_type": "game_duration",
+                "requirement_value": 60, "points": 0, "is_hidden": True, "created_at": datetime.utcnow(),
+            })
+            for player_id, duration in durations.items():
+                username = f"legacy_{player_id[:8]}"
+                await players_collection.insert_one({
+                    "id": player_id, "username": username, "created_at": datetime.utcnow(),
+                    "total_games": 1, "total_score": 10, "best_score": 10, "total_playtime": duration,
+                    "updated_at": datetime.utcnow(),
+                })
+                await scores_collection.insert_one({
+                    "id": str(uuid.uuid4()), "player_id": player_id, "player_username": username,
+                    "game_session_id": str(uuid.uuid4()), "score": 10, "wave": 1, "powerups_collected": 0,
+                    "enemies_destroyed": 0, "asteroids_destroyed": 0, "game_duration": duration,
+                    "created_at": datetime.utcnow(),
+                })
+        
+        async def backfill():
+            # What manage.py backfill-achievements runs
+            from achievement_backfill import backfill_achievements
+            from database import (
+                PROGRESS_FIELDS, achievement_backfills_collection, achievements_collection,
+                backfill_longest_game, player_achievements_collection, players_collection, stat_counters
+            )
+            
+            await backfill_longest_game()
+            job = await backfill_achievements(
+                [achievement_id], players_collection, achievements_collection,
+                player_achievements_collection, achievement_backfills_collection,
+                PROGRESS_FIELDS, batch_size=2, counters=stat_counters
+            )
+            unlocked = await player_achievements_collection.find(
+                {"achievement_id": achievement_id}, {"_id": 0, "player_id": 1}
+            ).to_list(length=None)
+            return job["unlocked"], {doc["player_id"] for doc in unlocked}
+        
+        async def cleanup():
+            from counters import unlocks_counter
+            from database import achievements_collection, player_achievements_collection, stat_counters
+            
+            removed = await player_achievements_collection.delete_many({"achievement_id": achievement_id})
+            await stat_counters.incr(unlocks_counter(achievement_id), -removed.deleted_count)
+            await achievements_collection.delete_one({"id": achievement_id})
+        
+        self.http.run(seed())
+        try:
+            first, unlocked_first = self.http.run(backfill())
+            second, unlocked_second = self.http.run(backfill())
+        finally:
+            self.http.run(cleanup())
+        qualifying = {player_id for player_id, duration in durations.items() if duration >= 60}
+        legacy_unlocked = unlocked_first & set(durations)
+        if legacy_unlocked == qualifying and first >= len(qualifying) and second == 0 \
+                and unlocked_second == unlocked_first:
+            self.log_test("Achievement Backfill", True,
+                f"{first} unlocks, including {len(qualifying)} legacy players; re-run unlocked nothing")
+        else:
+            self.log_test("Achievement Backfill", False,
+                f"legacy unlocked={len(legacy_unlocked)}/{len(qualifying)} first={first} second={second}")
+    
+    def test_player_rebuild(self):
+        """Test that rebuild-players restores player aggregates from the event snapshot and the log tail"""
+        print("\n=== Testing Player Rebuild ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        response, success, error = self.make_request(
+            "POST", "/game/players", {"username": f"rebuild_{uuid.uuid4().hex[:8]}"}
+        )
+        if not success or response.status_code != 200:
+            self.log_test("Player Rebuild", False, f"Create player failed: {error or response.status_code}")
+            return
+        player = response.json()
+        
+        def play(final_data):
+            game_data = {"player_id": player["id"], "player_username": player["username"]}
+            response, success, _ = self.make_request("POST", "/game/games", game_data)
+            if success and response.status_code == 200:
+                self.make_request("POST", f"/game/games/{response.json()['id']}/end", final_data)
+                self.wait_for_result(response.json()["id"])
+        
+        async def snapshot():
+            from database import counters_collection, event_snapshots_collection, game_events_collection, players_collection
+            from event_log import take_snapshot
+            
+            # Seeded from the player documents, as on a first run
+            return await take_snapshot(
+                game_events_collection, event_snapshots_collection, counters_collection,
+                players_collection=players_collection
+            )
+        
+        async def corrupt_and_rebuild():
+            from database import event_snapshots_collection, game_events_collection, players_collection
+            from event_log import PLAYER_VIEW_FIELDS, rebuild_player_views
+            
+            projection = {"_id": 0, **{field: 1 for field in PLAYER_VIEW_FIELDS}}
+            expected = await players_collection.find_one({"id": player["id"]}, projection)
+            await players_collection.update_one(
+                {"id": player["id"]},
+                {"$set": {"total_games": 0, "total_score": 0, "best_score": 0, "longest_game": 0}}
+            )
+            result = await rebuild_player_views(game_events_collection, event_snapshots_collection, players_collection)
+            return expected, await players_collection.find_one({"id": player["id"]}, projection), result
+        
+        play({"final_score": 1500, "max_wave": 3, "game_duration": 200, "enemies_destroyed": 12})
+        snapshot_seq = self.http.run(snapshot())
+        play({"final_score": 900, "max_wave": 5, "game_duration": 100, "enemies_destroyed": 8})
+        expected, rebuilt, result = self.http.run(corrupt_and_rebuild())
+        if rebuilt == expected and expected.get("total_games") == 2 and result["snapshot_seq"] == snapshot_seq \
+                and result["events_replayed"] >= 1:
+            self.log_test("Player Rebuild", True,
+                f"Aggregates restored from snapshot {snapshot_seq} and {result['events_replayed']} later events")
+        else:
+            self.log_test("Player Rebuild", False, f"expected={expected} rebuilt={rebuilt} result={result}")
+    
+    def test_leaderboard_snapshot_journal(self):
+        """Test that workers overlay journaled scores on the snapshot and the writer folds them in"""
+        print("\n=== Testing Leaderboard Snapshot Journal ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        import shutil
+        import tempfile
+        data_dir = tempfile.mkdtemp(prefix="leaderboard-test-")
+        old_id, new_id = str(uuid.uuid4()), str(uuid.uuid4())
+        
+        def score(player_id, value):
+            return {"player_id": player_id, "player_username": f"p{value}", "score": value, "wave": 1,
+                    "game_duration": 60, "created_at": datetime.utcnow()}
+        
+        def view(snapshot):
+            return (
+                snapshot.generation, snapshot.records, snapshot.total_scores, snapshot.rank(400),
+                snapshot.best_score(old_id), snapshot.best_score(new_id), [row["score"] for row in snapshot.page(0, 10)]
+            )
+        
+        async def journal_then_fold():
+            import numpy as np
+            from leaderboard_snapshot import (
+                ENTRY_DTYPE, JOURNAL_HEADER, PLAYER_DTYPE, LeaderboardSnapshot, encode_snapshot, entry_row
+            )
+            
+            path = os.path.join(data_dir, "board.snap")
+            writer, worker = LeaderboardSnapshot(path), LeaderboardSnapshot(path)
+            base = [score(old_id, 100), score(str(uuid.uuid4()), 300), score(str(uuid.uuid4()), 500)]
+            writer._start_journal(1)
+            writer._publish(encode_snapshot(
+                1, [row["score"] for row in base], np.array([entry_row(row) for row in base], dtype=ENTRY_DTYPE),
+                np.array([(row["player_id"].encode(), row["score"]) for row in base], dtype=PLAYER_DTYPE),
+                [], 1, JOURNAL_HEADER.size
+            ))
+            worker.notify_changed(score(old_id, 400))
+            writer.notify_changed(score(new_id, 600))
+            overlaid = view(worker.fresh())
+            
+            await writer.patch(fold_records=2)
+            worker._checked_at = 0.0
+            folded = view(worker.current())
+            restarted = view(LeaderboardSnapshot(path).current())
+            return overlaid, folded, restarted
+        
+        try:
+            overlaid, folded, restarted = self.http.run(journal_then_fold())
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        board = (5, 3, 400, 600, [600, 500, 400, 300, 100])
+        if overlaid == (1, 2, *board) and folded == (2, 0, *board) and restarted == folded:
+            self.log_test("Leaderboard Snapshot Journal", True, "Journaled scores overlaid, then folded into the file")
+        else:
+            self.log_test("Leaderboard Snapshot Journal", False,
+                f"overlaid={overlaid} folded={folded} restarted={restarted}")
+    
+    def test_rate_limiting(self):
+        """Test the 429 path and which X-Forwarded-For hops identify the client"""
+        print("\n=== Testing Rate Limiting ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        import ipaddress
+        import rate_limit
+        from starlette.requests import Request
+        
+        # Fresh buckets, so earlier tests neither help nor hurt
+        backend, buckets = rate_limit.rate_limit_backend, rate_limit.LocalBucketBackend(worker_count=1)
+        rate_limit.rate_limit_backend = buckets
+        try:
+            limited = None
+            for attempt in range(500):
+                # A new X-Forwarded-For each time: from a peer that is not a trusted proxy it is ignored,
+                # so it cannot reset the budget
+                headers = {"X-Forwarded-For": f"203.0.113.{attempt % 250}"}
+                response, success, error = self.make_request(
+                    "GET", "/game/leaderboard", params={"limit": 1}, headers=headers
+                )
+                if success and response.status_code == 429:
+                    limited = response
+                    break
+        finally:
+            rate_limit.rate_limit_backend = backend
+        if limited is not None and int(limited.headers.get("Retry-After", 0)) >= 1 and len(buckets._buckets) == 1:
+            self.log_test("Rate Limit 429", True, f"Limited after {attempt} requests with Retry-After")
+        else:
+            self.log_test("Rate Limit 429", False,
+                f"limited={limited is not None} clients seen={len(buckets._buckets)}")
+        
+        def key(peer, forwarded):
+            headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+            request = Request({"type": "http", "headers": headers, "client": (peer, 4321)})
+            return rate_limit.client_key(request, trusted=[ipaddress.ip_network("10.0.0.0/8")])
+        
+        cases = {
+            # Right-most hop that is not a trusted proxy; the left part is client-supplied
+            ("10.0.0.2", "198.51.100.7, 203.0.113.9, 10.0.0.1"): "203.0.113.9",
+            ("10.0.0.2", "203.0.113.9"): "203.0.113.9",
+            ("192.0.2.1", "203.0.113.9"): "192.0.2.1",  # Untrusted peer: header ignored
+            ("10.0.0.2", "10.0.0.5, 10.0.0.1"): "10.0.0.5",  # Only proxies: the left-most
+            ("10.0.0.2", None): "10.0.0.2",
+        }
+        wrong = {args: key(*args) for args, expected in cases.items() if key(*args) != expected}
+        if not wrong:
+            self.log_test("Trusted Proxy Forwarding", True, f"{len(cases)} forwarding chains keyed correctly")
+        else:
+            self.log_test("Trusted Proxy Forwarding", False, f"Wrong client keys: {wrong}")
+    
+    def test_catalog_lagging_secondary(self):
+        """Test that a catalog read from a secondary that has not caught up is neither served empty nor cached"""
+        print("\n=== Testing Catalog Read From a Lagging Secondary ===")
+        
+        if not IN_PROCESS:
+            print("Skipped: needs BACKEND_TEST_IN_PROCESS=1")
+            return
+        
+        async def read_catalog():
+            import database
+            
+            routed_catalog, primary = database.catalog_achievements_collection, database.achievements_collection
+            # An empty collection stands in for a secondary that has not replicated init_achievements
+            lagging = database.db["lagging_achievements"]
+            try:
+                database.catalog_achievements_collection = lagging
+                database.invalidate_achievement_catalog()
+                from_primary = await database.get_achievement_catalog()
+                
+                database.achievements_collection = lagging
+                database.invalidate_achievement_catalog()
+                empty = await database.get_achievement_catalog()
+                empty_cached = database._catalog_cache["items"] is not None
+            finally:
+                database.catalog_achievements_collection, database.achievements_collection = routed_catalog, primary
+                database.invalidate_achievement_catalog()
+            return len(from_primary), len(empty), empty_cached
+        
+        from_primary, empty, empty_cached = self.http.run(read_catalog())
+        if from_primary > 0 and empty == 0 and not empty_cached:
+            self.log_test("Catalog Lagging Secondary", True, f"{from_primary} achievements read from the primary")
+        else:
+            self.log_test("Catalog Lagging Secondary", False,
+                f"from_primary={from_primary} empty={empty} empty_cached={empty_cached}")
+    
+    def test_idempotency(self):
+        """Test Idempotency-Key replays for game start and end"""
+        print("\n=== Testing Idempotency Keys ===")
+        
+        if not self.test_player_id:
+            self.log_test("Idempotency Keys", False, "No test player available")
+            return
+        
+        headers = {"Idempotency-Key": f"test-start-{uuid.uuid4()}"}
+        game_data = {"player_id": self.test_player_id, "player_username": "test"}
+        first, success1, _ = self.make_request("POST", "/game/games", game_data, headers=headers)
+        retry, success2, _ = self.make_request("POST", "/game/games", game_data, headers=headers)
+        if success1 and success2 and first.status_code == 200 and retry.status_code == 200 \
+                and first.json()["id"] == retry.json()["id"]:
+            self.log_test("Idempotent Game Start", True, "Retry returned the original game session")
+        else:
+            self.log_test("Idempotent Game Start", False, "Retry created a different game session or failed")
+            return
+        
+        # Keys are per player: another player sending the same key starts their own game
+        response, success, error = self.make_request(
+            "POST", "/game/players", {"username": f"idempotency_{uuid.uuid4().hex[:8]}"}
+        )
+        if success and response.status_code == 200:
+            other_data = {"player_id": response.json()["id"], "player_username": "other"}
+            other, success, error = self.make_request("POST", "/game/games", other_data, headers=headers)
+            if success and other.status_code == 200 and other.json()["player_id"] == other_data["player_id"]:
+                self.log_test("Idempotency Key Scope", True, "Same key from another player started their own game")
+            else:
+                self.log_test("Idempotency Key Scope", False,
+                    f"Same key from another player failed: {other.status_code if success else error}")
+        else:
+            self.log_test("Idempotency Key Scope", False, f"Create player failed: {error or response.status_code}")
+        
+        game_id = first.json()["id"]
+        headers = {"Idempotency-Key": f"test-end-{uuid.uuid4()}"}
+        final_data = {"final_score": 4200, "max_wave": 4, "game_duration": 90}
+        first, success1, _ = self.make_request("POST", f"/game/games/{game_id}/end", final_data, headers=headers)
+        retry, success2, _ = self.make_request("POST", f"/game/games/{game_id}/end", final_data, headers=headers)
+        if success1 and success2 and first.status_code == 200 and retry.status_code == 200 \
+                and first.json()["score"]["id"] == retry.json()["score"]["id"]:
+            self.log_test("Idempotent Game End", True, "Retry returned the original score")
+        else:
+            self.log_test("Idempotent Game End", False, "Retry recorded a second score or failed")
+        
+        changed = {**final_data, "final_score": 1}
+        response, success, error = self.make_request("POST", f"/game/games/{game_id}/end", changed, headers=headers)
+        if success and response.status_code == 422:
+            self.log_test("Idempotency Key Reuse", True, "Reused key with a different body correctly returned 422")
+        else:
+            self.log_test("Idempotency Key Reuse", False, f"Key reuse test failed: {response.status_code if success else error}")
+    
     def test_error_handling(self):
         """Test error handling for various scenarios"""
         print("\n=== Testing Error Handling ===")
@@ -393,7 +1503,7 @@ class CosmicDefenderAPITester:
     def run_all_tests(self):
         """Run all test suites"""
         print(f"🚀 Starting Cosmic Defender Backend API Tests")
-        print(f"📡 Testing against: {self.base_url}")
+        print(f"📡 Testing against: {self.base_url}{' (in-process)' if IN_PROCESS else ''}")
         print("=" * 60)
         
         start_time = time.time()
@@ -405,6 +1515,24 @@ class CosmicDefenderAPITester:
         self.test_leaderboard()
         self.test_achievements()
         self.test_player_stats()
+        self.test_lobby()
+        self.test_player_sync()
+        self.test_groups()
+        self.test_replays()
+        self.test_response_encodings()
+        self.test_global_stats()
+        self.test_activity_stats()
+        self.test_idempotency()
+        self.test_projection_replay()
+        self.test_id_migration()
+        self.test_archive_restore()
+        self.test_embedded_journal()
+        self.test_longest_game_backfill()
+        self.test_achievement_backfill()
+        self.test_player_rebuild()
+        self.test_leaderboard_snapshot_journal()
+        self.test_rate_limiting()
+        self.test_catalog_lagging_secondary()
         self.test_error_handling()
         
         end_time = time.time()